@@ -0,0 +1,120 @@
+"""
+Blueprint for administrative operations.
+"""
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+from flask import Blueprint, Response, jsonify, request
+
+import branches
+import slow_query_log
+import snapshot
+import tracing
+
+admin_blueprint = Blueprint('admin_blueprint', __name__)
+SNAPSHOT_DIR = 'snapshots'
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def snapshot_files():
+    """
+    Returns the database files of the branch of the request.
+    :return: list of paths, None for the default databases
+    """
+    branch = branches.current_branch()
+    if branch is None:
+        return None
+    directory = branches.registry.branch_dir(branch)
+    return [os.path.join(directory, os.path.basename(db_file)) for db_file in snapshot.DB_FILES]
+
+
+@admin_blueprint.route('/admin/snapshot', methods=['POST'])
+def create_snapshot():
+    """
+    This method takes an online snapshot of all databases of the branch of the request into a
+    new directory below SNAPSHOT_DIR, below SNAPSHOT_DIR/<branch> for a branch.
+    :return: the written files
+    """
+    branch = branches.current_branch()
+    target_dir = os.path.join(SNAPSHOT_DIR, *([branch] if branch else []),
+                              datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+    files = snapshot.snapshot_databases(target_dir, snapshot_files())
+    return jsonify({'message': 'Snapshot created', 'files': files}), 201
+
+
+@admin_blueprint.route('/admin/snapshot/export', methods=['GET'])
+def export_snapshot():
+    """
+    This method takes an online snapshot of the branch of the request and streams it as a gzip
+    compressed tar archive. With ?compress=false the archive is only packed, not compressed.
+    :return: application/gzip or application/x-tar stream
+    """
+    compress = request.args.get('compress', 'true').lower() == 'true'
+    work_dir = tempfile.mkdtemp()
+    archive_file = os.path.join(work_dir, 'snapshot.tar.gz' if compress else 'snapshot.tar')
+    try:
+        snapshot.export_snapshot(archive_file, os.path.join(work_dir, 'snapshot'), snapshot_files(),
+                                 compress=compress)
+    except BaseException:
+        # The stream, which removes the directory otherwise, is never started
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+    def stream():
+        try:
+            with open(archive_file, 'rb') as archive:
+                while chunk := archive.read(EXPORT_CHUNK_SIZE):
+                    yield chunk
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    response = Response(stream(),
+                        mimetype='application/gzip' if compress else 'application/x-tar')
+    response.headers['Content-Disposition'] = \
+        f'attachment; filename={os.path.basename(archive_file)}'
+    return response
+
+
+@admin_blueprint.route('/admin/slow_queries', methods=['GET'])
+def get_slow_queries():
+    """
+    This method returns the slowest SQL statements with their query plans.
+    :return: list of statements, slowest first
+    """
+    return jsonify(slow_query_log.get_slow_queries()), 200
+
+
+@admin_blueprint.route('/admin/traces', methods=['GET'])
+def get_traces():
+    """
+    This method returns the latest spans from the trace ring buffer, with ?trace_id= the spans
+    of one trace together with the time per span name.
+    :return: spans, and the summary of a single trace
+    """
+    trace_id = request.args.get('trace_id')
+    if trace_id:
+        spans = tracing.get_spans(trace_id)
+        if not spans:
+            return jsonify({'message': 'Trace not found'}), 404
+        return jsonify({'spans': spans, 'summary': tracing.summarize(spans)}), 200
+    limit = request.args.get('limit', 1000, type=int)
+    return jsonify({'spans': tracing.get_spans(limit=limit)}), 200
+
+
+@admin_blueprint.route('/admin/branches', methods=['POST'])
+def create_branch():
+    """
+    This method creates a library branch with empty databases, e.g. {"branch": "north"}.
+    Its routes are then served below /branches/north/ or with the header X-Branch: north.
+    :return: message
+    """
+    name = (request.get_json(silent=True) or {}).get('branch')
+    try:
+        created = branches.registry.create(name)
+    except (TypeError, ValueError) as e:
+        return jsonify({'message': str(e)}), 400
+    if not created:
+        return jsonify({'message': 'Branch already exists'}), 409
+    return jsonify({'message': 'Branch created'}), 201
@@ -0,0 +1,67 @@
+"""
+Blueprint which runs many API calls in one request and one transaction.
+"""
+import logging
+
+from flask import Blueprint, current_app, jsonify, request
+
+from db import batch_transaction
+
+batch_blueprint = Blueprint('batch_blueprint', __name__)
+MAX_BATCH_OPERATIONS = 100
+BATCH_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+
+@batch_blueprint.route('/batch', methods=['POST'])
+def run_batch():
+    """
+    This method runs a list of operations, e.g.
+    {"operations": [{"method": "POST", "path": "/create_rent", "body": {...}}, ...], "atomic": true}
+    through the handlers of the app in one transaction, and returns the status and body of
+    every operation. With atomic, the first operation answering 400 or above stops the batch
+    and rolls all of it back; otherwise only an operation which fails with an exception does,
+    or one whose writes were rolled back even though it answered a success.
+    :return: committed, the per-operation results and, if not committed, the index of the
+        operation which failed the batch
+    """
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not 1 <= len(operations) <= MAX_BATCH_OPERATIONS:
+        return jsonify({'message': f'operations must be a list of 1 to {MAX_BATCH_OPERATIONS} '
+                                   'operations'}), 400
+    for operation in operations:
+        if (not isinstance(operation, dict) or operation.get('method', 'GET') not in BATCH_METHODS
+                or not str(operation.get('path', '')).startswith('/')
+                or operation['path'] == '/batch'):
+            return jsonify({'message': f'Invalid operation {operation}'}), 400
+
+    results = []
+    with batch_transaction() as batch:
+        for operation in operations:
+            status, body = run_operation(operation)
+            results.append({'status': status, 'body': body})
+            # A DAO rollback inside the batch only marks it failed, the operation may still succeed
+            if batch.failed or status >= 500 or (data.get('atomic') and status >= 400):
+                batch.failed = True
+                break
+    if not batch.failed:
+        return jsonify({'committed': True, 'results': results}), 200
+    status = 500 if results[-1]['status'] >= 500 else 409
+    return jsonify({'committed': False, 'failed_operation': len(results) - 1,
+                    'results': results}), status
+
+
+def run_operation(operation):
+    """
+    Dispatches one operation to its handler inside the batch transaction.
+    :param operation: dict with method, path and optionally body
+    :return: status code and json body of the response
+    """
+    with current_app.test_request_context(operation['path'], method=operation.get('method', 'GET'),
+                                          json=operation.get('body')):
+        try:
+            response = current_app.full_dispatch_request()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.error(f"Batch operation {operation['path']} failed: {e}")  # pylint: disable=logging-fstring-interpolation
+            return 500, {'message': 'Internal Server Error'}
+        return response.status_code, response.get_json(silent=True)
@@ -0,0 +1,223 @@
+"""
+This module keeps Bloom filters over the keys of a table, e.g. the usernames, so a key which
+is definitely not in the table is answered without a query. A filter never misses a key that
+was written through its DAO or committed by another connection: before answering it checks
+PRAGMA data_version, and if another connection wrote, it reads the new keys from the
+changelog. The keys are read through the read pool of the DAO, so a batch transaction which
+owns the writer connection never holds the filter up. Deleted keys stay in the filter and
+only cost a query, like any false positive.
+The false-positive rate and the starting capacity are tunable per filter; a filter which
+holds more keys than its capacity is rebuilt with twice the capacity.
+Every check counts in the metrics as bloom.<name>.skipped, .passed and .false_positives.
+"""
+import hashlib
+import math
+import sqlite3
+import threading
+
+import metrics
+
+BLOOM_FALSE_POSITIVE_RATE = 0.01
+BLOOM_MIN_CAPACITY = 1024
+# Keys one bulk existence check may ask for
+MAX_EXISTENCE_CHECKS = 10000
+
+
+def existence_response(keys, existing):
+    """
+    Splits the keys of a bulk existence check into existing and missing ones.
+    :param keys: list of the checked keys
+    :param existing: set of the existing keys
+    :return: dict with the existing and the missing keys in request order
+    """
+    return {'existing': [key for key in keys if key in existing],
+            'missing': [key for key in keys if key not in existing]}
+
+
+class BloomFilter:
+    """
+    Bit array with the number of hash functions chosen for a capacity and false-positive rate.
+    """
+
+    def __init__(self, capacity, false_positive_rate=BLOOM_FALSE_POSITIVE_RATE):
+        """
+        :param capacity: number of keys the false-positive rate is planned for
+        :param false_positive_rate: share of absent keys which are reported as maybe present
+        """
+        self.capacity = max(1, capacity)
+        self.false_positive_rate = false_positive_rate
+        # m = -n ln p / ln(2)^2 bits and k = m / n ln 2 hashes minimize the false positives
+        bits_per_key = -math.log(false_positive_rate) / math.log(2) ** 2
+        self.size = max(8, math.ceil(self.capacity * bits_per_key))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: the k positions are h1 + i * h2 of one 128 bit digest
+        digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        """
+        Adds a key.
+        :param key: str or int
+        """
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def stats(self):
+        """
+        Returns the size and the expected false-positive rate at the current number of keys.
+        :return: dict
+        """
+        return {
+            'keys': self.count,
+            'capacity': self.capacity,
+            'bits': self.size,
+            'hashes': self.hashes,
+            'bytes': len(self.bits),
+            'target_false_positive_rate': self.false_positive_rate,
+            'expected_false_positive_rate': round(
+                (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes, 6),
+        }
+
+
+class ExistenceFilter:  # pylint: disable=too-many-instance-attributes
+    """
+    Bloom filter over one column of a table of a DAO.
+    """
+
+    def __init__(self, name, readers, table, column,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                 capacity=BLOOM_MIN_CAPACITY, false_positive_rate=BLOOM_FALSE_POSITIVE_RATE):
+        """
+        :param name: name of the filter in the metrics, e.g. "usernames"
+        :param readers: db.ReadOnlyPool of the DAO, its writer tells when others wrote
+        :param table: table of the keys
+        :param column: column of the keys, also the field of the changelog data
+        :param capacity: keys the filter is planned for at least
+        :param false_positive_rate: share of absent keys which still cost a query
+        """
+        self.name = name
+        self.readers = readers
+        self.table = table
+        self.column = column
+        self.min_capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.last_seq = 0
+        self.data_version = None
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        Builds the filter from the table, e.g. at startup or after the table was recreated.
+        """
+        with self.lock:
+            self._rebuild()
+
+    def _data_version(self):
+        # Reads no table, so it neither waits for the transaction owning the writer nor is timed
+        return sqlite3.Connection.execute(self.readers.writer, 'PRAGMA data_version').fetchone()[0]
+
+    def _rebuild(self, capacity=0):
+        self.data_version = self._data_version()
+        try:
+            with self.readers.connection() as conn:
+                # The position in the changelog is read first, keys written meanwhile are read twice
+                self.last_seq = conn.execute(
+                    'SELECT COALESCE(MAX(seq), 0) FROM changelog').fetchone()[0]
+                keys = [row[0] for row in conn.execute(f'SELECT {self.column} FROM {self.table}')]
+        except sqlite3.OperationalError:
+            # No table yet, so no keys
+            self.last_seq, keys = 0, []
+        self.bloom = BloomFilter(max(self.min_capacity, capacity, 2 * len(keys)),
+                                 self.false_positive_rate)
+        for key in keys:
+            self.bloom.add(key)
+        metrics.increment(f'bloom.{self.name}.rebuilds')
+
+    def _catch_up(self):
+        # The changelog is read without the lock, so other checks go on meanwhile
+        with self.lock:
+            data_version = self._data_version()
+            if data_version == self.data_version:
+                return
+            last_seq = self.last_seq
+        try:
+            with self.readers.connection() as conn:
+                rows = conn.execute(
+                    f"SELECT seq, json_extract(data, '$.{self.column}') FROM changelog "
+                    "WHERE table_name = ? AND seq > ? AND operation != 'delete' ORDER BY seq",
+                    (self.table, last_seq)).fetchall()
+        except sqlite3.OperationalError:
+            self.rebuild()
+            return
+        with self.lock:
+            for seq, key in rows:
+                # Rows a concurrent catch-up added already are skipped
+                if seq > self.last_seq:
+                    self._add(key)
+                    self.last_seq = seq
+            self.data_version = data_version
+
+    def _add(self, key):
+        self.bloom.add(key)
+        if self.bloom.count > self.bloom.capacity:
+            self._rebuild(2 * self.bloom.capacity)
+
+    def add(self, key):
+        """
+        Adds a key written through the DAO.
+        :param key: str or int
+        """
+        with self.lock:
+            self._add(key)
+
+    def might_contain(self, key):
+        """
+        Tells whether a key may be in the table.
+        :param key: str or int
+        :return: False if the key is definitely not in the table
+        """
+        return bool(self.candidates((key,)))
+
+    def candidates(self, keys):
+        """
+        Drops the keys which are definitely not in the table.
+        :param keys: iterable of keys
+        :return: list of the keys which may be in the table
+        """
+        self._catch_up()
+        keys = list(keys)
+        with self.lock:
+            candidates = [key for key in keys if key in self.bloom]
+        metrics.increment(f'bloom.{self.name}.skipped', len(keys) - len(candidates))
+        metrics.increment(f'bloom.{self.name}.passed', len(candidates))
+        return candidates
+
+    def record_false_positives(self, count):
+        """
+        Counts keys which passed the filter but were not found.
+        :param count: int
+        """
+        metrics.increment(f'bloom.{self.name}.false_positives', count)
+
+    def stats(self):
+        """
+        Returns the size of the filter and its counters.
+        :return: dict
+        """
+        with self.lock:
+            stats = self.bloom.stats()
+        for counter in ('skipped', 'passed', 'false_positives', 'rebuilds'):
+            stats[counter] = metrics.get(f'bloom.{self.name}.{counter}')
+        return stats
@@ -1,26 +1,51 @@
 """
 Test all Blueprint classes
 """
-# pylint: disable=[line-too-long,redefined-outer-name,duplicate-code]
+# pylint: disable=[line-too-long,redefined-outer-name,duplicate-code,unused-argument]
+import gzip
+import io
+import json
+import os
+import sqlite3
+import tarfile
 import tempfile
+import zlib
+
 import pytest
-from flask import Flask
+from flask import Flask, jsonify
+
+import metrics
+import password_hashing
+import table_versions
+import tracing
 
 from book import Book
-from book_dao import BookDao
+import branches
+from branches import register_branches
+from response_cache import cached_response
+from response_compression import compress_response
+from request_profiler import register_profiling
+from tracing import register_tracing
+import admin_blueprint as admin_module
+import snapshot
+from admin_blueprint import admin_blueprint
+from batch_blueprint import batch_blueprint
 from books_blueprint import book_blueprint
+from changes_blueprint import changes_blueprint
+import health_blueprint as health_module
+from health_blueprint import health_blueprint
 from rent_book import RentedBook
 from rent_book_blueprint import rent_book_blueprint
-from rent_book_dao import RentedBookDao
+from stats_blueprint import stats_blueprint
 from user import User
 from user_blueprint import user_blueprint
-from user_dao import UserDao
 
 
 @pytest.fixture
-def app():
+def app(app_daos):
     """
-    Create a Flask app with all blueprints registered
+    Create a Flask app with all blueprints registered, the blueprints work on the cloned
+    template databases of app_daos
     :return:
     """
     app = Flask(__name__)
@@ -28,57 +53,43 @@ def app():
     app.register_blueprint(user_blueprint)
     app.register_blueprint(book_blueprint)
     app.register_blueprint(rent_book_blueprint)
+    app.register_blueprint(changes_blueprint)
+    app.register_blueprint(admin_blueprint)
+    app.register_blueprint(stats_blueprint)
+    app.register_blueprint(batch_blueprint)
+    app.register_blueprint(health_blueprint)
+    app.after_request(compress_response)
+    register_profiling(app)
+    register_tracing(app)
+    register_branches(app)
     yield app
 
 
 @pytest.fixture
-def user_dao():
+def user_dao(app_daos):
     """
-    Create a UserDao with an in-memory database and initialize the table
+    The UserDao the blueprints use
     :return:
     """
-    # Create UserDao with an in-memory database and initialize the table
-    dao = UserDao(":memory:")
-    dao.create_table()
-    yield dao
-    dao.close()
+    return app_daos.user_dao
 
 
 @pytest.fixture
-def book_dao():
+def book_dao(app_daos):
     """
-    Create a BookDao with an in-memory database and initialize the table
+    The BookDao the blueprints use
     :return:
     """
-    # Create BookDao with an in-memory database and initialize the table
-    dao = BookDao(":memory:")
-    dao.create_table()
-    yield dao
-    dao.close()
+    return app_daos.book_dao
 
 
 @pytest.fixture
-def rented_book_dao():
-    """Create a RentedBookDao with a temporary SQLite database."""
-    with tempfile.NamedTemporaryFile(suffix='.db') as temp_db:
-        db_path = temp_db.name
-
-        # Initialize DAOs with the file-based database path
-        rented_book_dao_user_dao = UserDao(db_path)
-        rented_book_dao_book_dao = BookDao(db_path)
-
-        rented_book_dao_user_dao.create_table()
-        rented_book_dao_book_dao.create_table()
-
-        dao = RentedBookDao(db_path)
-        dao.create_table()
-
-        yield dao  # Provide the DAO for testing
-
-        # Clean up resources by closing DAO connections
-        rented_book_dao_user_dao.close()
-        rented_book_dao_book_dao.close()
-        dao.close()
+def rented_book_dao(app_daos):
+    """
+    The RentedBookDao the blueprints use
+    :return:
+    """
+    return app_daos.rented_book_dao
 
 
 def test_add_user(app):
@@ -102,6 +113,21 @@ def test_get_all_users(app):
         assert response.json == [] or response.json >= []
 
 
+def test_get_all_users_with_fields(app):
+    """
+    Test the get_all_users route with a fields projection
+    """
+    with app.test_client() as client:
+        response = client.get('/users?fields=user_id,username')
+        assert response.status_code == 200
+        assert all(set(user) == {'user_id', 'username'} for user in response.json)
+
+        response = client.get('/users?fields=email')
+        assert response.status_code == 400
+        assert client.get('/users?fields=user_id,password').status_code == 400
+        assert all(set(user) == {'user_id', 'username'} for user in client.get('/users').json)
+
+
 def test_get_user(app, user_dao):
     """
     Test the get_user route
@@ -112,14 +138,13 @@ def test_get_user(app, user_dao):
         assert response.status_code == 404
         assert response.json == {'message': 'User not found'}
 
-        user_dao.add_user(User(1, 'admin', 'admin'))
-        list_of_users = user_dao.get_all_users()
-        user_id = len(list_of_users) + 1
-        client.get('/add_user', json={'user_id': user_id, 'username': 'user', 'password': 'user'})
-        response = client.get(f'/user_by_id/{user_id}')
+        user_dao.add_user(User(None, 'reader', 'reader'))
+        response = client.get(f'/user_by_id/{len(list_of_users) + 1}')
         assert response.status_code == 200
-        print(response.json)
-        assert response.json == {'user_id': 2, 'username': 'user', 'password': 'user'}
+        assert response.json == {'user_id': 3, 'username': 'reader'}
+        password = user_dao.get_one_user(3).password
+        assert password_hashing.is_password_hash(password)
+        assert password_hashing.verify_password('reader', password)
 
 
 def test_get_user_by_username(app):
@@ -135,7 +160,27 @@ def test_get_user_by_username(app):
         client.get('/add_user', json=json_string)
         response = client.get(f'/user_by_username/{json_string["username"]}')
         assert response.status_code == 200
-        assert response.json == json_string
+        assert response.json == {'user_id': 2, 'username': json_string['username']}
+
+
+def test_login(app):
+    """
+    Test the login route and the cache of verified credentials
+    """
+    password_hashing.clear_cache()
+    with app.test_client() as client:
+        client.post('/add_user', json={'user_id': None, 'username': 'login', 'password': 'secret'})
+        response = client.post('/login', json={'username': 'login', 'password': 'secret'})
+        assert response.status_code == 200
+        assert response.json['username'] == 'login'
+        hits = metrics.get('password_cache.hits')
+        assert client.post('/login', json={'username': 'login', 'password': 'secret'}).status_code == 200
+        assert metrics.get('password_cache.hits') == hits + 1
+        assert client.post('/login', json={'username': 'login', 'password': 'wrong'}).status_code == 401
+        assert client.post('/login', json={'username': 'nobody', 'password': 'secret'}).status_code == 401
+        assert client.post('/login', json={'username': 'login'}).status_code == 400
+        # Seeded users were stored before passwords were hashed
+        assert client.post('/login', json={'username': 'admin', 'password': 'admin'}).status_code == 200
 
 
 def test_update_user(app, user_dao):
@@ -155,13 +200,30 @@ def test_add_book(app):
     Test the add_book route
     """
     with app.test_client() as client:
-        book = Book(1, '123', 'Test Book', 'Author')
+        book = Book(3, '123', 'Test Book', 'Author')
         json_string = book.__dict__
         response = client.post('/add_book', json=json_string)
         assert response.status_code == 201
         assert response.json == {'message': 'Book created'}
 
 
+def test_add_book_conflict(app):
+    """
+    Test that the add_book route answers 409 for an existing book and update_book 404 for a missing one
+    """
+    with app.test_client() as client:
+        json_string = {'id': 4242, 'isbn': '4242', 'title': 'Conflict Book', 'author': 'Author'}
+        assert client.post('/add_book', json=json_string).status_code == 201
+        response = client.post('/add_book', json=json_string)
+        assert response.status_code == 409
+        assert response.json == {'message': 'Book already exists'}
+        assert client.delete('/deleteBook/4242').status_code == 200
+
+        response = client.put('/updateBook', json=json_string)
+        assert response.status_code == 404
+        assert response.json == {'message': 'Book not found'}
+
+
 def test_get_all_books(app):
     """
     Test the get_all_books route
@@ -172,6 +234,20 @@ def test_get_all_books(app):
         assert response.json == [] or response.json >= []
 
 
+def test_get_all_books_with_fields(app):
+    """
+    Test the get_all_books route with a fields projection
+    """
+    with app.test_client() as client:
+        response = client.get('/books?fields=id,title')
+        assert response.status_code == 200
+        assert all(set(book) == {'id', 'title'} for book in response.json)
+
+        response = client.get('/books?fields=id,price')
+        assert response.status_code == 400
+        assert response.json == {'message': 'Unknown fields: price'}
+
+
 def test_get_processed_books(app):
     """
     Test the get_processed_books route
@@ -198,10 +274,10 @@ def test_get_book_by_isbn(app, book_dao):
         assert response.status_code == 404
         assert response.json == {'message': 'Book not found'}
 
-        book_dao.add_book(Book(1, '123', 'Test Book', 'Author'))
-        response = client.get('/books/1')
+        book_dao.add_book(Book(3, '123', 'Test Book', 'Author'))
+        response = client.get('/books/3')
         assert response.status_code == 200
-        assert response.json == {'id': 1, 'isbn': '123', 'title': 'Test Book', 'author': 'Author'}
+        assert response.json == {'id': 3, 'isbn': '123', 'title': 'Test Book', 'author': 'Author'}
 
 
 def test_update_book(app, book_dao):
@@ -224,12 +300,16 @@ def test_add_rented_book(app):
     """
     with app.test_client() as client:
         user = User(1, 'admin', 'admin')
-        book = Book(1, '123', 'Test Book', 'Author')
+        book = Book(2, '5678', 'Book2', 'Author2')
         rented_book = RentedBook(1, user, book, True)
         json_string = rented_book.__dict__
         response = client.post('/create_rent', json=json_string)
         assert response.status_code == 201
         assert response.json == {'message': 'Rent created'}
+        # The seeded rental 1 has book 1 out
+        rented_book = RentedBook(1, user, Book(1, '1234', 'Book1', 'Author1'), True)
+        response = client.post('/create_rent', json=rented_book.__dict__)
+        assert response.status_code == 409
 
 
 def test_get_rented_books_count_by_user(app, rented_book_dao):
@@ -240,9 +320,7 @@ def test_get_rented_books_count_by_user(app, rented_book_dao):
         user = User(1, 'admin', 'admin')
         book = Book(1, '123', 'Test Book', 'Author')
 
-        # Add rented books for user 1
-        rented_book_dao.add_rented_book(RentedBook(1, user, book, True))
-        rented_book_dao.add_rented_book(RentedBook(2, user, book, True))
+        # Add a second rented book for user 1, the template has one rent for users 1 and 2
         rented_book_dao.add_rented_book(RentedBook(3, user, book, True))
         response = client.get('/rented_books/count_by_user')
         assert response.status_code == 200
@@ -264,16 +342,14 @@ def test_get_rented_book_by_id(app, rented_book_dao, book_dao):
         assert response.json == {'message': 'Rented book not found'}
 
         user = User(1, 'admin', 'admin')
-        book = Book(1, '123', 'Test Book', 'Author')
-        rented_book = RentedBook(1, user, book, True)
+        book = Book(3, '123', 'Test Book', 'Author')
+        rented_book = RentedBook(3, user, book, True)
         rented_book_dao.add_rented_book(rented_book)
         book_dao.add_book(book)
-        client.post('/add_book', json={'id': 1, 'isbn': '123', 'title': 'Test Book', 'author': 'Author'})
-        response = client.get('/rented_books/1')
+        response = client.get('/rented_books/3')
         assert response.status_code == 200
-        assert response.json == {'id': 1, 'user': {'user_id': 1, 'username': 'admin',
-                                                   'password': 'admin'},
-                                 'book': {'id': 1, 'isbn': '123', 'title': 'Test Book', 'author': 'Author'},
+        assert response.json == {'id': 3, 'user': {'user_id': 1, 'username': 'admin'},
+                                 'book': {'id': 3, 'isbn': '123', 'title': 'Test Book', 'author': 'Author'},
                                  'rented': True}
 
 
@@ -294,7 +370,9 @@ def test_get_rented_books_by_user_id(app, rented_book_dao):
         response = client.get(f'/rented_books_by_user_id/{user.user_id}')
         assert response.status_code == 200
         response_json = response.get_json()
-        assert any(rented_book['user']['user_id'] == user.user_id for rented_book in response_json)
+        assert all(rented_book['user_id'] == user.user_id for rented_book in response_json)
+        response = client.get(f'/rented_books_by_user_id/{user.user_id}?expand=user')
+        assert response.json[0]['user'] == {'user_id': 1, 'username': 'admin'}
 
 
 def test_get_all_rented_books(app):
@@ -304,7 +382,12 @@ def test_get_all_rented_books(app):
     with app.test_client() as client:
         response = client.get('/rented_books')
         assert response.status_code == 200
-        assert response.json == [] or response.json >= []
+        assert response.json == [{'id': 1, 'user_id': 1, 'book_id': 1, 'rented': True},
+                                 {'id': 2, 'user_id': 2, 'book_id': 2, 'rented': False}]
+        response = client.get('/rented_books?expand=user,book')
+        assert response.json[1]['user'] == {'user_id': 2, 'username': 'user'}
+        assert response.json[1]['book'] == {'id': 2, 'isbn': '5678', 'title': 'Book2', 'author': 'Author2'}
+        assert client.get('/rented_books?expand=password').status_code == 400
 
 
 def test_update_rent(app, rented_book_dao):
@@ -410,6 +493,473 @@ def test_delete_book(app, book_dao):
         assert response.json == {'message': 'Book deleted'}
 
 
+def test_get_popular_books(app, rented_book_dao):
+    """
+    Test the popular books route
+    """
+    with app.test_client() as client:
+        rented_book_dao.add_rented_book(RentedBook(None, User(1, 'admin', 'admin'),
+                                                   Book(2, '5678', 'Book2', 'Author2'), True))
+        response = client.get('/books/popular?n=1')
+        assert response.status_code == 200
+        assert response.json == [{'book': {'id': 2, 'isbn': '5678', 'title': 'Book2',
+                                           'author': 'Author2'}, 'rentals': 2}]
+        assert client.get('/books/popular?n=0').status_code == 400
+
+
+def test_get_similar_books(app):
+    """
+    Test that a new rental refreshes the similar books and the batch rebuild agrees
+    """
+    with app.test_client() as client:
+        client.post('/create_rent', json={'id': None, 'user': {'user_id': 1, 'username': 'admin', 'password': 'admin'},
+                                          'book': {'id': 2, 'isbn': '5678', 'title': 'Book2', 'author': 'Author2'},
+                                          'rented': True})
+        expected = [{'book': {'id': 2, 'isbn': '5678', 'title': 'Book2', 'author': 'Author2'}, 'co_rentals': 1}]
+        assert client.get('/books/1/similar').json == expected
+        response = client.post('/books/similar/rebuild')
+        assert response.status_code == 200
+        assert response.json['similar_books'] == 2
+        assert client.get('/books/1/similar').json == expected
+        assert client.get('/books/1/similar?n=0').status_code == 400
+
+
+def test_get_circulation(app):
+    """
+    Test the circulation report of the seeded and the new rentals
+    """
+    with app.test_client() as client:
+        client.post('/create_rent', json={'id': None, 'user': {'user_id': 1, 'username': 'admin', 'password': 'admin'},
+                                          'book': {'id': 2, 'isbn': '5678', 'title': 'Book2', 'author': 'Author2'},
+                                          'rented': True})
+        response = client.get('/stats/circulation?from=2000-01-01&to=2999-12-31&group_by=author')
+        assert response.status_code == 200
+        assert response.json['rows'] == [{'author': 'Author2', 'loans': 2}, {'author': 'Author1', 'loans': 1}]
+        assert response.json['totals'] == {'loans': 3, 'active_users': 2}
+        response = client.get('/stats/circulation')
+        assert response.status_code == 200
+        assert response.json['group_by'] == 'day'
+        assert client.get('/stats/circulation?group_by=user').status_code == 400
+        assert client.get('/stats/circulation?from=yesterday').status_code == 400
+
+
+def test_compaction_keeps_pending_rentals(app):
+    """
+    Test that compacting the rentals changelog rolls up the rentals it would drop first
+    """
+    with app.test_client() as client:
+        rent_id = client.post('/rented_books/check_out', json={'user_id': 1, 'book_id': 2}).json['id']
+        assert client.post(f'/rented_books/{rent_id}/return').status_code == 200
+        last_seq = client.get('/changes?table=rented_books&limit=1000').json['last_seq']
+        response = client.post('/changes/compact', json={'table': 'rented_books', 'up_to': last_seq})
+        assert response.json['removed'] >= 1
+        response = client.get('/stats/circulation?from=2000-01-01&to=2999-12-31')
+        assert response.json['totals']['loans'] == 3
+
+
+def test_check_out_and_return(app):
+    """
+    Test that a book can only be checked out while it is not out and at the read version
+    """
+    with app.test_client() as client:
+        availability = client.get('/books/2/availability').json
+        assert availability['available'] is True
+        stale_version = availability['version']
+        response = client.post('/rented_books/check_out', json={'user_id': 1, 'book_id': 2,
+                                                                'version': stale_version})
+        assert response.status_code == 201
+        rent_id = response.json['id']
+        assert client.post('/rented_books/check_out', json={'user_id': 2, 'book_id': 2}).status_code == 409
+        assert client.get('/books/2/availability').json['rent_id'] == rent_id
+
+        assert client.post(f'/rented_books/{rent_id}/return').status_code == 200
+        assert client.post(f'/rented_books/{rent_id}/return').status_code == 404
+        response = client.post('/rented_books/check_out', json={'user_id': 2, 'book_id': 2,
+                                                                'version': stale_version})
+        assert response.status_code == 409
+        version = client.get('/books/2/availability').json['version']
+        response = client.post('/rented_books/check_out', json={'user_id': 2, 'book_id': 2,
+                                                                'version': version})
+        assert response.status_code == 201
+
+
+def test_update_rent_never_lends_twice(app):
+    """
+    Test that update_rent does not lend a rental again while its book is out with another one
+    """
+    with app.test_client() as client:
+        rent_id = client.post('/rented_books/check_out', json={'user_id': 1, 'book_id': 2}).json['id']
+        assert client.post(f'/rented_books/{rent_id}/return').status_code == 200
+        other_rent_id = client.post('/rented_books/check_out', json={'user_id': 2, 'book_id': 2}).json['id']
+        response = client.put('/update_rent', json={'id': rent_id, 'user': None, 'book': None, 'rented': True})
+        assert response.status_code == 409
+        assert client.get('/books/2/availability').json['rent_id'] == other_rent_id
+        response = client.put('/update_rent', json={'id': 10 ** 9, 'user': None, 'book': None, 'rented': True})
+        assert response.status_code == 404
+
+
+def test_holds(app):
+    """
+    Test that a hold on an available book is served at once and a returned book goes to the next hold
+    """
+    with app.test_client() as client:
+        response = client.post('/books/2/holds', json={'user_id': 1})
+        assert response.status_code == 201
+        assert response.json['status'] == 'assigned'
+        rent_id = response.json['rent_id']
+        assert client.get('/books/2/availability').json['rent_id'] == rent_id
+
+        assert client.post('/books/2/holds', json={'user_id': 2, 'priority': 10}).status_code == 400
+        waiting = client.post('/books/2/holds', json={'user_id': 2}).json
+        assert waiting['status'] == 'waiting'
+        assert waiting['position'] == 1
+        assert client.post('/books/2/holds', json={'user_id': 2}).status_code == 409
+        urgent = client.post('/books/2/holds', json={'user_id': 3, 'priority': 9}).json
+        assert urgent['position'] == 1
+        assert [hold['user_id'] for hold in client.get('/books/2/holds').json] == [3, 2]
+        assert client.get(f'/holds/{waiting["id"]}').json['position'] == 2
+        assert client.delete(f'/holds/{urgent["id"]}').status_code == 200
+        assert client.delete(f'/holds/{urgent["id"]}').status_code == 404
+
+        assert client.post(f'/rented_books/{rent_id}/return').status_code == 200
+        hold = client.get(f'/holds/{waiting["id"]}').json
+        assert hold['status'] == 'assigned'
+        assert client.get('/books/2/availability').json['rent_id'] == hold['rent_id']
+        assert client.get('/books/2/holds').json == []
+        assert client.get('/holds/999').status_code == 404
+
+
+def test_existence_checks(app):
+    """
+    Test the bulk existence checks of usernames, book ids and isbns and their filter statistics
+    """
+    with app.test_client() as client:
+        response = client.post('/users/exists', json={'usernames': ['admin', 'nobody']})
+        assert response.status_code == 200
+        assert response.json == {'existing': ['admin'], 'missing': ['nobody']}
+        assert client.post('/users/exists', json={'usernames': 'admin'}).status_code == 400
+
+        response = client.post('/books/exists', json={'ids': [1, 99], 'isbns': ['1234', '000']})
+        assert response.json['ids'] == {'existing': [1], 'missing': [99]}
+        assert response.json['isbns'] == {'existing': ['1234'], 'missing': ['000']}
+
+        bloom_filters = client.get('/health').json['caches']['bloom_filters']
+        assert set(bloom_filters) == {'books.book_ids', 'books.isbns', 'users.usernames'}
+        assert bloom_filters['users.usernames']['keys'] >= 1
+
+
+def test_batch(app):
+    """
+    Test that a batch sees its own writes, commits them together and rolls back atomically
+    """
+    with app.test_client() as client:
+        response = client.post('/batch', json={'operations': [
+            {'method': 'POST', 'path': '/add_book',
+             'body': {'id': 3, 'isbn': '9999', 'title': 'Book3', 'author': 'Author3'}},
+            {'method': 'GET', 'path': '/books/3'},
+            {'method': 'POST', 'path': '/rented_books/check_out', 'body': {'user_id': 2, 'book_id': 3}},
+            {'method': 'GET', 'path': '/user_by_id/42'},
+        ]})
+        assert response.status_code == 200
+        assert response.json['committed'] is True
+        assert [result['status'] for result in response.json['results']] == [201, 200, 201, 404]
+        assert response.json['results'][1]['body']['title'] == 'Book3'
+        assert client.get('/books/3').status_code == 200
+        assert client.get('/books/3/availability').json['available'] is False
+
+        response = client.post('/batch', json={'atomic': True, 'operations': [
+            {'method': 'POST', 'path': '/add_book',
+             'body': {'id': 4, 'isbn': '4444', 'title': 'Book4', 'author': 'Author4'}},
+            {'method': 'POST', 'path': '/rented_books/check_out', 'body': {'user_id': 2, 'book_id': 1}},
+            {'method': 'GET', 'path': '/books/4'},
+        ]})
+        assert response.status_code == 409
+        assert response.json['committed'] is False
+        assert [result['status'] for result in response.json['results']] == [201, 409]
+        assert response.json['failed_operation'] == 1
+        assert client.get('/books/4').status_code == 404
+
+        # A hold on a book which is out waits, and trying to serve it does not fail the batch
+        response = client.post('/batch', json={'atomic': True, 'operations': [
+            {'method': 'POST', 'path': '/add_book',
+             'body': {'id': 5, 'isbn': '5555', 'title': 'Book5', 'author': 'Author5'}},
+            {'method': 'POST', 'path': '/books/1/holds', 'body': {'user_id': 2}},
+        ]})
+        assert response.json['committed'] is True
+        assert [result['status'] for result in response.json['results']] == [201, 201]
+        assert response.json['results'][1]['body']['status'] == 'waiting'
+        assert client.get('/books/5').status_code == 200
+        assert client.post('/batch', json={'operations': []}).status_code == 400
+        assert client.post('/batch', json={'operations': [{'path': '/batch'}]}).status_code == 400
+
+
+def test_batch_stops_at_swallowed_rollback(app, book_dao):
+    """
+    Test that a batch stops at an operation which rolled back its writes but answered a success
+    """
+    def swallowed_error():
+        book_dao.conn.rollback()
+        return jsonify({'message': 'Done'}), 200
+
+    app.add_url_rule('/swallowed_error', view_func=swallowed_error, methods=['POST'])
+    with app.test_client() as client:
+        response = client.post('/batch', json={'operations': [
+            {'method': 'POST', 'path': '/add_book',
+             'body': {'id': 6, 'isbn': '6666', 'title': 'Book6', 'author': 'Author6'}},
+            {'method': 'POST', 'path': '/swallowed_error'},
+            {'method': 'POST', 'path': '/add_book',
+             'body': {'id': 7, 'isbn': '7777', 'title': 'Book7', 'author': 'Author7'}},
+        ]})
+        assert response.status_code == 409
+        assert response.json['committed'] is False
+        assert response.json['failed_operation'] == 1
+        assert [result['status'] for result in response.json['results']] == [201, 200]
+        assert client.get('/books/6').status_code == 404
+
+
+def test_health_and_ready(app, book_dao, monkeypatch):
+    """
+    Test the connection statistics of /health and that /ready fails on a broken connection
+    """
+    with app.test_client() as client:
+        response = client.get('/ready')
+        assert response.status_code == 200
+        assert response.json == {'ready': True, 'in_flight': 1}
+
+        response = client.get('/health')
+        assert response.status_code == 200
+        assert response.json['requests']['in_flight'] == 1
+        books = response.json['connections']['books']
+        assert books['status'] == 'ok'
+        assert books['file'].endswith('books.db')
+        assert books['page_count'] > 0
+        # The cloned pages are still in the WAL until a checkpoint
+        assert books['file_bytes'] + books['wal_bytes'] >= books['page_size'] * books['page_count']
+        assert 'rented_books.user_dao' in response.json['connections']
+        assert 0 <= response.json['caches']['response_cache']['hit_rate'] <= 1
+
+        monkeypatch.setattr(health_module, 'MAX_IN_FLIGHT_REQUESTS', 0)
+        assert client.get('/ready').status_code == 503
+        monkeypatch.setattr(health_module, 'MAX_IN_FLIGHT_REQUESTS', 64)
+
+        book_dao.conn.close()
+        response = client.get('/ready')
+        assert response.status_code == 503
+        assert response.json['reason'].startswith('books: ')
+        response = client.get('/health')
+        assert response.status_code == 503
+        assert response.json['connections']['books']['status'] == 'error'
+
+
+def test_branches(app):
+    """
+    Test that every branch is served from its own databases, by path prefix or header
+    """
+    book = {'id': 1, 'isbn': '1111', 'title': 'North Book', 'author': 'Author'}
+    with app.test_client() as client:
+        assert client.post('/admin/branches', json={'branch': 'north'}).status_code == 201
+        assert client.post('/admin/branches', json={'branch': 'north'}).status_code == 409
+        assert client.post('/admin/branches', json={'branch': '../north'}).status_code == 400
+        assert client.post('/admin/branches', json={'branch': 'south'}).status_code == 201
+
+        assert client.get('/branches/north/books').json == []
+        default_books = client.get('/books').json
+        assert client.post('/branches/north/add_book', json=book).status_code == 201
+        assert client.get('/branches/north/books').json == [book]
+        assert client.get('/books', headers={'X-Branch': 'north'}).json == [book]
+        assert client.get('/books').json == default_books
+        assert client.get('/books', headers={'X-Branch': 'south'}).json == []
+        assert client.get('/branches/west/books').status_code == 404
+
+        client.post('/branches/north/add_user', json={'user_id': None, 'username': 'reader',
+                                                      'password': 'secret'})
+        response = client.post('/branches/north/rented_books/check_out',
+                               json={'user_id': 1, 'book_id': 1})
+        assert response.status_code == 201
+        assert client.get('/branches/north/books/1/availability').json['available'] is False
+        assert client.get('/branches/north/rented_books').json == [
+            {'id': response.json['id'], 'user_id': 1, 'book_id': 1, 'rented': True}]
+        assert len(client.get('/rented_books').json) == 2
+
+        # max_open is 2, a third branch closes the least recently used one
+        assert client.post('/admin/branches', json={'branch': 'east'}).status_code == 201
+        assert client.get('/branches/east/books').status_code == 200
+        assert list(branches.registry.open) == ['north', 'east']
+        assert client.get('/branches/south/books').json == []
+        assert list(branches.registry.open) == ['east', 'south']
+        assert client.get('/branches/north/books').json == [book]
+
+
+def test_get_changes(app):
+    """
+    Test the change feed and its compaction
+    """
+    with app.test_client() as client:
+        since = client.get('/changes?table=books').json['last_seq']
+        response = client.get(f'/changes?table=books&since={since}&limit=1000')
+        since = response.json['last_seq']
+
+        json_string = {'id': 7777, 'isbn': '7777', 'title': 'Feed Book', 'author': 'Author'}
+        client.post('/add_book', json=json_string)
+        client.put('/updateBook', json={**json_string, 'title': 'Feed Book 2'})
+        client.delete('/deleteBook/7777')
+
+        response = client.get(f'/changes?table=books&since={since}')
+        assert response.status_code == 200
+        changes = response.json['changes']
+        assert [change['operation'] for change in changes] == ['insert', 'update', 'delete']
+        assert changes[1]['data'] == {**json_string, 'title': 'Feed Book 2'}
+        assert response.json['last_seq'] == changes[-1]['seq']
+
+        response = client.post('/changes/compact', json={'table': 'books', 'up_to': changes[-1]['seq']})
+        assert response.json['removed'] >= 2
+        response = client.get(f'/changes?table=books&since={since}')
+        assert [change['operation'] for change in response.json['changes']] == ['delete']
+
+        assert client.get('/changes?table=loans').status_code == 400
+
+
+def test_snapshot(app, monkeypatch):
+    """
+    Test the online snapshot and the compressed export
+    """
+    with tempfile.TemporaryDirectory() as snapshot_dir, app.test_client() as client:
+        monkeypatch.setattr(admin_module, 'SNAPSHOT_DIR', snapshot_dir)
+        response = client.post('/admin/snapshot')
+        assert response.status_code == 201
+        assert len(response.json['files']) == 3
+        books_copy = next(file for file in response.json['files']
+                          if os.path.basename(file) == 'books.db')
+        with sqlite3.connect(books_copy) as conn:
+            assert conn.execute('SELECT COUNT(*) FROM books').fetchone()[0] >= 0
+        conn.close()
+
+        response = client.get('/admin/snapshot/export')
+        assert response.status_code == 200
+        with tarfile.open(fileobj=io.BytesIO(response.data), mode='r:gz') as archive:
+            assert sorted(archive.getnames()) == ['books.db', 'rented_books.db', 'user.db']
+
+        # A branch exports its own databases
+        assert client.post('/admin/branches', json={'branch': 'north'}).status_code == 201
+        client.post('/branches/north/add_book',
+                    json={'id': 1, 'isbn': '1111', 'title': 'North Book', 'author': 'Author'})
+        response = client.get('/branches/north/admin/snapshot/export?compress=false')
+        with tarfile.open(fileobj=io.BytesIO(response.data), mode='r') as archive:
+            archive.extract('books.db', snapshot_dir, filter='data')
+        with sqlite3.connect(os.path.join(snapshot_dir, 'books.db')) as conn:
+            assert conn.execute('SELECT title FROM books').fetchall() == [('North Book',)]
+        conn.close()
+
+        # A failed snapshot leaves no work directory behind
+        work_root = os.path.join(snapshot_dir, 'work')
+        os.makedirs(work_root)
+        monkeypatch.setattr(tempfile, 'tempdir', work_root)
+        monkeypatch.setattr(snapshot, 'snapshot_databases', lambda *args: 1 / 0)
+        assert client.get('/admin/snapshot/export').status_code == 500
+        assert not os.listdir(work_root)
+
+
+def test_cached_collection_response(app):
+    """
+    Test that collection responses are served from the cache until a write invalidates them
+    """
+    with app.test_client() as client:
+        first = client.get('/books')
+        hits = metrics.get('response_cache.hits')
+        second = client.get('/books')
+        assert metrics.get('response_cache.hits') == hits + 1
+        assert second.json == first.json
+
+        json_string = {'id': 8888, 'isbn': '8888', 'title': 'Cached Book', 'author': 'Author'}
+        client.post('/add_book', json=json_string)
+        response = client.get('/books')
+        assert metrics.get('response_cache.hits') == hits + 1
+        assert json_string in response.json
+        client.delete('/deleteBook/8888')
+        assert json_string not in client.get('/books').json
+
+
+def test_profiled_request(app, tmp_path):
+    """
+    Test that requests are only profiled when profiling is enabled and asked for
+    """
+    app.config['PROFILE_DIR'] = str(tmp_path / 'profiles')
+    with app.test_client() as client:
+        response = client.get('/books', headers={'X-Profile': '1'})
+        assert 'X-Profile-Summary' not in response.headers
+
+        app.config['PROFILING_ENABLED'] = True
+        assert 'X-Profile-Summary' not in client.get('/books').headers
+        response = client.get('/books/1', headers={'X-Profile': '1'})
+        assert response.status_code == 200
+        assert 'get_book_by_isbn' in response.headers['X-Profile-Summary']
+        assert response.headers['X-Profile-File'].startswith('books_int_isbn-')
+        assert os.listdir(tmp_path / 'profiles') == [response.headers['X-Profile-File']]
+
+
+def test_traced_request(app, tmp_path):
+    """
+    Test that sampled requests are traced into spans per DAO method and SQL statement
+    """
+    app.config['TRACE_FILE'] = str(tmp_path / 'traces.jsonl')
+    tracing.clear()
+    with app.test_client() as client:
+        assert 'X-Trace-Id' not in client.get('/rented_books').headers
+        assert tracing.get_spans() == []
+
+        response = client.get('/rented_books_by_user_id/1?expand=user', headers={'X-Trace': '1'})
+        trace_id = response.headers['X-Trace-Id']
+        spans = tracing.get_spans(trace_id)
+        root = spans[-1]
+        assert root['name'] == 'GET /rented_books_by_user_id/<int:user_id>'
+        assert root['parent_id'] is None
+        assert root['attributes']['status'] == 200
+        names = {span['name'] for span in spans}
+        assert {'RentedBookDao.get_rentals', 'UserDao.get_users_by_ids', 'sql', 'jsonify'} <= names
+        get_rentals = next(span for span in spans if span['name'] == 'RentedBookDao.get_rentals')
+        assert any(span['parent_id'] == get_rentals['span_id'] and span['name'] == 'sql'
+                   for span in spans)
+        with open(tmp_path / 'traces.jsonl', encoding='utf-8') as trace_file:
+            assert [json.loads(line) for line in trace_file] == spans
+
+        response = client.get(f'/admin/traces?trace_id={trace_id}')
+        assert response.status_code == 200
+        summary = {row['name']: row for row in response.json['summary']}
+        assert summary[root['name']]['share'] == 1
+        assert summary['sql']['count'] >= 2
+        assert client.get('/admin/traces?trace_id=missing').status_code == 404
+
+        app.config['TRACE_SAMPLE_RATE'] = 1.0
+        assert 'X-Trace-Id' in client.get('/books').headers
+
+
+def test_compressed_response(app):
+    """
+    Test the negotiated compression and the cache of compressed collection responses
+    """
+    payload = [{'id': i, 'title': 'Compressible Book'} for i in range(100)]
+    app.add_url_rule('/compressible', 'compressible',
+                     cached_response('books')(lambda: jsonify(payload)))
+    with app.test_client() as client:
+        response = client.get('/compressible')
+        assert 'Content-Encoding' not in response.headers
+
+        response = client.get('/compressible', headers={'Accept-Encoding': 'gzip, deflate'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert json.loads(gzip.decompress(response.data)) == payload
+
+        hits = metrics.get('compression.cache_hits')
+        response = client.get('/compressible', headers={'Accept-Encoding': 'deflate'})
+        assert response.headers['Content-Encoding'] == 'deflate'
+        assert json.loads(zlib.decompress(response.data)) == payload
+        response = client.get('/compressible', headers={'Accept-Encoding': 'deflate'})
+        assert metrics.get('compression.cache_hits') == hits + 1
+
+        table_versions.bump('books')
+        client.get('/compressible', headers={'Accept-Encoding': 'deflate'})
+        assert metrics.get('compression.cache_hits') == hits + 1
+
+
 def test_close(book_dao, user_dao, rented_book_dao):
     """
     Close all DAOs to properly close database connections
@@ -2,22 +2,40 @@
 This module contains the BookDao class which is responsible for handling all the database
 operations related to the book entity.
 """
-# pylint: disable=unnecessary-lambda-assignment
-import sqlite3
+import json
+
+from bloom_filter import ExistenceFilter
+from db import connect, data_file, ReadOnlyPool
+from tracing import trace_methods
 from book import Book
+from changelog_dao import create_changelog_triggers
+import table_versions
 
-BOOK_DB_NAME = "books.db"
+BOOK_DB_NAME = data_file("books.db")
+BOOK_COLUMNS = ('id', 'isbn', 'title', 'author')
 
 
+@trace_methods
 class BookDao:
     """
     This class handles all the database operations related to the book entity.
     """
 
-    def __init__(self, db_file=BOOK_DB_NAME):
-        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+    def __init__(self, db_file=BOOK_DB_NAME, create=True):
+        """
+        :param db_file: path of the database file or ":memory:"
+        :param create: create the table, which drops the books of an existing one
+        """
+        self.conn = connect(db_file)
         self.cursor = self.conn.cursor()
-        self.create_table()
+        # GET routes read through their own read-only connections, self.conn only writes
+        self.readers = ReadOnlyPool(db_file, self.conn)
+        # Lookups of ids and isbns which definitely do not exist skip the database
+        self.book_ids = ExistenceFilter('book_ids', self.readers, 'books', 'id')
+        self.isbns = ExistenceFilter('isbns', self.readers, 'books', 'isbn')
+        self.existence_filters = {'book_ids': self.book_ids, 'isbns': self.isbns}
+        if create:
+            self.create_table()
 
     def create_table(self):
         """
@@ -32,61 +50,115 @@ class BookDao:
                 author TEXT
             )
         ''')
+        create_changelog_triggers(self.cursor, 'books', 'id', BOOK_COLUMNS)
         self.conn.commit()
+        for existence_filter in self.existence_filters.values():
+            existence_filter.rebuild()
+        table_versions.bump('books')
 
     def add_book(self, book):
         """
         Adds a book to the database.
         :param book: Book instance
-        :return: True if added, False if book exists
+        :return: True if added, False if a book with the same id or isbn exists
         """
-        try:
-            self.cursor.execute(
-                'INSERT INTO books (id, isbn, title, author) VALUES (?,?, ?, ?)',
-                (book.id, book.isbn, book.title, book.author)
-            )
-            self.conn.commit()
-            return True
-        except sqlite3.IntegrityError:
+        # The conflict clause lets the insert itself decide, no lookup beforehand
+        self.cursor.execute(
+            'INSERT INTO books (id, isbn, title, author) VALUES (?,?, ?, ?) ON CONFLICT DO NOTHING',
+            (book.id, book.isbn, book.title, book.author)
+        )
+        added = self.cursor.rowcount > 0
+        self.conn.commit()
+        if not added:
             print('Book already exists')
             return False
+        self.book_ids.add(book.id)
+        self.isbns.add(book.isbn)
+        table_versions.bump('books')
+        return True
 
         # In book_dao.py
 
         # Existing methods...
 
-    def get_all_books(self, sort_by_author=False, sort_by_title=True):
+    def get_all_books(self, sort_by_author=False, sort_by_title=True, fields=None):
         """
         Retrieves all books from the database and optionally sorts them by author and/or title.
         :param sort_by_author: Sort books by author if True (optional).
         :param sort_by_title: Sort books by title if True (optional).
-        :return: A sorted list of book objects.
-        """
-        # Retrieve all books from the database
-        self.cursor.execute("SELECT id, isbn, title, author FROM books")
-        books = [Book(*row) for row in self.cursor.fetchall()]
-
-        # Define multi-var lambda for sorting
-        sorting_key = lambda book: (
-            book.author if sort_by_author else '',
-            book.title if sort_by_title else ''
-        )
-
-        # Sort the books based on the sorting_key lambda
-        books.sort(key=sorting_key)
-
-        return books
+        :param fields: Tuple of column names to select (optional), see projection.parse_fields.
+        :return: A sorted list of book objects, or a list of dicts if fields is given.
+        """
+        columns = fields or BOOK_COLUMNS
+        # Sort in SQL, the id keeps the order of equal titles/authors stable
+        order_by = [column for column, enabled in (('author', sort_by_author),
+                                                   ('title', sort_by_title)) if enabled]
+        with self.readers.connection() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(columns)} FROM books ORDER BY {', '.join(order_by + ['id'])}"
+            ).fetchall()
+        if fields:
+            return [dict(zip(fields, row)) for row in rows]
+        return [Book(*row) for row in rows]
 
     def get_book_by_id(self, book_id):
         """
-        Returns a book by its isbn.
+        Returns a book by its isbn, without a query if the id definitely does not exist.
         :param book_id: int
         :return: Book instance or None
         """
-        self.cursor.execute('SELECT * FROM books WHERE id = ?', (book_id,))
-        row = self.cursor.fetchone()
+        if not self.book_ids.might_contain(book_id):
+            return None
+        with self.readers.connection() as conn:
+            row = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
+        if row is None:
+            self.book_ids.record_false_positives(1)
         return Book(*row) if row else None
 
+    def get_books_by_ids(self, book_ids):
+        """
+        Returns several books with one query, the ids are passed as one json array.
+        :param book_ids: iterable of book ids
+        :return: dict of book id to Book
+        """
+        candidates = self.book_ids.candidates(book_ids)
+        if not candidates:
+            return {}
+        with self.readers.connection() as conn:
+            rows = conn.execute('SELECT * FROM books WHERE id IN (SELECT value FROM json_each(?))',
+                                (json.dumps(candidates),)).fetchall()
+        return {row[0]: Book(*row) for row in rows}
+
+    def get_existing_book_ids(self, book_ids):
+        """
+        Tells which of many book ids exist, e.g. to validate a catalog sync. Only the ids which
+        pass the Bloom filter are looked up, with one query.
+        :param book_ids: iterable of book ids
+        :return: set of the existing ids
+        """
+        return self._get_existing(self.book_ids, 'id', book_ids)
+
+    def get_existing_isbns(self, isbns):
+        """
+        Tells which of many isbns exist, e.g. to validate a catalog sync.
+        :param isbns: iterable of isbns
+        :return: set of the existing isbns
+        """
+        return self._get_existing(self.isbns, 'isbn', isbns)
+
+    def _get_existing(self, existence_filter, column, keys):
+        candidates = existence_filter.candidates(keys)
+        if not candidates:
+            return set()
+        with self.readers.connection() as conn:
+            rows = conn.execute(
+                f'SELECT {column} FROM books WHERE {column} IN (SELECT value FROM json_each(?))',
+                (json.dumps(candidates),)
+            ).fetchall()
+        existing = {row[0] for row in rows}
+        existence_filter.record_false_positives(len(set(candidates)) - len(existing))
+        return existing
+
     def delete_book_by_id(self, book_id):
         """
         Deletes a book by its isbn.
@@ -94,10 +166,12 @@ class BookDao:
         :return: True if deleted, False if not found
         """
         self.cursor.execute('DELETE FROM books WHERE id = ?', (book_id,))
-        if self.cursor.rowcount > 0:
-            self.conn.commit()
-            return True
-        return False
+        deleted = self.cursor.rowcount > 0
+        # Always end the transaction so a miss does not keep the write lock
+        self.conn.commit()
+        if deleted:
+            table_versions.bump('books')
+        return deleted
 
     # book_dao.py
 
@@ -111,15 +185,18 @@ class BookDao:
             'UPDATE books SET title = ?, author = ?, isbn = ? WHERE id = ?',
             (updated_book.title, updated_book.author, updated_book.isbn, updated_book.id)
         )
-        if self.cursor.rowcount > 0:
-            self.conn.commit()
-            return True
-        return False
+        updated = self.cursor.rowcount > 0
+        self.conn.commit()
+        if updated:
+            self.isbns.add(updated_book.isbn)
+            table_versions.bump('books')
+        return updated
 
     def close(self):
         """
         Closes the connection to the database.
         """
+        self.readers.close()
         self.conn.close()
 
     def drop_table(self):
@@ -128,3 +205,4 @@ class BookDao:
         """
         self.cursor.execute('DROP TABLE IF EXISTS books')
         self.conn.commit()
+        table_versions.bump('books')
@@ -5,11 +5,15 @@ from functools import reduce
 
 # pylint: disable=no-else-return,line-too-long,broad-exception-caught
 from flask import Blueprint, jsonify, request
-from book_dao import BookDao, BOOK_DB_NAME
 from book import Book
+from bloom_filter import MAX_EXISTENCE_CHECKS, existence_response
+from branches import BranchLocal
+from projection import parse_fields
+from response_cache import cached_response
+from storage import create_book_dao
 
 book_blueprint = Blueprint('book_blueprint', __name__)
-book_dao = BookDao(BOOK_DB_NAME)
+book_dao = BranchLocal('book_dao', create_book_dao())
 
 
 # Higher-order function for executing an operation and handling responses
@@ -28,8 +32,15 @@ def execute_and_respond(operation):
 
 
 @book_blueprint.route('/books', methods=['GET'])
+@cached_response('books')
 def get_all_books():
-    """This method returns all the books from the database."""
+    """This method returns all the books from the database, optionally narrowed by ?fields=id,title."""
+    try:
+        fields = parse_fields(request.args.get('fields'), Book)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    if fields:
+        return execute_and_respond(lambda: (book_dao.get_all_books(fields=fields), 200))
     return execute_and_respond(lambda: ([book.__dict__ for book in book_dao.get_all_books()], 200))
 
 
@@ -48,27 +59,36 @@ def get_book_by_isbn(isbn):
     return execute_and_respond(operation)
 
 
+@book_blueprint.route('/books/exists', methods=['POST'])
+def get_existing_books():
+    """
+    This method tells which book ids and isbns exist, e.g. {"ids": [1, 2], "isbns": ["123"]},
+    to validate a catalog sync with one call. Keys the Bloom filters rule out cost no query.
+    """
+    data = request.get_json(silent=True) or {}
+    ids, isbns = data.get('ids', []), data.get('isbns', [])
+    if not isinstance(ids, list) or not isinstance(isbns, list) or len(ids) + len(isbns) > MAX_EXISTENCE_CHECKS:
+        return jsonify({'message': f'ids and isbns must be lists of at most {MAX_EXISTENCE_CHECKS} keys'}), 400
+    return jsonify({'ids': existence_response(ids, book_dao.get_existing_book_ids(ids)),
+                    'isbns': existence_response(isbns, book_dao.get_existing_isbns(isbns))}), 200
+
+
 @book_blueprint.route('/add_book', methods=['POST'])
 def add_book():
     """This method adds a book to the database."""
     data = request.get_json()
     new_book = Book(data['id'], data['isbn'], data['title'], data['author'])
-    existing_book = book_dao.get_book_by_id(data['id'])
-    if existing_book:
-        return jsonify({'message': 'Book already exists'}), 409
-    # Ensure the lambda returns a tuple (result, status_code)
+    # The insert decides on its own whether the book already exists
     return execute_and_respond(lambda: ({'message': 'Book created'}, 201) if book_dao.add_book(new_book) else (
-        {'message': 'Book creation failed'}, 500))
+        {'message': 'Book already exists'}, 409))
 
 
 @book_blueprint.route('/deleteBook/<int:isbn>', methods=['DELETE'])
 def delete_book(isbn):
     """This method deletes a book by its ISBN."""
-    if not book_dao.get_book_by_id(isbn):
-        return jsonify({'message': 'Book not found'}), 404
     # Return a tuple (result, status_code) explicitly
     return execute_and_respond(lambda: ({'message': 'Book deleted'}, 200) if book_dao.delete_book_by_id(isbn) else (
-        {'message': 'Deletion failed'}, 500))
+        {'message': 'Book not found'}, 404))
 
 
 @book_blueprint.route('/updateBook', methods=['PUT'])
@@ -76,11 +96,9 @@ def update_book():
     """This method updates a book."""
     data = request.get_json()
     updated_book = Book(data['id'], data['isbn'], data['title'], data['author'])
-    if not book_dao.get_book_by_id(data['id']):
-        return jsonify({'message': 'Book not found'}), 404
     # Return a tuple (result, status_code) explicitly
     return execute_and_respond(lambda: ({'message': 'Book updated'}, 200) if book_dao.update_book(updated_book) else (
-        {'message': 'Update failed'}, 500))
+        {'message': 'Book not found'}, 404))
 
 
 @book_blueprint.route('/processed_books', methods=['GET'])
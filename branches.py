@@ -0,0 +1,298 @@
+"""
+This module serves several library branches from one process. Every branch has its own
+directory of database files below BRANCHES_DIR. A request selects its branch by the path
+prefix /branches/<branch>/... or the header X-Branch; requests without one use the default
+databases of the app.
+The DAOs of the active branches are kept open in a least recently used registry of at most
+MAX_OPEN_BRANCHES branches, idle branches beyond that are closed. The blueprints reach the
+DAOs of the branch of the current request through BranchLocal proxies.
+"""
+import contextvars
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from flask import jsonify, request
+
+import metrics
+import sharded_rent_book_dao
+from book_dao import BookDao, BOOK_DB_NAME
+from changelog_dao import ChangelogDao
+from circulation_dao import CirculationDao, CIRCULATION_DB_NAME
+from db import data_file
+from recommendation_dao import RecommendationDao, RECOMMENDATION_DB_NAME
+from rent_book_dao import RENTED_BOOK_DB_NAME
+from user_dao import UserDao, USER_DB_NAME
+
+BRANCHES_DIR = data_file('branches')
+BRANCH_PREFIX = '/branches/'
+BRANCH_HEADER = 'X-Branch'
+# Every open branch holds 8 writer connections plus the idle connections of its read pools
+MAX_OPEN_BRANCHES = 32
+BRANCH_NAME = re.compile(r'[A-Za-z0-9_-]{1,64}')
+_ENVIRON_KEY = 'branches.name'
+_DAOS_ENVIRON_KEY = 'branches.daos'
+
+_current = contextvars.ContextVar('branch', default=None)
+
+
+class BranchDaos:  # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """
+    The DAOs on the database files of one branch.
+    """
+
+    def __init__(self, name, directory, create=False):
+        """
+        :param name: name of the branch
+        :param directory: directory of its database files
+        :param create: create the tables of a new branch
+        """
+        self.name = name
+        self.users = 0
+
+        def branch_file(db_file):
+            return os.path.join(directory, os.path.basename(db_file))
+
+        self.book_dao = BookDao(branch_file(BOOK_DB_NAME), create=create)
+        self.user_dao = UserDao(branch_file(USER_DB_NAME))
+        self.rent_book_dao = sharded_rent_book_dao.create_rented_book_dao(
+            branch_file(RENTED_BOOK_DB_NAME), user_dao=self.user_dao, book_dao=self.book_dao)
+        if create:
+            self.user_dao.create_table()
+            self.rent_book_dao.create_table()
+        self.changelog_daos = {'books': ChangelogDao(branch_file(BOOK_DB_NAME)),
+                               'users': ChangelogDao(branch_file(USER_DB_NAME)),
+                               'rented_books': ChangelogDao(branch_file(RENTED_BOOK_DB_NAME))}
+        self.recommendation_dao = RecommendationDao(branch_file(RECOMMENDATION_DB_NAME))
+        self.circulation_dao = CirculationDao(branch_file(CIRCULATION_DB_NAME))
+
+    def close(self):
+        """
+        Closes all DAOs of the branch, the rented book DAO closes the user and book DAOs.
+        """
+        for changelog_dao in self.changelog_daos.values():
+            changelog_dao.close()
+        self.recommendation_dao.close()
+        self.circulation_dao.close()
+        self.rent_book_dao.close()
+
+
+class BranchRegistry:
+    """
+    Least recently used registry of the open branches. A branch is leased to a request with
+    acquire and given back with release, only branches without a lease are closed.
+    While more than max_open branches are leased at once, all of them stay open.
+    """
+
+    def __init__(self, directory=BRANCHES_DIR, max_open=MAX_OPEN_BRANCHES):
+        self.directory = directory
+        self.max_open = max_open
+        self.open = OrderedDict()
+        self.lock = threading.Lock()
+
+    def branch_dir(self, name):
+        """
+        Returns the directory of a branch.
+        :param name: name of the branch
+        :return: path
+        :raises ValueError: if the name is not a valid branch name
+        """
+        if not BRANCH_NAME.fullmatch(name or ''):
+            raise ValueError('Branch names consist of 1 to 64 letters, digits, "_" and "-"')
+        return os.path.join(self.directory, name)
+
+    def exists(self, name):
+        """
+        Tells whether a branch exists.
+        :param name: name of the branch
+        :return: bool
+        """
+        try:
+            return os.path.isdir(self.branch_dir(name))
+        except ValueError:
+            return False
+
+    def create(self, name):
+        """
+        Creates a branch with empty tables.
+        :param name: name of the branch
+        :return: True if created, False if it exists
+        :raises ValueError: if the name is not a valid branch name
+        """
+        directory = self.branch_dir(name)
+        try:
+            os.makedirs(directory)
+        except FileExistsError:
+            return False
+        BranchDaos(name, directory, create=True).close()
+        return True
+
+    def acquire(self, name):
+        """
+        Leases the DAOs of a branch, opening them if the branch is not open.
+        :param name: name of the branch
+        :return: BranchDaos
+        :raises KeyError: if the branch does not exist
+        """
+        with self.lock:
+            daos = self.open.get(name)
+            if daos is None:
+                if not self.exists(name):
+                    raise KeyError(name)
+                daos = self.open[name] = BranchDaos(name, self.branch_dir(name))
+                metrics.increment('branches.opened')
+            else:
+                metrics.increment('branches.reused')
+            self.open.move_to_end(name)
+            daos.users += 1
+            evicted = self._evict()
+        for evicted_daos in evicted:
+            evicted_daos.close()
+        return daos
+
+    def release(self, daos):
+        """
+        Gives a lease back, and closes the idle branches beyond max_open.
+        :param daos: BranchDaos from acquire
+        """
+        with self.lock:
+            daos.users -= 1
+            evicted = self._evict()
+        for evicted_daos in evicted:
+            evicted_daos.close()
+
+    def _evict(self):
+        idle = [name for name, daos in self.open.items() if daos.users == 0]
+        evicted = [self.open.pop(name) for name in idle[:max(0, len(self.open) - self.max_open)]]
+        metrics.increment('branches.closed', len(evicted))
+        return evicted
+
+    def get_files(self):
+        """
+        Returns the database files of all branches, e.g. for the maintenance.
+        :return: list of paths
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(os.path.join(self.directory, name, file)
+                      for name in os.listdir(self.directory) if self.exists(name)
+                      for file in os.listdir(os.path.join(self.directory, name))
+                      if file.endswith('.db'))
+
+    def close(self):
+        """
+        Closes all idle branches.
+        """
+        with self.lock:
+            idle = [name for name, daos in self.open.items() if daos.users == 0]
+            evicted = [self.open.pop(name) for name in idle]
+        for daos in evicted:
+            daos.close()
+
+
+registry = BranchRegistry()
+
+
+class BranchLocal:
+    """
+    Proxy for a DAO of the blueprints, which forwards to the DAO of the branch of the current
+    request, or to the default DAO outside of a branch.
+    """
+
+    def __init__(self, attribute, default):
+        """
+        :param attribute: name of the DAO on BranchDaos, e.g. "book_dao"
+        :param default: DAO on the default databases
+        """
+        self._attribute = attribute
+        self._default = default
+
+    def _target(self):
+        daos = _current.get()
+        return self._default if daos is None else getattr(daos, self._attribute)
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+    def __contains__(self, key):
+        return key in self._target()
+
+    def __iter__(self):
+        return iter(self._target())
+
+    def __len__(self):
+        return len(self._target())
+
+
+def current_branch():
+    """
+    Returns the branch of the current request.
+    :return: name, or None for the default databases
+    """
+    daos = _current.get()
+    return daos.name if daos else None
+
+
+class BranchMiddleware:  # pylint: disable=too-few-public-methods
+    """
+    WSGI middleware which moves the prefix /branches/<branch> from the path to the script
+    root, so the routes of the app match, and remembers the branch in the environ.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith(BRANCH_PREFIX):
+            name, _, rest = path[len(BRANCH_PREFIX):].partition('/')
+            environ[_ENVIRON_KEY] = name
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + BRANCH_PREFIX + name
+            environ['PATH_INFO'] = '/' + rest
+        return self.wsgi_app(environ, start_response)
+
+
+def register_branches(app):
+    """
+    Registers the branch selection on an app.
+    :param app: flask app
+    """
+    app.wsgi_app = BranchMiddleware(app.wsgi_app)
+    app.before_request(enter_branch)
+    app.teardown_request(leave_branch)
+
+
+def enter_branch():
+    """
+    before_request hook, leases the branch of the request. The operations of a batch have
+    neither prefix nor header and stay in the branch of the batch.
+    :return: 404 response if the branch does not exist
+    """
+    name = request.environ.get(_ENVIRON_KEY) or request.headers.get(BRANCH_HEADER)
+    if not name:
+        return None
+    try:
+        daos = registry.acquire(name)
+    except KeyError:
+        return jsonify({'message': 'Branch not found'}), 404
+    request.environ[_DAOS_ENVIRON_KEY] = (daos, _current.set(daos))
+    return None
+
+
+def leave_branch(_exception):
+    """
+    teardown_request hook, gives the branch of the request back.
+    """
+    lease = request.environ.pop(_DAOS_ENVIRON_KEY, None)
+    if lease is None:
+        return
+    daos, token = lease
+    try:
+        _current.reset(token)
+    except ValueError:
+        _current.set(None)
+    registry.release(daos)
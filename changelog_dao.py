@@ -0,0 +1,129 @@
+"""
+This module contains the data access object for the change feed.
+Every database file has its own changelog table which is filled by triggers on the
+entity table, so each write is recorded in the same transaction as the write itself.
+"""
+import json
+
+from db import connect, ReadOnlyPool
+from tracing import trace_methods
+
+CHANGELOG_SCHEMA = ('''
+    CREATE TABLE IF NOT EXISTS changelog (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        operation TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        data TEXT,
+        changed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+''', 'CREATE INDEX IF NOT EXISTS changelog_table_seq ON changelog (table_name, seq)')
+
+
+def create_changelog(cursor):
+    """
+    Creates the changelog table and its index if they do not exist.
+    :param cursor: cursor of the database
+    """
+    for statement in CHANGELOG_SCHEMA:
+        cursor.execute(statement)
+
+
+def create_changelog_triggers(cursor, table, key_column, columns):
+    """
+    Creates the changelog table and the insert, update and delete triggers for a table.
+    :param cursor: cursor of the database the table lives in
+    :param table: name of the table
+    :param key_column: primary key column of the table
+    :param columns: columns which are written to the changelog as json
+    """
+    create_changelog(cursor)
+    data = "json_object(" + ", ".join(f"'{column}', NEW.{column}" for column in columns) + ")"
+    for operation, event, key, payload in (('insert', 'INSERT', 'NEW', data),
+                                           ('update', 'UPDATE', 'NEW', data),
+                                           ('delete', 'DELETE', 'OLD', 'NULL')):
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_changelog_{operation} AFTER {event} ON {table}
+            BEGIN
+                INSERT INTO changelog (table_name, operation, row_id, data)
+                VALUES ('{table}', '{operation}', {key}.{key_column}, {payload});
+            END
+        ''')
+
+
+@trace_methods
+class ChangelogDao:
+    """
+    This class reads and compacts the changelog of one database file.
+    """
+
+    def __init__(self, db_file):
+        self.conn = connect(db_file)
+        self.cursor = self.conn.cursor()
+        create_changelog(self.cursor)
+        self.conn.commit()
+        self.readers = ReadOnlyPool(db_file, self.conn)
+
+    def get_changes(self, table, since=0, limit=100):
+        """
+        Returns the changes of a table after a sequence number, oldest first.
+        :param table: name of the table
+        :param since: only changes with a greater sequence number are returned
+        :param limit: maximum number of changes
+        :return: list of dicts with seq, operation, row_id, data and changed_at
+        """
+        with self.readers.connection() as conn:
+            rows = conn.execute(
+                'SELECT seq, operation, row_id, data, changed_at FROM changelog '
+                'WHERE table_name = ? AND seq > ? ORDER BY seq LIMIT ?',
+                (table, since, limit)
+            ).fetchall()
+        return [
+            {'seq': row[0], 'operation': row[1], 'row_id': row[2],
+             'data': json.loads(row[3]) if row[3] else None, 'changed_at': row[4]}
+            for row in rows
+        ]
+
+    def get_inserted_columns(self, table, columns, since=0, limit=10000):
+        """
+        Returns the inserts of a table after a sequence number as columns instead of rows,
+        with the given fields extracted from the json data by SQLite.
+        :param table: name of the table
+        :param columns: names of the fields to extract
+        :param since: only changes with a greater sequence number are returned
+        :param limit: maximum number of changes
+        :return: tuple of the seq column, the day (YYYY-MM-DD) column and one column per field
+        """
+        extracted = ''.join(f", json_extract(data, '$.{column}')" for column in columns)
+        with self.readers.connection() as conn:
+            rows = conn.execute(
+                f'SELECT seq, substr(changed_at, 1, 10){extracted} FROM changelog '
+                "WHERE table_name = ? AND operation = 'insert' AND seq > ? ORDER BY seq LIMIT ?",
+                (table, since, limit)
+            ).fetchall()
+        return tuple(zip(*rows)) if rows else ((),) * (len(columns) + 2)
+
+    def compact(self, table, up_to):
+        """
+        Removes all changes up to a sequence number which are superseded by a later
+        change of the same row, so only the latest state of every row is kept.
+        :param table: name of the table
+        :param up_to: highest sequence number which may be removed
+        :return: number of removed changes
+        """
+        self.cursor.execute('''
+            DELETE FROM changelog
+            WHERE table_name = ? AND seq <= ? AND seq NOT IN (
+                SELECT MAX(seq) FROM changelog WHERE table_name = ? GROUP BY row_id
+            )
+        ''', (table, up_to, table))
+        removed = self.cursor.rowcount
+        self.conn.commit()
+        return removed
+
+    def close(self):
+        """
+        Closes the connection to the database.
+        """
+        self.readers.close()
+        self.conn.close()
@@ -0,0 +1,70 @@
+"""
+Blueprint for the incremental change feed of books, users and rentals.
+"""
+from flask import Blueprint, jsonify, request
+
+from book_dao import BOOK_DB_NAME
+from branches import BranchLocal
+from changelog_dao import ChangelogDao
+from rent_book_dao import RENTED_BOOK_DB_NAME
+from user_dao import USER_DB_NAME
+
+changes_blueprint = Blueprint('changes_blueprint', __name__)
+# Every table lives in its own database file, so every table has its own sequence
+changelog_daos = BranchLocal('changelog_daos', {
+    'books': ChangelogDao(BOOK_DB_NAME),
+    'users': ChangelogDao(USER_DB_NAME),
+    'rented_books': ChangelogDao(RENTED_BOOK_DB_NAME),
+})
+MAX_CHANGES_LIMIT = 1000
+# table -> callable which returns the highest sequence number a consumer of the changelog
+# allows to compact, see register_compaction_limit
+compaction_limits = {}
+
+
+def register_compaction_limit(table, limit):
+    """
+    Registers a consumer of the changelog of a table, which still needs the superseded
+    changes after the sequence number limit() returns.
+    :param table: name of the table
+    :param limit: callable which returns a sequence number
+    """
+    compaction_limits[table] = limit
+
+
+@changes_blueprint.route('/changes', methods=['GET'])
+def get_changes():
+    """
+    This method returns the inserts, updates and deletes of a table in order.
+    Query parameters: table (books, users or rented_books), since (sequence number) and limit.
+    :return: changes and the sequence number to continue from
+    """
+    table = request.args.get('table')
+    if table not in changelog_daos:
+        return jsonify({'message': f"table must be one of {', '.join(changelog_daos)}"}), 400
+    since = request.args.get('since', 0, type=int)
+    limit = min(request.args.get('limit', 100, type=int), MAX_CHANGES_LIMIT)
+    changes = changelog_daos[table].get_changes(table, since, limit)
+    return jsonify({
+        'table': table,
+        'changes': changes,
+        'last_seq': changes[-1]['seq'] if changes else since
+    }), 200
+
+
+@changes_blueprint.route('/changes/compact', methods=['POST'])
+def compact_changes():
+    """
+    This method removes changes up to a sequence number which are superseded by a later
+    change of the same row, at most up to the limits of the registered consumers.
+    :return message:
+    """
+    data = request.get_json()
+    table = data.get('table')
+    if table not in changelog_daos:
+        return jsonify({'message': f"table must be one of {', '.join(changelog_daos)}"}), 400
+    up_to = int(data['up_to'])
+    if table in compaction_limits:
+        up_to = min(up_to, compaction_limits[table]())
+    removed = changelog_daos[table].compact(table, up_to)
+    return jsonify({'message': 'Changes compacted', 'removed': removed, 'up_to': up_to}), 200
@@ -0,0 +1,83 @@
+"""
+Contention benchmark of RentedBookDao.check_out and return_book.
+Every client is a thread with its own RentedBookDao, so its own writer connection, like
+the desks of several server processes. All clients check out random books of a small
+catalogue and return them right away, for a fixed time per number of clients.
+
+    python checkout_benchmark.py --clients 1 2 4 8 16 --books 20 --seconds 3
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+import metrics
+from book_dao import BookDao
+from rent_book_dao import RentedBookDao
+from user_dao import UserDao
+
+
+def run_clients(db_file, client_count, book_count, seconds):
+    """
+    Runs the clients against one database file.
+    :return: dict with check_outs, conflicts, returns, busy and busy_retries
+    """
+    daos = [RentedBookDao(db_file, user_dao=UserDao(':memory:'), book_dao=BookDao(':memory:'))
+            for _ in range(client_count)]
+    daos[0].create_table()
+    counts = {'check_outs': 0, 'conflicts': 0, 'returns': 0, 'busy': 0}
+    lock = threading.Lock()
+    retries_before = metrics.get('sql.busy_retries')
+    deadline = time.perf_counter() + seconds
+
+    def client(user_id):
+        dao, local = daos[user_id], dict.fromkeys(counts, 0)
+        while time.perf_counter() < deadline:
+            try:
+                rent_id = dao.check_out(user_id, random.randrange(book_count))
+                if rent_id is None:
+                    local['conflicts'] += 1
+                    continue
+                local['check_outs'] += 1
+                local['returns'] += dao.return_book(rent_id)
+            except sqlite3.OperationalError:
+                local['busy'] += 1
+        with lock:
+            for key, value in local.items():
+                counts[key] += value
+
+    threads = [threading.Thread(target=client, args=(user_id,)) for user_id in range(client_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for dao in daos:
+        dao.close()
+    counts['busy_retries'] = metrics.get('sql.busy_retries') - retries_before
+    return counts
+
+
+def main():
+    """
+    Runs the benchmark for every number of clients and prints one line per run.
+    """
+    parser = argparse.ArgumentParser(description='Check-out throughput by number of clients.')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--books', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=3)
+    args = parser.parse_args()
+    print('clients  check-outs/s  conflicts/s  busy  busy_retries')
+    for client_count in args.clients:
+        with tempfile.TemporaryDirectory() as directory:
+            counts = run_clients(os.path.join(directory, 'rented_books.db'), client_count,
+                                 args.books, args.seconds)
+        print(f"{client_count:7d}  {counts['check_outs'] / args.seconds:12.0f}  "
+              f"{counts['conflicts'] / args.seconds:11.0f}  {counts['busy']:4d}  "
+              f"{counts['busy_retries']:12d}")
+
+
+if __name__ == '__main__':
+    main()
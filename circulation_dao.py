@@ -0,0 +1,152 @@
+"""
+This module contains the data access object for the circulation statistics.
+New rentals are read from the changelog of rented_books in columnar batches, aggregated
+per day with vectorized NumPy operations and folded into daily rollup tables, so reports
+only read the rollups of the requested days however long the rental history is.
+"""
+import threading
+
+import numpy as np
+
+from db import connect, data_file, ReadOnlyPool
+from tracing import trace_methods
+
+CIRCULATION_DB_NAME = data_file('circulation.db')
+ROLLUP_BATCH_SIZE = 10000
+UNKNOWN_AUTHOR = 'unknown'
+
+CIRCULATION_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS daily_loans ('
+    'day TEXT PRIMARY KEY, loans INTEGER NOT NULL, active_users INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS daily_author_loans ('
+    'day TEXT NOT NULL, author TEXT NOT NULL, loans INTEGER NOT NULL, '
+    'PRIMARY KEY (day, author)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS daily_active_users ('
+    'day TEXT NOT NULL, user_id INTEGER NOT NULL, PRIMARY KEY (day, user_id)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS rollup_state (source TEXT PRIMARY KEY, last_seq INTEGER NOT NULL)',
+)
+GROUP_BY = ('day', 'author')
+
+
+@trace_methods
+class CirculationDao:
+    """
+    This class folds rental events into the daily rollups and reads them.
+    """
+
+    def __init__(self, db_file=CIRCULATION_DB_NAME):
+        self.conn = connect(db_file)
+        self.cursor = self.conn.cursor()
+        for statement in CIRCULATION_SCHEMA:
+            self.cursor.execute(statement)
+        self.conn.commit()
+        self.readers = ReadOnlyPool(db_file, self.conn)
+        self.lock = threading.Lock()
+
+    def get_last_seq(self, source='rented_books'):
+        """
+        Returns the changelog sequence number up to which the rentals are rolled up.
+        The changelog of rented_books must not be compacted beyond it, a compaction drops
+        the inserts of rentals which were updated later; /changes/compact clamps to it.
+        :param source: name of the changelog table
+        :return: int
+        """
+        row = self.conn.execute('SELECT last_seq FROM rollup_state WHERE source = ?',
+                                (source,)).fetchone()
+        return row[0] if row else 0
+
+    def roll_up(self, changelog_dao, book_dao, batch_size=ROLLUP_BATCH_SIZE):
+        """
+        Folds all rentals added since the last roll up into the daily rollups. Every batch
+        is written in one transaction together with its sequence number, so a rental is
+        counted exactly once. Authors are looked up when the rental is rolled up.
+        :param changelog_dao: ChangelogDao of the rented_books database
+        :param book_dao: DAO to look up the authors of the rented books
+        :param batch_size: number of rentals per batch
+        :return: number of rolled up rentals
+        """
+        rolled_up = 0
+        with self.lock:
+            while True:
+                seqs, days, user_ids, book_ids = changelog_dao.get_inserted_columns(
+                    'rented_books', ('user_id', 'book_id'), self.get_last_seq(), batch_size)
+                if not seqs:
+                    return rolled_up
+                self._fold_batch(np.asarray(days), np.asarray(user_ids, dtype=np.int64),
+                                 np.asarray(book_ids, dtype=np.int64), book_dao)
+                self.cursor.execute(
+                    'INSERT INTO rollup_state (source, last_seq) VALUES (?, ?) '
+                    'ON CONFLICT (source) DO UPDATE SET last_seq = excluded.last_seq',
+                    ('rented_books', seqs[-1]))
+                self.conn.commit()
+                rolled_up += len(seqs)
+
+    def _fold_batch(self, days, user_ids, book_ids, book_dao):  # pylint: disable=too-many-locals
+        day_keys, day_index = np.unique(days, return_inverse=True)
+        day_loans = np.bincount(day_index, minlength=len(day_keys))
+
+        book_keys, book_index = np.unique(book_ids, return_inverse=True)
+        books_by_id = book_dao.get_books_by_ids(book_keys.tolist())
+        books = (books_by_id.get(book_id) for book_id in book_keys.tolist())
+        author_keys, author_of_book = np.unique(
+            np.array([book.author if book and book.author else UNKNOWN_AUTHOR for book in books]),
+            return_inverse=True)
+        day_authors, author_loans = np.unique(
+            day_index * len(author_keys) + author_of_book[book_index], return_counts=True)
+
+        user_keys, user_index = np.unique(user_ids, return_inverse=True)
+        day_users = np.unique(day_index * len(user_keys) + user_index)
+
+        self.cursor.executemany(
+            'INSERT INTO daily_loans (day, loans, active_users) VALUES (?, ?, 0) '
+            'ON CONFLICT (day) DO UPDATE SET loans = loans + excluded.loans',
+            zip(day_keys.tolist(), day_loans.tolist()))
+        self.cursor.executemany(
+            'INSERT INTO daily_author_loans (day, author, loans) VALUES (?, ?, ?) '
+            'ON CONFLICT (day, author) DO UPDATE SET loans = loans + excluded.loans',
+            zip(day_keys[day_authors // len(author_keys)].tolist(),
+                author_keys[day_authors % len(author_keys)].tolist(), author_loans.tolist()))
+        self.cursor.executemany(
+            'INSERT OR IGNORE INTO daily_active_users (day, user_id) VALUES (?, ?)',
+            zip(day_keys[day_users // len(user_keys)].tolist(),
+                user_keys[day_users % len(user_keys)].tolist()))
+        self.cursor.executemany(
+            'UPDATE daily_loans SET active_users = '
+            '(SELECT COUNT(*) FROM daily_active_users WHERE day = ?) WHERE day = ?',
+            ((day, day) for day in day_keys.tolist()))
+
+    def get_circulation(self, from_day, to_day, group_by='day'):
+        """
+        Returns the loans between two days (both included) from the rollups.
+        :param from_day: first day, YYYY-MM-DD
+        :param to_day: last day, YYYY-MM-DD
+        :param group_by: 'day' for loans and active users per day, 'author' for loans per author
+        :return: dict with the rows of the grouping and the totals of the whole range
+        """
+        if group_by not in GROUP_BY:
+            raise ValueError(f"group_by must be one of {', '.join(GROUP_BY)}")
+        with self.readers.connection() as conn:
+            if group_by == 'day':
+                rows = [{'day': day, 'loans': loans, 'active_users': active_users}
+                        for day, loans, active_users in conn.execute(
+                            'SELECT day, loans, active_users FROM daily_loans '
+                            'WHERE day BETWEEN ? AND ? ORDER BY day', (from_day, to_day))]
+            else:
+                rows = [{'author': author, 'loans': loans}
+                        for author, loans in conn.execute(
+                            'SELECT author, SUM(loans) FROM daily_author_loans '
+                            'WHERE day BETWEEN ? AND ? GROUP BY author ORDER BY 2 DESC, author',
+                            (from_day, to_day))]
+            loans = conn.execute('SELECT COALESCE(SUM(loans), 0) FROM daily_loans '
+                                 'WHERE day BETWEEN ? AND ?', (from_day, to_day)).fetchone()[0]
+            active_users = conn.execute('SELECT COUNT(DISTINCT user_id) FROM daily_active_users '
+                                        'WHERE day BETWEEN ? AND ?',
+                                        (from_day, to_day)).fetchone()[0]
+        return {'rows': rows, 'totals': {'loans': loans, 'active_users': active_users}}
+
+    def close(self):
+        """
+        Closes the connection to the database.
+        """
+        self.readers.close()
+        self.conn.close()
@@ -1,12 +1,141 @@
 """
 This file is used to define fixtures that can be used in the tests.
+Every test which needs the app data gets its own copy of one pre-seeded template database,
+so the tests neither share state nor touch books.db, user.db and rented_books.db and can
+run in parallel with pytest-xdist.
 """
-from main import generate_data
+# pylint: disable=redefined-outer-name,import-outside-toplevel,too-many-locals
+import os
+import shutil
+import sqlite3
+import tempfile
+from types import SimpleNamespace
 
+import pytest
 
-def pytest_sessionstart():
+_DATA_DIR = {}
+
+
+def pytest_configure():
+    """
+    The blueprints open their DAOs in LIBRARY_DATA_DIR when they are imported, so every test
+    process (every xdist worker) gets its own scratch directory before the tests are collected.
+    :return:
+    """
+    _DATA_DIR['path'] = tempfile.mkdtemp(prefix='library-tests-')
+    os.environ['LIBRARY_DATA_DIR'] = _DATA_DIR['path']
+
+
+def pytest_unconfigure():
     """
-    This method is called when the session starts.
+    This method is called when the test process ends.
     :return:
     """
-    generate_data()
+    shutil.rmtree(_DATA_DIR['path'], ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def template_dir(tmp_path_factory):
+    """
+    Seeds the template databases once per test process with the data of main.generate_data
+    :return: directory of the template databases
+    """
+    from main import setup_books, setup_users, setup_rented_books
+    from book_dao import BookDao
+    from rent_book_dao import RentedBookDao
+    from user_dao import UserDao
+
+    directory = tmp_path_factory.mktemp('template')
+    rented_book_dao = RentedBookDao(str(directory / 'rented_books.db'),
+                                    user_dao=UserDao(str(directory / 'user.db')),
+                                    book_dao=BookDao(str(directory / 'books.db')))
+    setup_books(BookDao(str(directory / 'books.db')))
+    setup_users(UserDao(str(directory / 'user.db')))
+    setup_rented_books(rented_book_dao)
+    return directory
+
+
+def clone_template(template_file, dao_conn):
+    """
+    Copies a template database into the connection of a DAO with the SQLite backup API.
+    :param template_file: path of the template database
+    :param dao_conn: writer connection of the DAO
+    :return:
+    """
+    template = sqlite3.connect(template_file)
+    try:
+        template.backup(dao_conn)
+    finally:
+        template.close()
+
+
+@pytest.fixture
+def app_daos(tmp_path, template_dir, monkeypatch):
+    """
+    Clones the template databases for one test and injects DAOs on the clones into the
+    blueprints.
+    :return: namespace with book_dao, user_dao, rented_book_dao and the database files
+    """
+    import books_blueprint
+    import branches
+    import changes_blueprint
+    import rent_book_blueprint
+    import snapshot
+    import stats_blueprint
+    import table_versions
+    import user_blueprint
+    from book_dao import BookDao
+    from branches import BranchLocal
+    from changelog_dao import ChangelogDao
+    from circulation_dao import CirculationDao
+    from recommendation_dao import RecommendationDao
+    from rent_book_dao import RentedBookDao
+    from user_dao import UserDao
+
+    files = {name: str(tmp_path / name) for name in ('books.db', 'user.db', 'rented_books.db')}
+    book_dao = BookDao(files['books.db'])
+    user_dao = UserDao(files['user.db'])
+    rented_book_dao = RentedBookDao(files['rented_books.db'],
+                                    user_dao=UserDao(files['user.db']),
+                                    book_dao=BookDao(files['books.db']))
+    for name, conn in (('books.db', book_dao.conn), ('user.db', user_dao.conn),
+                       ('rented_books.db', rented_book_dao.conn)):
+        clone_template(str(template_dir / name), conn)
+    # The clone replaced the content of all tables, so the cached responses are stale, and
+    # the Bloom filters on the cloned connections did not see it as a write of another one
+    for table in ('books', 'users', 'rented_books'):
+        table_versions.bump(table)
+    for dao in (book_dao, user_dao):
+        for existence_filter in dao.existence_filters.values():
+            existence_filter.rebuild()
+
+    monkeypatch.setattr(books_blueprint, 'book_dao', BranchLocal('book_dao', book_dao))
+    monkeypatch.setattr(user_blueprint, 'user_dao', BranchLocal('user_dao', user_dao))
+    monkeypatch.setattr(rent_book_blueprint, 'rent_book_dao',
+                        BranchLocal('rent_book_dao', rented_book_dao))
+    recommendation_dao = RecommendationDao(str(tmp_path / 'recommendations.db'))
+    monkeypatch.setattr(rent_book_blueprint, 'recommendation_dao',
+                        BranchLocal('recommendation_dao', recommendation_dao))
+    monkeypatch.setattr(snapshot, 'DB_FILES', tuple(files.values()))
+    changelog_daos = {'books': ChangelogDao(files['books.db']),
+                      'users': ChangelogDao(files['user.db']),
+                      'rented_books': ChangelogDao(files['rented_books.db'])}
+    monkeypatch.setattr(changes_blueprint, 'changelog_daos',
+                        BranchLocal('changelog_daos', changelog_daos))
+    circulation_dao = CirculationDao(str(tmp_path / 'circulation.db'))
+    monkeypatch.setattr(stats_blueprint, 'circulation_dao',
+                        BranchLocal('circulation_dao', circulation_dao))
+    branch_registry = branches.BranchRegistry(str(tmp_path / 'branches'), max_open=2)
+    monkeypatch.setattr(branches, 'registry', branch_registry)
+
+    yield SimpleNamespace(book_dao=book_dao, user_dao=user_dao,
+                          rented_book_dao=rented_book_dao, files=files)
+
+    branch_registry.close()
+    for changelog_dao in changelog_daos.values():
+        changelog_dao.close()
+    recommendation_dao.close()
+    circulation_dao.close()
+    rented_book_dao.close()
+    user_dao.close()
+    book_dao.close()
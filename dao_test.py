@@ -2,10 +2,31 @@
 Test the DAO classes
 """
 # pylint: disable=redefined-outer-name
+import importlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
+from flask import Flask
 from book_dao import BookDao
 from user_dao import UserDao
 from rent_book_dao import RentedBookDao
+from sharded_rent_book_dao import ShardedRentedBookDao
+import branches
+import db
+import maintenance
+import metrics
+import password_hashing
+import slow_query_log
+import storage
+import tracing
+from db import batch_transaction, connect, retry_on_busy
+from changelog_dao import ChangelogDao
+from circulation_dao import CirculationDao
+from recommendation_dao import RecommendationDao, build_similar_books
+from memory_dao import MemoryStorage, MemoryBookDao, MemoryUserDao, MemoryRentedBookDao
+from waitlist import Waitlist
+from bloom_filter import BloomFilter
 from book import Book
 from user import User
 from rent_book import RentedBook
@@ -96,6 +117,30 @@ def test_get_all_books(book_dao):
     assert books[1].isbn == '222'
 
 
+def test_get_all_books_with_fields(book_dao):
+    """
+    Test selecting only some columns of all books
+    :param book_dao:
+    :return:
+    """
+    book_dao.add_book(Book(id=1, isbn='111', title='Book B', author='Author1'))
+    book_dao.add_book(Book(id=2, isbn='222', title='Book A', author='Author2'))
+    books = book_dao.get_all_books(fields=('id', 'title'))
+    assert books == [{'id': 2, 'title': 'Book A'}, {'id': 1, 'title': 'Book B'}]
+
+
+def test_get_books_by_ids(book_dao):
+    """
+    Test getting several books with one query
+    :param book_dao:
+    :return:
+    """
+    book_dao.add_book(Book(id=1, isbn='111', title='Book B', author='Author1'))
+    book_dao.add_book(Book(id=2, isbn='222', title='Book A', author='Author2'))
+    assert book_dao.get_books_by_ids({2, 3}) == {2: Book(2, '222', 'Book A', 'Author2')}
+    assert book_dao.get_books_by_ids([]) == {}
+
+
 def test_get_book_by_id(book_dao):
     """
     Test getting a book by its id
@@ -123,6 +168,24 @@ def test_delete_book(book_dao):
     assert book_dao.get_book_by_id(1) is None
 
 
+def test_book_reads_use_read_only_connections(tmp_path):
+    """
+    Test that reads of a file database go through the read-only pool and see committed writes
+    :param tmp_path:
+    :return:
+    """
+    dao = BookDao(str(tmp_path / 'books.db'))
+    dao.add_book(Book(id=1, isbn='123', title='Pooled Book', author='Author'))
+    assert dao.get_book_by_id(1).title == 'Pooled Book'
+    with dao.readers.connection() as conn:
+        assert conn is not dao.conn
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute('DELETE FROM books')
+    dao.update_book(Book(id=1, isbn='123', title='Updated Book', author='Author'))
+    assert dao.get_book_by_id(1).title == 'Updated Book'
+    dao.close()
+
+
 # Tests for UserDao
 
 def test_add_user(user_dao):
@@ -152,6 +215,17 @@ def test_get_all_users(user_dao):
     assert users[1].username == 'user2'
 
 
+def test_get_all_users_with_fields(user_dao):
+    """
+    Test selecting only some columns of all users
+    :param user_dao:
+    :return:
+    """
+    user_dao.add_user(User(user_id=1, username='user1', password='password1'))
+    users = user_dao.get_all_users(fields=('user_id', 'username'))
+    assert users == [{'user_id': 1, 'username': 'user1'}]
+
+
 def test_get_one_user(user_dao):
     """
     Test getting a user by its id
@@ -301,3 +375,648 @@ def test_update_rented_book(rented_book_dao, user_dao, book_dao):
     result = rented_book_dao.update_rented_book(updated_rented_book)
     assert result is True
     assert rented_book_dao.get_rent_by_id(1).rented is False
+
+
+def test_get_rentals(rented_book_dao, user_dao):
+    """
+    Test the compact rentals and the batched user lookup used to expand them
+    :param rented_book_dao:
+    :param user_dao:
+    :return:
+    """
+    users = [User(user_id=i, username=f'user{i}', password='password') for i in (1, 2)]
+    book = Book(id=1, isbn='111', title='Book', author='Author')
+    for user in users + users[:1]:
+        user_dao.add_user(user)
+        rented_book_dao.add_rented_book(RentedBook(id=None, user=user, book=book, rented=False))
+    assert rented_book_dao.get_rentals(1) == [
+        {'id': 1, 'user_id': 1, 'book_id': 1, 'rented': False},
+        {'id': 3, 'user_id': 1, 'book_id': 1, 'rented': False},
+    ]
+    assert [rental['id'] for rental in rented_book_dao.get_rentals()] == [1, 2, 3]
+    found = user_dao.get_users_by_ids([2])
+    assert list(found) == [2] and found[2].username == 'user2'
+
+
+def test_password_hashing(user_dao):
+    """
+    Test that passwords are stored as scrypt hashes which verify and are cached once checked
+    :param user_dao:
+    :return:
+    """
+    password_hashing.clear_cache()
+    user_dao.add_user(User(user_id=None, username='hashed', password='password'))
+    user = user_dao.get_user_by_username('hashed')
+    assert password_hashing.is_password_hash(user.password)
+    assert password_hashing.verify_password('password', user.password)
+    assert not password_hashing.verify_password('wrong', user.password)
+    hits = metrics.get('password_cache.hits')
+    assert password_hashing.check_credentials(user, 'password')
+    assert password_hashing.check_credentials(user, 'password')
+    assert metrics.get('password_cache.hits') == hits + 1
+    assert not password_hashing.check_credentials(user, 'wrong')
+    assert not password_hashing.check_credentials(None, 'password')
+
+    user_dao.update_user(User(user_id=user.user_id, username='hashed', password='changed'))
+    changed = user_dao.get_user_by_username('hashed')
+    assert changed.password != user.password
+    assert not password_hashing.check_credentials(changed, 'password')
+    assert password_hashing.check_credentials(changed, 'changed')
+
+
+def test_rental_counters(rented_book_dao):
+    """
+    Test that the triggers keep the rental counters in step with inserts and deletes
+    :param rented_book_dao:
+    :return:
+    """
+    users = [User(user_id=i, username=f'user{i}', password='password') for i in (1, 2)]
+    books = [Book(id=i, isbn=str(i), title=f'Book{i}', author='Author') for i in (1, 2, 3)]
+    for user, book in ((users[0], books[0]), (users[1], books[0]), (users[1], books[1]),
+                       (users[0], books[2]), (users[1], books[2]), (users[1], books[2])):
+        rented_book_dao.add_rented_book(RentedBook(id=None, user=user, book=book))
+    assert rented_book_dao.get_most_rented_books(2) == [(3, 3), (1, 2)]
+    assert rented_book_dao.get_most_active_users() == [(2, 4), (1, 2)]
+
+    rented_book_dao.delete_rented_book_by_user_id(2)
+    assert rented_book_dao.get_most_rented_books() == [(1, 1), (3, 1)]
+    assert rented_book_dao.get_most_active_users() == [(1, 2)]
+
+
+def test_concurrent_check_out(tmp_path):
+    """
+    Test that of many connections checking out the same book at once exactly one wins
+    :param tmp_path:
+    :return:
+    """
+    db_file = str(tmp_path / 'rented_books.db')
+    daos = [RentedBookDao(db_file, user_dao=UserDao(':memory:'), book_dao=BookDao(':memory:'))
+            for _ in range(8)]
+    daos[0].create_table()
+    with ThreadPoolExecutor(max_workers=len(daos)) as executor:
+        rent_ids = list(executor.map(lambda user_id: daos[user_id].check_out(user_id, 1),
+                                     range(len(daos))))
+    winners = [rent_id for rent_id in rent_ids if rent_id is not None]
+    assert len(winners) == 1
+    assert daos[0].get_book_loan(1) == {'book_id': 1, 'available': False,
+                                        'rent_id': winners[0], 'version': 1}
+    assert daos[1].return_book(winners[0]) is True
+    assert daos[2].return_book(winners[0]) is False
+    assert daos[3].check_out(3, 1, version=1) is None
+    assert daos[3].check_out(3, 1, version=2) is not None
+    for dao in daos:
+        dao.close()
+
+
+def test_waitlist():
+    """
+    Test that a waitlist serves by priority and arrival and keeps the positions up to date
+    :return:
+    """
+    waitlist = Waitlist([(1, 0), (2, 5), (3, 0)])
+    waitlist.push(4, 5)
+    assert [waitlist.position(hold_id) for hold_id in (1, 2, 3, 4)] == [3, 1, 4, 2]
+    # A hold loaded with the waitlist and pushed after its insert keeps its place
+    waitlist.push(2, 5)
+    assert len(waitlist) == 4 and waitlist.position(2) == 1
+    assert waitlist.remove(2) is True
+    assert waitlist.remove(2) is False
+    assert waitlist.peek() == 4
+    assert waitlist.position(3) == 3
+    assert waitlist.position(2) is None
+
+    for hold_id in range(10, 1010):
+        waitlist.push(hold_id, hold_id % 3)
+    for hold_id in range(10, 1000):
+        waitlist.remove(hold_id)
+    assert len(waitlist) == 13
+    assert len(waitlist.heap) < 2 * len(waitlist) + 64
+    assert waitlist.peek() == 4
+    assert waitlist.position(1000) == 5
+    assert waitlist.position(1) == 9
+
+
+@pytest.mark.parametrize('engine', ['sqlite', 'sharded', 'memory'])
+def test_holds(tmp_path, engine):
+    """
+    Test that returning a book rents it to the next hold and that cancelled holds are skipped
+    :param tmp_path:
+    :param engine:
+    :return:
+    """
+    db_file = str(tmp_path / 'rented_books.db')
+    if engine == 'memory':
+        dao = MemoryRentedBookDao(MemoryStorage())
+    elif engine == 'sharded':
+        dao = ShardedRentedBookDao(db_file, shard_count=2,
+                                   user_dao=UserDao(':memory:'), book_dao=BookDao(':memory:'))
+    else:
+        dao = RentedBookDao(db_file, user_dao=UserDao(':memory:'), book_dao=BookDao(':memory:'))
+    dao.create_table()
+    rent_id = dao.check_out(1, 7)
+    first = dao.add_hold(7, 2)
+    assert first['position'] == 1
+    assert dao.add_hold(7, 2) is None
+    second = dao.add_hold(7, 3)
+    assert second['position'] == 2
+    urgent = dao.add_hold(7, 4, priority=5)
+    assert urgent['position'] == 1
+    assert dao.assign_next_hold(7) is None
+    assert [hold['user_id'] for hold in dao.get_waitlist(7)] == [4, 2, 3]
+    assert dao.cancel_hold(urgent['id']) is True
+    assert dao.cancel_hold(urgent['id']) is False
+    assert dao.get_hold(urgent['id'])['status'] == 'cancelled'
+
+    assert dao.update_rented_book(RentedBook(rent_id, None, None, False)) is True
+    assigned = dao.get_hold(first['id'])
+    assert assigned['status'] == 'assigned'
+    assert assigned['position'] is None
+    assert dao.get_book_loan(7)['rent_id'] == assigned['rent_id']
+    assert dao.get_rental_book_id(assigned['rent_id']) == 7
+    assert dao.get_next_hold(7)['user_id'] == 3
+    assert dao.get_hold(second['id'])['position'] == 1
+
+    assert dao.return_book(assigned['rent_id']) is True
+    assert dao.get_hold(second['id'])['status'] == 'assigned'
+    assert dao.get_waitlist(7) == []
+    assert dao.add_hold(7, 2)['position'] == 1
+    dao.close()
+
+
+def test_bloom_filter():
+    """
+    Test that a Bloom filter keeps every key and stays near its false-positive rate
+    :return:
+    """
+    bloom = BloomFilter(1000, 0.01)
+    for key in range(1000):
+        bloom.add(f'user{key}')
+    assert all(f'user{key}' in bloom for key in range(1000))
+    false_positives = sum(f'other{key}' in bloom for key in range(10000))
+    assert false_positives < 300
+    stats = bloom.stats()
+    assert stats['hashes'] == 7
+    assert stats['bytes'] == 1199
+    assert 0.005 < stats['expected_false_positive_rate'] < 0.02
+
+
+def test_existence_filters(tmp_path):
+    """
+    Test that definite misses skip the database and that writes of other connections are seen
+    :param tmp_path:
+    :return:
+    """
+    db_file = str(tmp_path / 'user.db')
+    user_dao = UserDao(db_file)
+    user_dao.create_table()
+    other_dao = UserDao(db_file)
+    user_dao.usernames.min_capacity = 4
+    user_dao.usernames.rebuild()
+    metrics.reset()
+    assert user_dao.add_user(User(user_id=None, username='alice', password='password')) is True
+    assert user_dao.get_user_by_username('bob') is None
+    assert metrics.get('bloom.usernames.skipped') == 1
+    assert other_dao.add_user(User(user_id=None, username='bob', password='password')) is True
+    assert user_dao.get_user_by_username('bob').username == 'bob'
+
+    for index in range(10):
+        user_dao.add_user(User(user_id=None, username=f'user{index}', password='password'))
+    assert user_dao.usernames.stats()['capacity'] >= 12
+    existing = user_dao.get_existing_usernames(['alice', 'bob', 'carol', 'user9'])
+    assert existing == {'alice', 'bob', 'user9'}
+    other_dao.close()
+    user_dao.close()
+
+    book_dao = BookDao(str(tmp_path / 'books.db'))
+    book_dao.add_book(Book(id=1, isbn='123', title='Filtered', author='Author'))
+    assert book_dao.get_book_by_id(2) is None
+    assert book_dao.get_books_by_ids([1, 2]) == {1: Book(1, '123', 'Filtered', 'Author')}
+    assert book_dao.get_existing_isbns(['123', '456']) == {'123'}
+    assert book_dao.update_book(Book(id=1, isbn='789', title='Filtered', author='Author')) is True
+    assert book_dao.get_existing_isbns(['789']) == {'789'}
+    assert book_dao.get_existing_book_ids([1, 3]) == {1}
+    assert metrics.get('bloom.book_ids.skipped') == 3
+
+    # A batch owning the writer connection holds up neither the catch-up nor other checks
+    other_book_dao = BookDao(str(tmp_path / 'books.db'), create=False)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        other_book_dao.add_book(Book(id=5, isbn='555', title='Other', author='Author'))
+        with batch_transaction() as batch:
+            book_dao.add_book(Book(id=4, isbn='444', title='Batched', author='Author'))
+            assert executor.submit(book_dao.get_existing_book_ids, [4, 5]).result(timeout=2) == {5}
+            batch.failed = True
+    other_book_dao.close()
+    book_dao.close()
+
+
+def test_traced_dao_methods(book_dao):
+    """
+    Test that DAO methods and their statements are only traced inside a sampled trace
+    :param book_dao:
+    :return:
+    """
+    tracing.clear()
+    book_dao.get_all_books()
+    assert tracing.start_trace('unsampled', 0.0) is None
+    assert tracing.get_spans() == []
+
+    root = tracing.start_trace('test', 1.0)
+    book_dao.add_book(Book(id=1, isbn='1', title='Traced', author='Author'))
+    book_dao.get_book_by_id(1)
+    tracing.finish_span(root)
+    spans = tracing.get_spans(root.trace_id)
+    assert [span['name'] for span in spans if span['parent_id'] == root.span_id] == [
+        'BookDao.add_book', 'BookDao.get_book_by_id']
+    get_book = spans[-2]
+    assert [span['name'] for span in spans if span['parent_id'] == get_book['span_id']] == ['sql']
+    assert all(span['trace_id'] == root.trace_id for span in spans)
+    assert tracing.start_span('after') is None
+
+
+def test_trace_file_rollover(tmp_path, monkeypatch):
+    """
+    Test that spans exported by many threads at once all land in the rotated trace files
+    :param tmp_path:
+    :param monkeypatch:
+    :return:
+    """
+    monkeypatch.setattr('tracing.TRACE_FILE_MAX_BYTES', 2048)
+    monkeypatch.setattr('tracing.TRACE_FILE_BACKUPS', 1000)
+    errors = []
+    monkeypatch.setattr('logging.Handler.handleError',
+                        lambda _handler, record: errors.append(record))
+    trace_file = str(tmp_path / 'traces.jsonl')
+    spans = [{'trace_id': str(thread), 'span_id': str(i), 'name': 'x' * 50}
+             for thread in range(8) for i in range(100)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda span: tracing.export([span], trace_file), spans))
+    exported = [line for path in tmp_path.iterdir()
+                for line in path.read_text(encoding='utf-8').splitlines()]
+    assert not errors
+    assert len(exported) == len(spans)
+
+
+def test_maintenance(tmp_path):
+    """
+    Test the maintenance tasks on a churned database and the scheduling by interval
+    :param tmp_path:
+    :return:
+    """
+    db_file = str(tmp_path / 'books.db')
+    dao = BookDao(db_file)
+    dao.create_table()
+    for i in range(1, 2001):
+        dao.add_book(Book(id=i, isbn=str(i), title='Churned ' * 20, author='Author'))
+    dao.cursor.execute('DELETE FROM books')
+    dao.conn.commit()
+
+    assert maintenance.run_task('checkpoint', db_file, 1.0)['checkpointed_frames'] > 0
+    assert maintenance.run_task('vacuum', db_file, 0)['pages_freed'] == 0
+    runs = metrics.get('maintenance.vacuum.runs')
+    result = maintenance.run_task('vacuum', db_file, 10.0)
+    assert result['pages_freed'] > 0 and result['pages_free'] == 0
+    assert metrics.get('maintenance.vacuum.runs') == runs + 1
+    assert dao.conn.execute('PRAGMA freelist_count').fetchone()[0] == 0
+    assert maintenance.run_task('analyze', db_file, 10.0)['indexes'] >= 1
+    assert 'seconds' in maintenance.run_task('optimize', db_file, 10.0)
+    assert maintenance.database_file(dao.conn) == db_file
+
+    scheduler = maintenance.MaintenanceScheduler(lambda: [db_file],
+                                                 intervals={'checkpoint': 10, 'vacuum': 20})
+    start = min(scheduler.next_runs.values()) - 10
+    assert scheduler.run_pending(start) == []
+    assert scheduler.run_pending(start + 10) == ['checkpoint']
+    assert scheduler.run_pending(start + 20) == ['checkpoint', 'vacuum']
+    assert db_file in scheduler.last_runs['vacuum']
+    scheduler.start()
+    scheduler.stop()
+
+    app = Flask(__name__)
+    scheduler = maintenance.register_maintenance(app, lambda: [db_file])
+    assert scheduler.thread is None
+    with app.test_client() as client:
+        client.get('/')
+        thread = scheduler.thread
+        client.get('/')
+    assert thread.is_alive() and scheduler.thread is thread
+    scheduler.stop()
+    dao.close()
+
+
+def test_branch_registry(tmp_path):
+    """
+    Test that the registry keeps at most max_open idle branches open, least recently used first
+    :param tmp_path:
+    :return:
+    """
+    registry = branches.BranchRegistry(str(tmp_path), max_open=2)
+    for name in ('a', 'b', 'c'):
+        assert registry.create(name) is True
+    assert registry.create('a') is False
+    with pytest.raises(ValueError):
+        registry.create('a/b')
+    with pytest.raises(KeyError):
+        registry.acquire('d')
+
+    leases = [registry.acquire(name) for name in ('a', 'b', 'c')]
+    # Leased branches are never closed
+    assert list(registry.open) == ['a', 'b', 'c']
+    leases[0].book_dao.add_book(Book(id=1, isbn='1', title='Book', author='Author'))
+    for daos in leases:
+        registry.release(daos)
+    assert list(registry.open) == ['b', 'c']
+    a_again = registry.acquire('a')
+    assert a_again is not leases[0]
+    assert a_again.book_dao.get_book_by_id(1).title == 'Book'
+    registry.release(a_again)
+    assert list(registry.open) == ['c', 'a']
+    assert len(registry.get_files()) == 3 * 5
+    registry.close()
+    assert not registry.open
+
+
+def test_retry_on_busy(monkeypatch):
+    """
+    Test that busy writes are retried a bounded number of times and other errors are not
+    :param monkeypatch:
+    :return:
+    """
+    monkeypatch.setattr('db.WRITE_RETRY_BACKOFF_SECONDS', 0)
+    attempts = []
+
+    def busy_write():
+        attempts.append(1)
+        error = sqlite3.OperationalError('database is locked')
+        error.sqlite_errorcode = sqlite3.SQLITE_BUSY
+        raise error
+
+    with pytest.raises(sqlite3.OperationalError):
+        retry_on_busy(busy_write, retries=3)
+    assert len(attempts) == 3
+    attempts.clear()
+    conn = sqlite3.connect(':memory:')
+    with pytest.raises(sqlite3.OperationalError):
+        retry_on_busy(lambda: attempts.append(1) or conn.execute('SELECT * FROM missing'),
+                      retries=3)
+    assert len(attempts) == 1
+    conn.close()
+
+
+def test_batch_owns_writer(tmp_path):
+    """
+    Test that writes of other threads neither commit nor roll back the writes of a batch
+    :param tmp_path:
+    :return:
+    """
+    conn = connect(str(tmp_path / 'batch.db'))
+    conn.execute('CREATE TABLE items (name TEXT)')
+    conn.commit()
+
+    def write(name, commit=True):
+        conn.execute('INSERT INTO items VALUES (?)', (name,))
+        if commit:
+            conn.commit()
+        else:
+            conn.rollback()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with batch_transaction() as batch:
+            write('batch')
+            committed = executor.submit(write, 'other')
+            rolled_back = executor.submit(write, 'rolled back', commit=False)
+            assert not committed.done() and not rolled_back.done()
+            batch.failed = True
+        committed.result()
+        rolled_back.result()
+        with batch_transaction():
+            write('batch')
+            executor.submit(write, 'rolled back', commit=False)
+    assert sorted(row[0] for row in conn.execute('SELECT name FROM items')) == ['batch', 'other']
+    conn.close()
+
+
+def test_sharded_rented_books(tmp_path, user_dao, book_dao):
+    """
+    Test that rentals are routed by user, gathered over all shards and rebalanced
+    :param tmp_path:
+    :param user_dao:
+    :param book_dao:
+    :return:
+    """
+    dao = ShardedRentedBookDao(str(tmp_path / 'rented_books.db'), shard_count=2,
+                               user_dao=user_dao, book_dao=book_dao)
+    dao.create_table()
+    book = Book(id=1, isbn='123', title='Test Book', author='Author')
+    book_dao.add_book(book)
+    users = [User(user_id=i, username=f'user{i}', password='password') for i in range(1, 4)]
+    for user in users:
+        user_dao.add_user(user)
+        dao.add_rented_book(RentedBook(id=None, user=user, book=book, rented=True))
+    dao.add_rented_book(RentedBook(id=None, user=users[0], book=book, rented=True))
+
+    assert [rented_book.id for rented_book in dao.get_all_rented_books()] == [1, 2, 3, 4]
+    assert len(dao.shard_for_user(2).get_all_rented_books()) == 1
+    assert len(dao.get_rented_books_by_user_id(1)) == 2
+    assert dao.count_rented_books_by_user() == {1: 2, 2: 1, 3: 1}
+    assert dao.get_rent_by_id(3).user.user_id == 3
+    assert dao.get_most_rented_books() == [(1, 4)]
+    assert dao.get_most_active_users(2) == [(1, 2), (2, 1)]
+
+    assert dao.rebalance(3) == 2
+    assert [rented_book.id for rented_book in dao.get_all_rented_books()] == [1, 2, 3, 4]
+    assert dao.count_rented_books_by_user() == {1: 2, 2: 1, 3: 1}
+    assert dao.delete_rented_book(4) is True
+    assert dao.delete_rented_book_by_user_id(1) is True
+    assert dao.count_rented_books_by_user() == {2: 1, 3: 1}
+    assert dao.get_most_rented_books() == [(1, 2)]
+    dao.executor.shutdown()
+    for shard in dao.shards:
+        shard.conn.close()
+
+
+def test_sharded_check_out_claims(tmp_path, user_dao, book_dao):
+    """
+    Test that a book is claimed on its own shard, so users of different shards never both get it
+    :param tmp_path:
+    :param user_dao:
+    :param book_dao:
+    :return:
+    """
+    dao = ShardedRentedBookDao(str(tmp_path / 'rented_books.db'), shard_count=2,
+                               user_dao=user_dao, book_dao=book_dao)
+    dao.create_table()
+    owner = dao.shard_for_book(2)
+    # A check-out of another shard which claimed the book but has not written its rental yet
+    assert owner.claim_book(2, 99) is True
+    assert dao.check_out(1, 2) is None
+    # A claim left behind by a check-out which never wrote its rental is taken over after a while
+    owner.conn.execute('UPDATE book_claims SET claimed_at = claimed_at - 3600')
+    owner.conn.commit()
+    rent_id = dao.check_out(1, 2)
+    assert owner.get_book_claim(2)[0] == rent_id
+    assert dao.check_out(2, 2) is None
+
+    assert dao.return_book(rent_id) is True
+    assert owner.get_book_claim(2) is None
+    other_rent_id = dao.check_out(2, 2)
+    assert dao.update_rented_book(RentedBook(rent_id, None, None, True)) is False
+    assert dao.get_book_loan(2)['rent_id'] == other_rent_id
+    assert dao.update_rented_book(RentedBook(other_rent_id, None, None, False)) is True
+    assert dao.update_rented_book(RentedBook(rent_id, None, None, True)) is True
+    assert owner.get_book_claim(2)[0] == rent_id
+
+    # The rentals of user 2 move to the third shard, the claim of book 2 to the first
+    assert dao.rebalance(3) == 1
+    assert dao.shard_for_book(2).get_book_claim(2)[0] == rent_id
+    assert dao.delete_rented_book(rent_id) is True
+    assert dao.shard_for_book(2).get_book_claim(2) is None
+    dao.executor.shutdown()
+    for shard in dao.shards:
+        shard.conn.close()
+
+
+def test_memory_storage(tmp_path):
+    """
+    Test the in-memory DAOs and the snapshot persistence of their storage
+    :param tmp_path:
+    :return:
+    """
+    snapshot_file = str(tmp_path / 'library.snapshot.json')
+    storage = MemoryStorage(snapshot_file)
+    book_dao, user_dao = MemoryBookDao(storage), MemoryUserDao(storage)
+    rented_book_dao = MemoryRentedBookDao(storage)
+    book = Book(id=1, isbn='123', title='Memory Book', author='Author')
+    assert book_dao.add_book(book) is True
+    assert book_dao.add_book(Book(id=2, isbn='123', title='Other', author='Author')) is False
+    assert user_dao.add_user(User(user_id=None, username='memory', password='password')) is True
+    user = user_dao.get_user_by_username('memory')
+    assert rented_book_dao.add_rented_book(RentedBook(id=None, user=user, book=book)) is True
+    assert book_dao.get_all_books(fields=('id', 'title')) == [{'id': 1, 'title': 'Memory Book'}]
+    assert rented_book_dao.count_rented_books_by_user() == {user.user_id: 1}
+    assert rented_book_dao.get_most_rented_books() == [(1, 1)]
+    rented_book_dao.close()
+
+    reloaded = MemoryRentedBookDao(MemoryStorage(snapshot_file))
+    assert reloaded.get_rented_books_by_user_id(user.user_id) == [RentedBook(1, user, book, True)]
+    assert reloaded.update_rented_book(RentedBook(1, user, book, False)) is True
+    assert reloaded.get_rent_by_id(1).rented is False
+    assert reloaded.get_most_active_users() == [(user.user_id, 1)]
+    assert reloaded.delete_rented_book_by_user_id(user.user_id) is True
+    assert reloaded.get_all_rented_books() == []
+    assert reloaded.get_most_rented_books() == []
+
+
+def test_storage_backend_from_environment(monkeypatch):
+    """
+    Test that the backend is read from the environment and the snapshot lives in the data directory
+    :param monkeypatch:
+    :return:
+    """
+    monkeypatch.setenv('LIBRARY_STORAGE_BACKEND', 'memory')
+    importlib.reload(storage)
+    try:
+        assert storage.STORAGE_BACKEND == 'memory'
+        assert storage.MEMORY_SNAPSHOT_FILE == db.data_file('library.snapshot.json')
+        monkeypatch.setenv('LIBRARY_STORAGE_BACKEND', 'postgres')
+        with pytest.raises(ValueError):
+            importlib.reload(storage)
+    finally:
+        monkeypatch.delenv('LIBRARY_STORAGE_BACKEND')
+        importlib.reload(storage)
+    assert storage.STORAGE_BACKEND == 'sqlite'
+
+
+def test_build_similar_books():
+    """
+    Test the batch build of the co-rented books
+    :return:
+    """
+    # user 1 rented books 10, 20 and 30 (30 twice), user 2 books 10 and 20, user 3 book 30
+    rentals = [(1, 10), (1, 20), (1, 30), (1, 30), (2, 10), (2, 20), (3, 30)]
+    columns = build_similar_books(*zip(*rentals), top_k=1)
+    assert [column.tolist() for column in columns] == [[10, 20, 30], [0, 0, 0],
+                                                       [20, 10, 10], [2, 2, 1]]
+    assert [column.tolist() for column in build_similar_books([], [])] == [[], [], [], []]
+
+
+def test_incremental_similar_books(tmp_path, rented_book_dao):
+    """
+    Test that merging the co-rentals of every new rental gives the same lists as a rebuild
+    :param tmp_path:
+    :param rented_book_dao:
+    :return:
+    """
+    recommendation_dao = RecommendationDao(str(tmp_path / 'recommendations.db'), top_k=2)
+    books = {i: Book(id=i, isbn=str(i), title=f'Book{i}', author='Author') for i in range(1, 5)}
+    for user_id, book_id in ((1, 1), (1, 2), (2, 1), (2, 3), (3, 1), (3, 3), (3, 4), (1, 4)):
+        user = User(user_id=user_id, username=f'user{user_id}', password='password')
+        rented_book_dao.add_rented_book(RentedBook(id=None, user=user, book=books[book_id]))
+        other_book_ids = {pair[1] for pair in rented_book_dao.get_rental_pairs()
+                          if pair[0] == user_id and pair[1] != book_id}
+        co_rentals = rented_book_dao.count_co_rentals(book_id, other_book_ids)
+        recommendation_dao.record_co_rentals(book_id, co_rentals)
+    incremental = {book_id: recommendation_dao.get_similar_books(book_id) for book_id in books}
+    assert incremental[1] == [(3, 2), (4, 2)]
+
+    assert recommendation_dao.rebuild(rented_book_dao.get_rental_pairs()) == 8
+    rebuilt = {book_id: recommendation_dao.get_similar_books(book_id) for book_id in books}
+    assert rebuilt == incremental
+    # More ids than SQLite allows bound parameters
+    assert rented_book_dao.count_co_rentals(1, range(2, 40000)) == {2: 1, 3: 2, 4: 2}
+    recommendation_dao.close()
+
+
+def test_circulation_rollup(tmp_path, book_dao):
+    """
+    Test that the rentals of the changelog are folded into the daily rollups exactly once
+    :param tmp_path:
+    :param book_dao:
+    :return:
+    """
+    rented_book_dao = RentedBookDao(str(tmp_path / 'rented_books.db'),
+                                    user_dao=UserDao(':memory:'), book_dao=book_dao)
+    rented_book_dao.create_table()
+    changelog_dao = ChangelogDao(str(tmp_path / 'rented_books.db'))
+    circulation_dao = CirculationDao(str(tmp_path / 'circulation.db'))
+    books = [Book(id=1, isbn='1', title='Book1', author='Author1'),
+             Book(id=2, isbn='2', title='Book2', author='Author2')]
+    for book in books:
+        book_dao.add_book(book)
+    for user_id, book in ((1, books[0]), (1, books[1]), (2, books[0]), (3, books[1]),
+                          (3, books[0])):
+        user = User(user_id=user_id, username=f'user{user_id}', password='password')
+        rented_book_dao.add_rented_book(RentedBook(id=None, user=user, book=book))
+    rented_book_dao.delete_rented_book(1)
+
+    assert circulation_dao.roll_up(changelog_dao, book_dao, batch_size=2) == 5
+    assert circulation_dao.roll_up(changelog_dao, book_dao) == 0
+    by_day = circulation_dao.get_circulation('2000-01-01', '2999-12-31')
+    assert [row['loans'] for row in by_day['rows']] == [5]
+    assert by_day['totals'] == {'loans': 5, 'active_users': 3}
+    by_author = circulation_dao.get_circulation('2000-01-01', '2999-12-31', group_by='author')
+    assert by_author['rows'] == [{'author': 'Author1', 'loans': 3},
+                                 {'author': 'Author2', 'loans': 2}]
+    assert circulation_dao.get_circulation('1999-01-01', '1999-12-31')['totals']['loans'] == 0
+    with pytest.raises(ValueError):
+        circulation_dao.get_circulation('2000-01-01', '2999-12-31', group_by='user')
+    circulation_dao.close()
+    changelog_dao.close()
+    rented_book_dao.close()
+
+
+def test_slow_query_log(rented_book_dao, monkeypatch):
+    """
+    Test that slow statements are logged with their DAO method and query plan
+    :param rented_book_dao:
+    :param monkeypatch:
+    :return:
+    """
+    monkeypatch.setattr(slow_query_log, 'SLOW_QUERY_THRESHOLD_MS', 0)
+    slow_query_log.clear()
+    rented_book_dao.get_rented_books_by_user_id(1)
+    entry = next(entry for entry in slow_query_log.get_slow_queries()
+                 if entry['sql'] == 'SELECT * FROM rented_books WHERE user_id = ?')
+    assert entry['dao_method'] == 'RentedBookDao.get_rented_books_by_user_id'
+    assert entry['parameters'] == '(1,)'
+    assert any('rented_books_user_id' in line for line in entry['query_plan'])
+    slow_query_log.clear()
@@ -0,0 +1,291 @@
+"""
+This module opens the SQLite connections used by the DAOs.
+"""
+import contextvars
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+import metrics
+import table_versions
+from slow_query_log import TimedConnection, TimedCursor
+
+# Directory of the database files, the working directory if not set
+DATA_DIR = os.environ.get('LIBRARY_DATA_DIR', '')
+BUSY_TIMEOUT_SECONDS = 5
+READ_POOL_SIZE = 8
+# Attempts of a write which still finds the database busy after BUSY_TIMEOUT_SECONDS
+WRITE_RETRIES = 5
+WRITE_RETRY_BACKOFF_SECONDS = 0.01
+
+
+def data_file(file_name):
+    """
+    Returns the path of a database file in DATA_DIR.
+    :param file_name: e.g. "books.db"
+    :return: str
+    """
+    return os.path.join(DATA_DIR, file_name)
+
+
+class Batch:  # pylint: disable=too-few-public-methods
+    """
+    State of the batch transaction of the current request, see batch_transaction.
+    """
+
+    def __init__(self):
+        self.connections = []
+        self.tables = set()
+        self.failed = False
+
+    def join(self, conn):
+        """Registers a connection whose transaction ends with the batch."""
+        if conn not in self.connections:
+            self.connections.append(conn)
+
+
+_batch = contextvars.ContextVar('batch', default=None)
+
+
+class BatchCursor(TimedCursor):
+    """
+    Cursor of a BatchConnection, every statement runs while its transaction owns the writer.
+    """
+
+    def execute(self, sql, parameters=(), /):
+        """Executes a statement once the writer is free."""
+        with self.connection.writing():
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        """Executes a statement for every parameter set once the writer is free."""
+        with self.connection.writing():
+            return super().executemany(sql, seq_of_parameters)
+
+
+class BatchConnection(TimedConnection):
+    """
+    Writer connection shared by the request threads. A transaction owns the connection from
+    its first statement to its commit or rollback, so no other thread commits or rolls back
+    its writes: a batch transaction owns it until the batch ends, any other thread until it
+    commits or rolls back, or right after a statement which left no transaction open.
+    Commit and rollback are deferred to the end of the batch while one is running in the
+    current context.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writer_lock = threading.Lock()
+        # The Batch or the id of the thread whose transaction owns the connection
+        self.writer = None
+
+    def cursor(self, factory=BatchCursor):
+        """Returns a new cursor, a BatchCursor unless another factory is given."""
+        return super().cursor(factory)
+
+    @contextmanager
+    def writing(self):
+        """
+        Context manager which runs a statement in the transaction of the current context,
+        after waiting up to BUSY_TIMEOUT_SECONDS for the transaction of another one.
+        """
+        batch = _batch.get()
+        owner = batch or threading.get_ident()
+        if self.writer != owner:
+            if not self.writer_lock.acquire(timeout=BUSY_TIMEOUT_SECONDS):
+                error = sqlite3.OperationalError('database is locked by another transaction')
+                error.sqlite_errorcode = sqlite3.SQLITE_BUSY
+                raise error
+            self.writer = owner
+            if batch is not None:
+                batch.join(self)
+        in_transaction = self.in_transaction
+        try:
+            yield
+        except sqlite3.Error:
+            # A failed first statement leaves the transaction it began open
+            if batch is None and not in_transaction:
+                sqlite3.Connection.rollback(self)
+            raise
+        finally:
+            if batch is None and not self.in_transaction:
+                self._release(owner)
+
+    def _release(self, owner):
+        if self.writer == owner:
+            self.writer = None
+            self.writer_lock.release()
+
+    def commit(self):
+        """Commits, or leaves the transaction open until the batch ends."""
+        if _batch.get() is None:
+            super().commit()
+            self._release(threading.get_ident())
+
+    def rollback(self):
+        """Rolls back, or marks the batch as failed so all of it is rolled back at the end."""
+        batch = _batch.get()
+        if batch is None:
+            super().rollback()
+            self._release(threading.get_ident())
+        else:
+            batch.failed = True
+
+    def end_batch(self, batch):
+        """
+        Commits or rolls back the transaction of a batch and hands the connection on.
+        :param batch: Batch which owns the connection
+        """
+        if self.writer is not batch:
+            return
+        try:
+            if batch.failed:
+                super().rollback()
+            else:
+                super().commit()
+        finally:
+            self._release(batch)
+
+
+def _record_batch_table(table):
+    batch = _batch.get()
+    if batch is not None:
+        batch.tables.add(table)
+
+
+table_versions.add_listener(_record_batch_table)
+
+
+@contextmanager
+def batch_transaction():
+    """
+    Context manager which runs all DAO writes of the current context in one transaction per
+    database file. The transactions are committed one after another when the block ends, or
+    all rolled back if the block raises or sets failed on the yielded Batch. Reads of the
+    block go through the writer connections, so they see the writes before them. The batch
+    owns every writer connection it used until it ends, so statements of other requests on
+    them wait, and neither their commits nor their rollbacks reach the writes of the batch.
+    :return: Batch
+    """
+    batch = Batch()
+    token = _batch.set(batch)
+    try:
+        yield batch
+    except BaseException:
+        batch.failed = True
+        raise
+    finally:
+        _batch.reset(token)
+        for conn in batch.connections:
+            conn.end_batch(batch)
+        metrics.increment('batch.rolled_back' if batch.failed else 'batch.committed')
+        # Responses cached during the batch may hold uncommitted rows
+        for table in batch.tables:
+            table_versions.bump(table)
+
+
+def in_batch():
+    """
+    Tells whether a batch transaction is running in the current context.
+    :return: bool
+    """
+    return _batch.get() is not None
+
+
+def connect(db_file):
+    """
+    Opens the writer connection of a DAO, it can be shared between the request threads.
+    File databases are switched to WAL, so readers and the backup never block the writer.
+    New databases are created with incremental auto vacuum, see maintenance.
+    :param db_file: path of the database file or ":memory:"
+    :return: sqlite3.Connection
+    """
+    conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False,
+                           factory=BatchConnection)
+    # Only takes effect on a new database, before WAL and the first table are written
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+def is_busy(error):
+    """
+    Tells whether a sqlite3 error is SQLITE_BUSY or SQLITE_LOCKED, including extended codes.
+    :param error: sqlite3.Error
+    :return: bool
+    """
+    code = getattr(error, 'sqlite_errorcode', None)
+    return code is not None and code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+
+def retry_on_busy(write, retries=WRITE_RETRIES):
+    """
+    Runs a write and runs it again with exponential backoff and jitter while the database
+    is busy. The write has to roll back its own transaction before it raises.
+    :param write: callable without arguments
+    :param retries: maximum number of attempts
+    :return: the result of write
+    """
+    for attempt in range(retries):
+        try:
+            return write()
+        except sqlite3.OperationalError as e:
+            if not is_busy(e) or attempt == retries - 1:
+                raise
+            metrics.increment('sql.busy_retries')
+            time.sleep(WRITE_RETRY_BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5))
+    raise ValueError('retries must be at least 1')
+
+
+class ReadOnlyPool:
+    """
+    Pool of read-only connections to one database file.
+    Reads taken from the pool run in parallel under WAL and never wait on the writer.
+    """
+
+    def __init__(self, db_file, writer, max_idle=READ_POOL_SIZE):
+        """
+        :param db_file: path of the database file or ":memory:"
+        :param writer: writer connection, used for reads of in-memory databases
+        :param max_idle: maximum number of idle connections kept open
+        """
+        self.writer = writer
+        self.max_idle = max_idle
+        self.uri = None
+        if db_file and db_file != ':memory:' and not db_file.startswith('file:'):
+            self.uri = f'file:{pathname2url(os.path.abspath(db_file))}?mode=ro'
+        self.idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager which lends a read-only connection to the caller.
+        :return: sqlite3.Connection
+        """
+        if self.uri is None or in_batch():
+            yield self.writer
+            return
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = sqlite3.connect(self.uri, uri=True, timeout=BUSY_TIMEOUT_SECONDS,
+                                   check_same_thread=False, factory=TimedConnection)
+        try:
+            yield conn
+        finally:
+            if self.idle.qsize() < self.max_idle:
+                self.idle.put(conn)
+            else:
+                conn.close()
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
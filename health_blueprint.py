@@ -0,0 +1,200 @@
+"""
+Blueprint for the health and readiness checks of the load balancer.
+/ready only answers whether this instance should get traffic and fails fast; /health also
+reports the statistics of every DAO connection and database file, the caches and the load.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from flask import Blueprint, jsonify, request
+
+import books_blueprint
+import changes_blueprint
+import metrics
+import rent_book_blueprint
+import response_cache
+import stats_blueprint
+import user_blueprint
+
+health_blueprint = Blueprint('health_blueprint', __name__)
+# /ready answers 503 above this many requests in flight, the health check itself included
+MAX_IN_FLIGHT_REQUESTS = 64
+_ENVIRON_KEY = 'health.in_flight'
+_started = time.time()
+_in_flight = {'requests': 0}
+_in_flight_lock = threading.Lock()
+
+
+@health_blueprint.before_app_request
+def count_request():
+    """
+    before_request hook of the whole app, counts the request as in flight.
+    """
+    request.environ[_ENVIRON_KEY] = True
+    with _in_flight_lock:
+        _in_flight['requests'] += 1
+
+
+@health_blueprint.teardown_app_request
+def uncount_request(_exception):
+    """
+    teardown_request hook of the whole app, the request is no longer in flight.
+    """
+    if request.environ.pop(_ENVIRON_KEY, False):
+        with _in_flight_lock:
+            _in_flight['requests'] -= 1
+
+
+def get_daos():
+    """
+    Returns the DAOs the blueprints currently use by name.
+    :return: dict
+    """
+    daos = {
+        'books': books_blueprint.book_dao,
+        'users': user_blueprint.user_dao,
+        'rented_books': rent_book_blueprint.rent_book_dao,
+        'recommendations': rent_book_blueprint.recommendation_dao,
+        'circulation': stats_blueprint.circulation_dao,
+    }
+    for table, changelog_dao in changes_blueprint.changelog_daos.items():
+        daos[f'changelog.{table}'] = changelog_dao
+    return daos
+
+
+def dao_connections(name, dao):
+    """
+    Yields the writer connections of a DAO, of its shards and of the DAOs it looks entities up
+    with. The in-memory DAOs have none.
+    :param name: name of the DAO
+    :param dao: DAO
+    :return: generator of (name, sqlite3.Connection)
+    """
+    if getattr(dao, 'conn', None) is not None:
+        yield name, dao.conn
+    for index, shard in enumerate(getattr(dao, 'shards', ())):
+        yield from dao_connections(f'{name}.shard{index}', shard)
+    for attribute in ('user_dao', 'book_dao'):
+        if getattr(dao, attribute, None) is not None:
+            yield from dao_connections(f'{name}.{attribute}', getattr(dao, attribute))
+
+
+def get_connections():
+    """
+    Returns every writer connection once, by the name of the first DAO which holds it.
+    :return: dict of name to sqlite3.Connection
+    """
+    connections, seen = {}, set()
+    for name, dao in get_daos().items():
+        for conn_name, conn in dao_connections(name, dao):
+            if id(conn) not in seen:
+                seen.add(id(conn))
+                connections[conn_name] = conn
+    return connections
+
+
+def connection_stats(conn):
+    """
+    Checks a connection and reads the size and page cache settings of its database.
+    The page cache hit counters of sqlite3_db_status are not exposed by the sqlite3 module.
+    :param conn: sqlite3.Connection
+    :return: dict
+    :raises sqlite3.Error: if the connection is closed or broken
+    """
+    conn.execute('SELECT 1').fetchone()
+    db_file = conn.execute('PRAGMA database_list').fetchone()[2]
+    pragmas = {pragma: conn.execute(f'PRAGMA {pragma}').fetchone()[0]
+               for pragma in ('page_size', 'page_count', 'freelist_count', 'cache_size')}
+    wal_file = f'{db_file}-wal'
+    return {
+        'status': 'ok',
+        'file': db_file or ':memory:',
+        'file_bytes': os.path.getsize(db_file) if db_file else 0,
+        'wal_bytes': os.path.getsize(wal_file) if db_file and os.path.exists(wal_file) else 0,
+        **pragmas,
+        # A negative cache_size is in KiB, a positive one in pages
+        'cache_bytes': (-pragmas['cache_size'] * 1024 if pragmas['cache_size'] < 0
+                        else pragmas['cache_size'] * pragmas['page_size']),
+        'in_transaction': conn.in_transaction,
+    }
+
+
+def hit_rate(hits_counter, misses_counter):
+    """
+    Returns the hit rate of a cache from its counters.
+    :param hits_counter: name of the hits counter
+    :param misses_counter: name of the misses counter
+    :return: float
+    """
+    hits, misses = metrics.get(hits_counter), metrics.get(misses_counter)
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+def bloom_filter_stats():
+    """
+    Returns the size, expected false-positive rate and counters of the Bloom filters of the
+    book and user DAOs, the in-memory DAOs have none.
+    :return: dict of DAO and filter name to stats
+    """
+    daos = {'books': books_blueprint.book_dao, 'users': user_blueprint.user_dao}
+    return {f'{dao_name}.{name}': existence_filter.stats()
+            for dao_name, dao in daos.items()
+            for name, existence_filter in getattr(dao, 'existence_filters', {}).items()}
+
+
+def get_in_flight():
+    """
+    Returns the number of requests in flight.
+    :return: int
+    """
+    with _in_flight_lock:
+        return _in_flight['requests']
+
+
+@health_blueprint.route('/health', methods=['GET'])
+def health():
+    """
+    This method reports the state of every DAO connection with the sizes of its database and
+    WAL files, the page cache settings, the cache hit rates and the requests in flight.
+    :return: 200 if all connections work, 503 otherwise
+    """
+    connections = {}
+    for name, conn in get_connections().items():
+        try:
+            connections[name] = connection_stats(conn)
+        except sqlite3.Error as e:
+            connections[name] = {'status': 'error', 'error': str(e)}
+    healthy = all(stats['status'] == 'ok' for stats in connections.values())
+    return jsonify({
+        'status': 'ok' if healthy else 'error',
+        'uptime_seconds': round(time.time() - _started, 3),
+        'requests': {'in_flight': get_in_flight(), 'max_in_flight': MAX_IN_FLIGHT_REQUESTS,
+                     'threads': threading.active_count()},
+        'connections': connections,
+        'caches': {
+            'response_cache': response_cache.stats(),
+            'compression_hit_rate': hit_rate('compression.cache_hits', 'compression.cache_misses'),
+            'password_hit_rate': hit_rate('password_cache.hits', 'password_cache.misses'),
+            'bloom_filters': bloom_filter_stats(),
+        },
+    }), 200 if healthy else 503
+
+
+@health_blueprint.route('/ready', methods=['GET'])
+def ready():
+    """
+    This method tells the load balancer whether to route requests to this instance. It stops
+    at the first broken connection, and answers 503 while too many requests are in flight.
+    :return: 200 or 503 with the reason
+    """
+    in_flight = get_in_flight()
+    if in_flight > MAX_IN_FLIGHT_REQUESTS:
+        return jsonify({'ready': False, 'reason': f'{in_flight} requests in flight'}), 503
+    for name, conn in get_connections().items():
+        try:
+            conn.execute('SELECT 1').fetchone()
+        except sqlite3.Error as e:
+            return jsonify({'ready': False, 'reason': f'{name}: {e}'}), 503
+    return jsonify({'ready': True, 'in_flight': in_flight}), 200
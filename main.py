@@ -5,15 +5,27 @@ set up the database and run the app
 
 from flask import Flask, jsonify
 
+import branches
+import maintenance
+import metrics
+import response_cache
+from response_compression import compress_response
+from request_profiler import register_profiling
+from tracing import register_tracing
+
 # blueprints
 from books_blueprint import book_blueprint
 from rent_book import RentedBook
 from user_blueprint import user_blueprint
 from rent_book_blueprint import rent_book_blueprint
+from changes_blueprint import changes_blueprint
+from admin_blueprint import admin_blueprint
+from stats_blueprint import stats_blueprint
+from batch_blueprint import batch_blueprint
+import health_blueprint as health_module
+from health_blueprint import health_blueprint
 # dao
-from book_dao import BookDao, BOOK_DB_NAME
-from user_dao import UserDao, USER_DB_NAME
-from rent_book_dao import RentedBookDao, RENTED_BOOK_DB_NAME
+from storage import create_book_dao, create_user_dao, create_rented_book_dao
 # models
 from book import Book
 from user import User
@@ -23,6 +35,15 @@ app.secret_key = 'supersecret'
 app.register_blueprint(book_blueprint)
 app.register_blueprint(user_blueprint)
 app.register_blueprint(rent_book_blueprint)
+app.register_blueprint(changes_blueprint)
+app.register_blueprint(admin_blueprint)
+app.register_blueprint(stats_blueprint)
+app.register_blueprint(batch_blueprint)
+app.register_blueprint(health_blueprint)
+app.after_request(compress_response)
+register_profiling(app)
+register_tracing(app)
+branches.register_branches(app)
 
 
 @app.route('/', methods=['GET'])
@@ -34,6 +55,15 @@ def greet():
     return jsonify("Hello", "myfriend")
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    This method returns the in-process metrics, e.g. compression time against bytes saved.
+    :return:
+    """
+    return jsonify({**metrics.snapshot(), 'response_cache': response_cache.stats()})
+
+
 def setup_books(book_dao):
     """
     This method sets up the books table with some initial data.
@@ -82,14 +112,28 @@ def setup_rented_books(rented_book_dao):
     rented_book_dao.close()
 
 
+def database_files():
+    """
+    This method returns the database files of the DAOs the blueprints use and of all branches,
+    for the maintenance.
+    :return:
+    """
+    files = (maintenance.database_file(conn) for conn in health_module.get_connections().values())
+    return [db_file for db_file in files if db_file] + branches.registry.get_files()
+
+
 def generate_data():
     """
     This method generates data for the database.
     :return:
     """
-    setup_books(BookDao(BOOK_DB_NAME))
-    setup_users(UserDao(USER_DB_NAME))
-    setup_rented_books(RentedBookDao(RENTED_BOOK_DB_NAME))
+    setup_books(create_book_dao())
+    setup_users(create_user_dao())
+    setup_rented_books(create_rented_book_dao())
+
+
+# Started by the first request of every serving process, also under a WSGI server
+maintenance.register_maintenance(app, database_files)
 
 
 if __name__ == '__main__':
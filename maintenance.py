@@ -0,0 +1,214 @@
+"""
+This module runs the maintenance of the database files in a background thread:
+ANALYZE, PRAGMA optimize, WAL checkpoints and incremental vacuum, every task on its own
+interval and within its own time budget. Tasks run on their own short-lived connection per
+file, so they never interleave with the transactions on the shared writer connections.
+Every run records its duration and effect in the metrics as maintenance.<task>.<name>.
+"""
+import logging
+import sqlite3
+import threading
+import time
+
+import metrics
+from db import connect
+
+MAINTENANCE_INTERVALS_SECONDS = {
+    'checkpoint': 60,
+    'vacuum': 10 * 60,
+    'optimize': 60 * 60,
+    'analyze': 24 * 60 * 60,
+}
+MAINTENANCE_BUDGET_SECONDS = {
+    'checkpoint': 1.0,
+    'vacuum': 0.5,
+    'optimize': 2.0,
+    'analyze': 5.0,
+}
+# Rows ANALYZE looks at per index, bounds its run time on large tables
+ANALYSIS_LIMIT = 1000
+# Pages freed per incremental vacuum step, the write lock is released between the steps
+VACUUM_STEP_PAGES = 256
+# SQLite calls the progress handler every that many virtual machine instructions
+PROGRESS_HANDLER_INSTRUCTIONS = 1000
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def database_file(conn):
+    """
+    Returns the file of the main database of a connection.
+    :param conn: sqlite3.Connection
+    :return: path, or None for an in-memory database
+    """
+    return conn.execute('PRAGMA database_list').fetchone()[2] or None
+
+
+def analyze(conn, _deadline):
+    """
+    Refreshes the statistics of the query planner with a sampling ANALYZE.
+    :return: effect of the run
+    """
+    conn.execute(f'PRAGMA analysis_limit={ANALYSIS_LIMIT}')
+    conn.execute('ANALYZE')
+    conn.commit()
+    return {'indexes': conn.execute('SELECT COUNT(*) FROM sqlite_stat1').fetchone()[0]}
+
+
+def optimize(conn, _deadline):
+    """
+    Lets SQLite analyze the tables whose statistics are out of date.
+    :return: effect of the run
+    """
+    conn.execute(f'PRAGMA analysis_limit={ANALYSIS_LIMIT}')
+    conn.execute('PRAGMA optimize')
+    conn.commit()
+    return {}
+
+
+def checkpoint(conn, _deadline):
+    """
+    Copies the committed WAL frames into the database file without waiting for the readers.
+    :return: effect of the run
+    """
+    busy, wal_frames, checkpointed = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    return {'busy': busy, 'wal_frames': max(wal_frames, 0),
+            'checkpointed_frames': max(checkpointed, 0)}
+
+
+def vacuum(conn, deadline):
+    """
+    Returns free pages to the file system in steps of VACUUM_STEP_PAGES until no page is free
+    or the budget is used up. Databases created before incremental auto vacuum are skipped,
+    converting them takes a full VACUUM.
+    :return: effect of the run
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        return {'skipped': 1}
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    free_before = free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    while free and time.monotonic() < deadline:
+        conn.execute(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})').fetchall()
+        conn.commit()
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return {'pages_freed': free_before - free, 'bytes_freed': (free_before - free) * page_size,
+            'pages_free': free}
+
+
+TASKS = {'checkpoint': checkpoint, 'vacuum': vacuum, 'optimize': optimize, 'analyze': analyze}
+
+
+def run_task(task, db_file, budget_seconds):
+    """
+    Runs one task on one database file. A statement still running when the budget is used up
+    is interrupted and rolled back.
+    :param task: name of the task
+    :param db_file: path of the database file
+    :param budget_seconds: time budget of the run
+    :return: dict with the duration and the effect of the run
+    """
+    start = time.monotonic()
+    deadline = start + budget_seconds
+    conn = connect(db_file)
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_HANDLER_INSTRUCTIONS)
+    try:
+        result = TASKS[task](conn, deadline)
+    except sqlite3.OperationalError as e:
+        if 'interrupted' not in str(e):
+            raise
+        conn.rollback()
+        result = {'interrupted': 1}
+    finally:
+        conn.close()
+    result['seconds'] = time.monotonic() - start
+    metrics.increment(f'maintenance.{task}.runs')
+    for name, value in result.items():
+        metrics.increment(f'maintenance.{task}.{name}', value)
+    return result
+
+
+class MaintenanceScheduler:
+    """
+    Background thread which runs every task when its interval has passed.
+    """
+
+    def __init__(self, get_files, intervals=None, budgets=None):
+        """
+        :param get_files: callable which returns the paths of the database files to maintain
+        :param intervals: seconds between the runs by task, overrides MAINTENANCE_INTERVALS_SECONDS
+        :param budgets: time budget by task, overrides MAINTENANCE_BUDGET_SECONDS
+        """
+        self.get_files = get_files
+        self.intervals = {**MAINTENANCE_INTERVALS_SECONDS, **(intervals or {})}
+        self.budgets = {**MAINTENANCE_BUDGET_SECONDS, **(budgets or {})}
+        now = time.monotonic()
+        self.next_runs = {task: now + interval for task, interval in self.intervals.items()}
+        self.last_runs = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def run_pending(self, now=None):
+        """
+        Runs the tasks which are due on all database files.
+        :param now: time.monotonic() of the check
+        :return: list of the tasks which ran
+        """
+        now = time.monotonic() if now is None else now
+        due = [task for task, next_run in self.next_runs.items() if next_run <= now]
+        for task in due:
+            self.next_runs[task] = now + self.intervals[task]
+            for db_file in self.get_files():
+                try:
+                    result = run_task(task, db_file, self.budgets[task])
+                except sqlite3.Error as e:
+                    metrics.increment(f'maintenance.{task}.errors')
+                    logging.error('Maintenance %s of %s failed: %s', task, db_file, e)
+                    continue
+                self.last_runs.setdefault(task, {})[db_file] = {**result, 'ran_at': time.time()}
+                logging.info('Maintenance %s of %s: %s', task, db_file, result)
+        return due
+
+    def _run(self):
+        while not self.stop_event.wait(max(0.0, min(self.next_runs.values()) - time.monotonic())):
+            self.run_pending()
+
+    def start(self):
+        """
+        Starts the background thread.
+        """
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread after the running task.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def register_maintenance(app, get_files):
+    """
+    Registers a MaintenanceScheduler on an app, started by the first request the process
+    serves. So it runs in every serving process, a WSGI worker or the child of the debug
+    reloader, and never in the reloader parent, which serves no requests.
+    With MAINTENANCE_ENABLED set to False it is not started.
+    :param app: flask app
+    :param get_files: callable which returns the paths of the database files to maintain
+    :return: MaintenanceScheduler
+    """
+    app.config.setdefault('MAINTENANCE_ENABLED', True)
+    scheduler = MaintenanceScheduler(get_files)
+    lock = threading.Lock()
+
+    def start_maintenance():
+        if scheduler.thread is None and app.config['MAINTENANCE_ENABLED']:
+            with lock:
+                if scheduler.thread is None:
+                    scheduler.start()
+
+    app.before_request(start_maintenance)
+    app.extensions['maintenance'] = scheduler
+    return scheduler
@@ -0,0 +1,744 @@
+"""
+This module contains an in-memory storage engine and DAOs on top of it with the same
+methods as BookDao, UserDao and RentedBookDao. The tables are dicts with secondary indexes,
+and the whole storage can be written to and loaded from a JSON snapshot file.
+"""
+import heapq
+import json
+import os
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+import table_versions
+from book import Book
+from password_hashing import hash_password
+from rent_book import RentedBook
+from tracing import trace_methods
+from user import User
+from waitlist import Waitlist
+
+
+class MemoryStorage:  # pylint: disable=too-many-instance-attributes
+    """
+    This class holds the books, users and rented books of the in-memory engine.
+    """
+
+    def __init__(self, snapshot_file=None):
+        self.snapshot_file = snapshot_file
+        self.lock = threading.RLock()
+        self.books = {}
+        self.book_ids_by_isbn = {}
+        self.users = {}
+        self.user_ids_by_username = {}
+        self.last_user_id = 0
+        self.rented_books = {}
+        self.rent_ids_by_user_id = {}
+        self.rental_counts_by_book_id = Counter()
+        # book id -> (rent id of the current loan or None, version), like book_loans
+        self.book_loans = {}
+        self.last_rent_id = 0
+        # hold id -> (id, book id, user id, priority, requested at, status, rent id), like holds
+        self.holds = {}
+        self.last_hold_id = 0
+        # book id -> Waitlist of its waiting holds, (book id, user id) -> id of the waiting hold
+        self.waitlists = {}
+        self.waiting_hold_ids = {}
+        if snapshot_file and os.path.exists(snapshot_file):
+            self.load(snapshot_file)
+
+    def save(self, snapshot_file=None):
+        """
+        Writes the storage to a JSON snapshot file, the old snapshot is replaced atomically.
+        :param snapshot_file: path of the snapshot, defaults to the file given on creation
+        """
+        snapshot_file = snapshot_file or self.snapshot_file
+        if not snapshot_file:
+            return
+        with self.lock:
+            data = {
+                'books': [list(row) for row in self.books.values()],
+                'users': [list(row) for row in self.users.values()],
+                'last_user_id': self.last_user_id,
+                'rented_books': [list(row) for row in self.rented_books.values()],
+                'last_rent_id': self.last_rent_id,
+                'holds': [list(row) for row in self.holds.values()],
+            }
+        with open(f'{snapshot_file}.tmp', 'w', encoding='utf-8') as file:
+            json.dump(data, file)
+        os.replace(f'{snapshot_file}.tmp', snapshot_file)
+
+    def load(self, snapshot_file):
+        """
+        Replaces the content of the storage with a JSON snapshot file.
+        :param snapshot_file: path of the snapshot
+        """
+        with open(snapshot_file, encoding='utf-8') as file:
+            data = json.load(file)
+        with self.lock:
+            self.books = {row[0]: tuple(row) for row in data['books']}
+            self.book_ids_by_isbn = {row[1]: row[0] for row in self.books.values()}
+            self.users = {row[0]: tuple(row) for row in data['users']}
+            self.user_ids_by_username = {row[1]: row[0] for row in self.users.values()}
+            self.last_user_id = data['last_user_id']
+            self.rented_books = {row[0]: tuple(row) for row in data['rented_books']}
+            self.rent_ids_by_user_id = {}
+            for rent_id, user_id, _, _ in self.rented_books.values():
+                self.rent_ids_by_user_id.setdefault(user_id, set()).add(rent_id)
+            self.rental_counts_by_book_id = Counter(row[2] for row in self.rented_books.values())
+            self.book_loans = {row[2]: (row[0], 1) for row in self.rented_books.values() if row[3]}
+            self.last_rent_id = data['last_rent_id']
+            # Snapshots written before the holds have none
+            self.holds = {row[0]: tuple(row) for row in data.get('holds', [])}
+            self.last_hold_id = max(self.holds, default=0)
+            self.waitlists = {}
+            self.waiting_hold_ids = {}
+            waiting = sorted((row for row in self.holds.values() if row[5] == 'waiting'),
+                             key=lambda row: (-row[3], row[4], row[0]))
+            for hold_id, book_id, user_id, priority, _, _, _ in waiting:
+                self.waitlists.setdefault(book_id, Waitlist()).push(hold_id, priority)
+                self.waiting_hold_ids[(book_id, user_id)] = hold_id
+
+
+@trace_methods
+class MemoryBookDao:
+    """
+    This class offers the methods of BookDao on a MemoryStorage.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def create_table(self):
+        """
+        Empties the books table.
+        """
+        with self.storage.lock:
+            self.storage.books.clear()
+            self.storage.book_ids_by_isbn.clear()
+        table_versions.bump('books')
+
+    def add_book(self, book):
+        """
+        Adds a book.
+        :param book: Book instance
+        :return: True if added, False if a book with the same id or isbn exists
+        """
+        with self.storage.lock:
+            if book.id in self.storage.books or book.isbn in self.storage.book_ids_by_isbn:
+                return False
+            self.storage.books[book.id] = (book.id, book.isbn, book.title, book.author)
+            self.storage.book_ids_by_isbn[book.isbn] = book.id
+        table_versions.bump('books')
+        return True
+
+    def get_all_books(self, sort_by_author=False, sort_by_title=True, fields=None):
+        """
+        Returns all books sorted like BookDao.get_all_books.
+        :param sort_by_author: Sort books by author if True (optional).
+        :param sort_by_title: Sort books by title if True (optional).
+        :param fields: Tuple of field names to return (optional).
+        :return: A sorted list of book objects, or a list of dicts if fields is given.
+        """
+        with self.storage.lock:
+            rows = list(self.storage.books.values())
+        rows.sort(key=lambda row: (row[3] if sort_by_author else '',
+                                   row[2] if sort_by_title else '', row[0]))
+        books = [Book(*row) for row in rows]
+        if fields:
+            return [{field: getattr(book, field) for field in fields} for book in books]
+        return books
+
+    def get_book_by_id(self, book_id):
+        """
+        Returns a book by its id.
+        :param book_id: int
+        :return: Book instance or None
+        """
+        row = self.storage.books.get(book_id)
+        return Book(*row) if row else None
+
+    def get_books_by_ids(self, book_ids):
+        """
+        Returns several books by their ids.
+        :param book_ids: iterable of book ids
+        :return: dict of book id to Book
+        """
+        with self.storage.lock:
+            return {book_id: Book(*self.storage.books[book_id])
+                    for book_id in book_ids if book_id in self.storage.books}
+
+    def get_existing_book_ids(self, book_ids):
+        """
+        Tells which of many book ids exist.
+        :param book_ids: iterable of book ids
+        :return: set of the existing ids
+        """
+        with self.storage.lock:
+            return {book_id for book_id in book_ids if book_id in self.storage.books}
+
+    def get_existing_isbns(self, isbns):
+        """
+        Tells which of many isbns exist through the isbn index.
+        :param isbns: iterable of isbns
+        :return: set of the existing isbns
+        """
+        with self.storage.lock:
+            return {isbn for isbn in isbns if isbn in self.storage.book_ids_by_isbn}
+
+    def delete_book_by_id(self, book_id):
+        """
+        Deletes a book by its id.
+        :param book_id: int
+        :return: True if deleted, False if not found
+        """
+        with self.storage.lock:
+            row = self.storage.books.pop(book_id, None)
+            if row is None:
+                return False
+            del self.storage.book_ids_by_isbn[row[1]]
+        table_versions.bump('books')
+        return True
+
+    def update_book(self, updated_book):
+        """
+        Updates a book.
+        :param updated_book: Book instance with updated data
+        :return: True if updated, False if not found or the isbn belongs to another book
+        """
+        with self.storage.lock:
+            row = self.storage.books.get(updated_book.id)
+            owner = self.storage.book_ids_by_isbn.get(updated_book.isbn, updated_book.id)
+            if row is None or owner != updated_book.id:
+                return False
+            del self.storage.book_ids_by_isbn[row[1]]
+            self.storage.books[updated_book.id] = (updated_book.id, updated_book.isbn,
+                                                   updated_book.title, updated_book.author)
+            self.storage.book_ids_by_isbn[updated_book.isbn] = updated_book.id
+        table_versions.bump('books')
+        return True
+
+    def close(self):
+        """
+        Writes the snapshot of the storage.
+        """
+        self.storage.save()
+
+    def drop_table(self):
+        """
+        Empties the books table.
+        """
+        self.create_table()
+
+
+@trace_methods
+class MemoryUserDao:
+    """
+    This class offers the methods of UserDao on a MemoryStorage.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def create_table(self):
+        """
+        Empties the users table.
+        """
+        with self.storage.lock:
+            self.storage.users.clear()
+            self.storage.user_ids_by_username.clear()
+            self.storage.last_user_id = 0
+        table_versions.bump('users')
+
+    def add_user(self, user):
+        """
+        Adds a user, the user id is assigned like an AUTOINCREMENT column.
+        :param user: dict or User object
+        :return: True if added, False if the username exists
+        """
+        username = user['username'] if isinstance(user, dict) else user.username
+        password = hash_password(user['password'] if isinstance(user, dict) else user.password)
+        with self.storage.lock:
+            if username in self.storage.user_ids_by_username:
+                print('User already exists')
+                return False
+            self.storage.last_user_id += 1
+            user_id = self.storage.last_user_id
+            self.storage.users[user_id] = (user_id, username, password)
+            self.storage.user_ids_by_username[username] = user_id
+        table_versions.bump('users')
+        return True
+
+    def get_all_users(self, fields=None):
+        """
+        Returns all users ordered by id.
+        :param fields: Tuple of field names to return (optional).
+        :return: list of User objects, or a list of dicts if fields is given.
+        """
+        with self.storage.lock:
+            users = [User(*row) for _, row in sorted(self.storage.users.items())]
+        if fields:
+            return [{field: getattr(user, field) for field in fields} for user in users]
+        return users
+
+    def get_one_user(self, user_id):
+        """
+        Returns a user by its id.
+        """
+        row = self.storage.users.get(user_id)
+        return User(*row) if row else None
+
+    def get_users_by_ids(self, user_ids):
+        """
+        Returns several users by their ids.
+        :param user_ids: iterable of user ids
+        :return: dict of user id to User
+        """
+        with self.storage.lock:
+            return {user_id: User(*self.storage.users[user_id])
+                    for user_id in user_ids if user_id in self.storage.users}
+
+    def get_user_by_username(self, username):
+        """
+        Returns a user by its username.
+        """
+        return self.get_one_user(self.storage.user_ids_by_username.get(username))
+
+    def get_existing_usernames(self, usernames):
+        """
+        Tells which of many usernames exist through the username index.
+        :param usernames: iterable of usernames
+        :return: set of the existing usernames
+        """
+        with self.storage.lock:
+            return {username for username in usernames
+                    if username in self.storage.user_ids_by_username}
+
+    def delete_user_by_id(self, user_id):
+        """
+        Deletes a user by its id.
+        """
+        with self.storage.lock:
+            row = self.storage.users.pop(user_id, None)
+            if row is None:
+                return False
+            del self.storage.user_ids_by_username[row[1]]
+        table_versions.bump('users')
+        return True
+
+    def update_user(self, updated_user):
+        """
+        Updates a user.
+        :return: True if updated, False if not found or the username belongs to another user
+        """
+        # Hashed before the lock, the scrypt work would stall every other storage access
+        password = hash_password(updated_user.password)
+        with self.storage.lock:
+            row = self.storage.users.get(updated_user.user_id)
+            owner = self.storage.user_ids_by_username.get(updated_user.username,
+                                                          updated_user.user_id)
+            if row is None or owner != updated_user.user_id:
+                return False
+            del self.storage.user_ids_by_username[row[1]]
+            self.storage.users[updated_user.user_id] = (updated_user.user_id,
+                                                        updated_user.username, password)
+            self.storage.user_ids_by_username[updated_user.username] = updated_user.user_id
+        table_versions.bump('users')
+        return True
+
+    def close(self):
+        """
+        Writes the snapshot of the storage.
+        """
+        self.storage.save()
+
+    def drop_table(self):
+        """
+        Empties the users table.
+        """
+        self.create_table()
+        return True
+
+
+@trace_methods
+class MemoryRentedBookDao:  # pylint: disable=too-many-public-methods
+    """
+    This class offers the methods of RentedBookDao on a MemoryStorage.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.user_dao = MemoryUserDao(storage)
+        self.book_dao = MemoryBookDao(storage)
+
+    def _to_rented_book(self, row):
+        return RentedBook(id=row[0], user=self.user_dao.get_one_user(row[1]),
+                          book=self.book_dao.get_book_by_id(row[2]), rented=bool(row[3]))
+
+    def _uncount_book(self, book_id):
+        counts = self.storage.rental_counts_by_book_id
+        counts[book_id] -= 1
+        if counts[book_id] <= 0:
+            del counts[book_id]
+
+    def _lend(self, book_id, rent_id):
+        _, version = self.storage.book_loans.get(book_id, (None, 0))
+        self.storage.book_loans[book_id] = (rent_id, version + 1)
+
+    def _take_back(self, book_id, rent_id):
+        loan_rent_id, version = self.storage.book_loans.get(book_id, (None, 0))
+        if loan_rent_id == rent_id:
+            self.storage.book_loans[book_id] = (None, version + 1)
+
+    def create_table(self):
+        """
+        Empties the rented_books table.
+        """
+        with self.storage.lock:
+            self.storage.rented_books.clear()
+            self.storage.rent_ids_by_user_id.clear()
+            self.storage.rental_counts_by_book_id.clear()
+            self.storage.book_loans.clear()
+            self.storage.last_rent_id = 0
+            self.storage.holds.clear()
+            self.storage.waitlists.clear()
+            self.storage.waiting_hold_ids.clear()
+            self.storage.last_hold_id = 0
+        table_versions.bump('rented_books')
+        table_versions.bump('holds')
+
+    def add_rented_book(self, rented_book, keep_id=False):
+        """
+        Adds a rented book.
+        :param rented_book: RentedBook instance
+        :param keep_id: store rented_book.id instead of assigning the next id
+        """
+        with self.storage.lock:
+            if keep_id and rented_book.id in self.storage.rented_books:
+                return False
+            rent_id = rented_book.id if keep_id else self.storage.last_rent_id + 1
+            self.storage.last_rent_id = max(self.storage.last_rent_id, rent_id)
+            user_id = rented_book.user.user_id
+            self.storage.rented_books[rent_id] = (rent_id, user_id, rented_book.book.id,
+                                                  rented_book.rented)
+            self.storage.rent_ids_by_user_id.setdefault(user_id, set()).add(rent_id)
+            self.storage.rental_counts_by_book_id[rented_book.book.id] += 1
+            if rented_book.rented:
+                self._lend(rented_book.book.id, rent_id)
+        table_versions.bump('rented_books')
+        return True
+
+    def get_all_rented_books(self):
+        """
+        Returns all rented books ordered by id.
+        """
+        with self.storage.lock:
+            rows = [row for _, row in sorted(self.storage.rented_books.items())]
+        return [self._to_rented_book(row) for row in rows]
+
+    def get_rent_by_id(self, rent_id):
+        """
+        Returns a rented book by its id.
+        """
+        row = self.storage.rented_books.get(rent_id)
+        return self._to_rented_book(row) if row else None
+
+    def get_rented_books_by_user_id(self, user_id):
+        """
+        Returns all the rented books of a user through the user index.
+        """
+        with self.storage.lock:
+            rows = [self.storage.rented_books[rent_id]
+                    for rent_id in sorted(self.storage.rent_ids_by_user_id.get(user_id, ()))]
+        return [self._to_rented_book(row) for row in rows]
+
+    def get_rentals(self, user_id=None):
+        """
+        Returns the rentals with the ids of their user and book only.
+        :param user_id: only the rentals of this user (optional)
+        :return: list of dicts with id, user_id, book_id and rented, ordered by id
+        """
+        with self.storage.lock:
+            if user_id is None:
+                rent_ids = sorted(self.storage.rented_books)
+            else:
+                rent_ids = sorted(self.storage.rent_ids_by_user_id.get(user_id, ()))
+            rows = [self.storage.rented_books[rent_id] for rent_id in rent_ids]
+        return [{'id': row[0], 'user_id': row[1], 'book_id': row[2], 'rented': bool(row[3])}
+                for row in rows]
+
+    def delete_rented_book(self, rent_id):
+        """
+        Deletes a rented book by its id.
+        """
+        with self.storage.lock:
+            row = self.storage.rented_books.pop(rent_id, None)
+            if row is None:
+                return False
+            self.storage.rent_ids_by_user_id[row[1]].discard(rent_id)
+            self._uncount_book(row[2])
+            self._take_back(row[2], rent_id)
+        table_versions.bump('rented_books')
+        return True
+
+    def delete_rented_book_by_user_id(self, user_id):
+        """
+        Deletes all rented books of a user.
+        """
+        with self.storage.lock:
+            rent_ids = self.storage.rent_ids_by_user_id.pop(user_id, set())
+            for rent_id in rent_ids:
+                book_id = self.storage.rented_books.pop(rent_id)[2]
+                self._uncount_book(book_id)
+                self._take_back(book_id, rent_id)
+        if not rent_ids:
+            return False
+        table_versions.bump('rented_books')
+        return True
+
+    def update_rented_book(self, rented_book):
+        """
+        Updates the rented flag of a rented book. A rental is only lent again while its book
+        is not out with another rental.
+        """
+        with self.storage.lock:
+            row = self.storage.rented_books.get(rented_book.id)
+            if row is None:
+                return False
+            loan_rent_id, _ = self.storage.book_loans.get(row[2], (None, 0))
+            if rented_book.rented and loan_rent_id not in (None, row[0]):
+                return False
+            self.storage.rented_books[rented_book.id] = row[:3] + (rented_book.rented,)
+            if rented_book.rented and not row[3]:
+                self._lend(row[2], row[0])
+            elif row[3] and not rented_book.rented:
+                self._take_back(row[2], row[0])
+            table_versions.bump('rented_books')
+            if not rented_book.rented:
+                self.assign_next_hold(row[2])
+        return True
+
+    def get_rental_book_id(self, rent_id):
+        """
+        Returns the book of a rental.
+        :param rent_id: int
+        :return: book id, None if the rental does not exist
+        """
+        row = self.storage.rented_books.get(rent_id)
+        return row[2] if row else None
+
+    def _hold_to_dict(self, row):
+        waitlist = self.storage.waitlists.get(row[1])
+        position = waitlist.position(row[0]) if waitlist and row[5] == 'waiting' else None
+        return {'id': row[0], 'book_id': row[1], 'user_id': row[2], 'priority': row[3],
+                'requested_at': row[4], 'status': row[5], 'rent_id': row[6], 'position': position}
+
+    def _end_hold(self, hold_id, status, rent_id=None):
+        row = self.storage.holds.get(hold_id)
+        if row is None or row[5] != 'waiting':
+            return False
+        self.storage.holds[hold_id] = row[:5] + (status, rent_id)
+        self.storage.waitlists[row[1]].remove(hold_id)
+        del self.storage.waiting_hold_ids[(row[1], row[2])]
+        table_versions.bump('holds')
+        return True
+
+    def add_hold(self, book_id, user_id, priority=0):
+        """
+        Puts a user on the waitlist of a book.
+        :param book_id: int
+        :param user_id: int
+        :param priority: int from 0 to MAX_HOLD_PRIORITY, higher is served first
+        :return: dict of the hold with its position, None if the user already waits for the book
+        """
+        with self.storage.lock:
+            if (book_id, user_id) in self.storage.waiting_hold_ids:
+                return None
+            self.storage.last_hold_id += 1
+            hold_id = self.storage.last_hold_id
+            requested_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+            row = self.storage.holds[hold_id] = (hold_id, book_id, user_id, priority, requested_at,
+                                                 'waiting', None)
+            self.storage.waitlists.setdefault(book_id, Waitlist()).push(hold_id, priority)
+            self.storage.waiting_hold_ids[(book_id, user_id)] = hold_id
+            table_versions.bump('holds')
+            return self._hold_to_dict(row)
+
+    def get_hold(self, hold_id):
+        """
+        Returns a hold with its position in the waitlist of its book.
+        :param hold_id: int
+        :return: dict, None if the hold does not exist
+        """
+        with self.storage.lock:
+            row = self.storage.holds.get(hold_id)
+            return self._hold_to_dict(row) if row else None
+
+    def get_next_hold(self, book_id):
+        """
+        Returns the hold which is served next for a book.
+        :param book_id: int
+        :return: dict, None if nobody waits for the book
+        """
+        with self.storage.lock:
+            waitlist = self.storage.waitlists.get(book_id)
+            hold_id = waitlist.peek() if waitlist else None
+            return None if hold_id is None else self.get_hold(hold_id)
+
+    def get_waitlist(self, book_id, limit=100):
+        """
+        Returns the waiting holds of a book in serving order.
+        :param book_id: int
+        :param limit: number of holds
+        :return: list of dicts with their positions
+        """
+        with self.storage.lock:
+            waitlist = self.storage.waitlists.get(book_id)
+            if not waitlist:
+                return []
+            holds = (self.storage.holds[hold_id] for hold_id in waitlist.slots)
+            rows = heapq.nsmallest(limit, holds, key=lambda row: (-row[3], row[4], row[0]))
+            return [self._hold_to_dict(row) for row in rows]
+
+    def cancel_hold(self, hold_id):
+        """
+        Takes a waiting hold off the waitlist of its book.
+        :param hold_id: int
+        :return: True if cancelled, False if the hold does not exist or no longer waits
+        """
+        with self.storage.lock:
+            return self._end_hold(hold_id, 'cancelled')
+
+    def assign_hold(self, hold_id, rent_id):
+        """
+        Marks a waiting hold as served by a rental.
+        :param hold_id: int
+        :param rent_id: id of the rental of the held book
+        :return: True if assigned, False if the hold does not exist or no longer waits
+        """
+        with self.storage.lock:
+            return self._end_hold(hold_id, 'assigned', rent_id)
+
+    def assign_next_hold(self, book_id):
+        """
+        Rents a book to the user of its next hold if the book is not out.
+        :param book_id: int
+        :return: dict of the assigned hold, None if nobody waits or the book is out
+        """
+        with self.storage.lock:
+            hold = self.get_next_hold(book_id)
+            if hold is None:
+                return None
+            rent_id = self.check_out(hold['user_id'], book_id)
+            if rent_id is None:
+                return None
+            self.assign_hold(hold['id'], rent_id)
+            return self.get_hold(hold['id'])
+
+    def check_out(self, user_id, book_id, version=None):
+        """
+        Rents a book to a user unless it is already out or its version changed.
+        :param user_id: int
+        :param book_id: int
+        :param version: version of the book read by the caller (optional)
+        :return: id of the new rental or None
+        """
+        with self.storage.lock:
+            rent_id, current_version = self.storage.book_loans.get(book_id, (None, 0))
+            if rent_id is not None or version not in (None, current_version):
+                return None
+            self.add_rented_book(RentedBook(None, User(user_id, None, None),
+                                            Book(book_id, None, None, None), True))
+            return self.storage.last_rent_id
+
+    def return_book(self, rent_id):
+        """
+        Returns a rented book.
+        :param rent_id: int
+        :return: True if returned, False if not found or returned before
+        """
+        with self.storage.lock:
+            row = self.storage.rented_books.get(rent_id)
+            if row is None or not row[3]:
+                return False
+            return self.update_rented_book(RentedBook(rent_id, None, None, False))
+
+    def get_book_loan(self, book_id):
+        """
+        Returns whether a book is out and its version for check_out.
+        :param book_id: int
+        :return: dict with book_id, available, rent_id and version
+        """
+        rent_id, version = self.storage.book_loans.get(book_id, (None, 0))
+        return {'book_id': book_id, 'available': rent_id is None, 'rent_id': rent_id,
+                'version': version}
+
+    def close(self):
+        """
+        Writes the snapshot of the storage.
+        """
+        self.storage.save()
+
+    def drop_table(self):
+        """
+        Empties the rented_books table.
+        """
+        self.create_table()
+
+    def count_rented_books_by_user(self):
+        """
+        Returns the count of rented books by user.
+        :return:
+        """
+        with self.storage.lock:
+            # Every rental counts, returned ones too, like in RentedBookDao. Rentals of deleted
+            # users are left out, RentedBookDao finds no user for them and fails instead
+            return {user_id: len(rent_ids)
+                    for user_id, rent_ids in self.storage.rent_ids_by_user_id.items()
+                    if rent_ids and user_id in self.storage.users}
+
+    def get_most_rented_books(self, limit=10):
+        """
+        Returns the most rented books from the rental counters.
+        :param limit: number of books
+        :return: list of (book_id, rentals) tuples, most rented first
+        """
+        with self.storage.lock:
+            return heapq.nsmallest(limit, self.storage.rental_counts_by_book_id.items(),
+                                   key=lambda item: (-item[1], item[0]))
+
+    def get_most_active_users(self, limit=10):
+        """
+        Returns the users with the most rentals.
+        :param limit: number of users
+        :return: list of (user_id, rentals) tuples, most active first
+        """
+        with self.storage.lock:
+            counts = [(user_id, len(rent_ids))
+                      for user_id, rent_ids in self.storage.rent_ids_by_user_id.items() if rent_ids]
+        return heapq.nsmallest(limit, counts, key=lambda item: (-item[1], item[0]))
+
+    def get_rental_pairs(self):
+        """
+        Returns the user and book of every rental.
+        :return: list of (user_id, book_id) tuples
+        """
+        with self.storage.lock:
+            return [(row[1], row[2]) for row in self.storage.rented_books.values()]
+
+    def count_co_rentals(self, book_id, other_book_ids):
+        """
+        Counts for every other book the users who rented both it and book_id.
+        :param book_id: int
+        :param other_book_ids: ids of the other books
+        :return: dict of other book id to number of users
+        """
+        other_book_ids = set(other_book_ids)
+        counts = {}
+        with self.storage.lock:
+            for rent_ids in self.storage.rent_ids_by_user_id.values():
+                user_book_ids = {self.storage.rented_books[rent_id][2] for rent_id in rent_ids}
+                if book_id in user_book_ids:
+                    for other_book_id in user_book_ids & other_book_ids:
+                        counts[other_book_id] = counts.get(other_book_id, 0) + 1
+        return counts
@@ -0,0 +1,43 @@
+"""
+This module collects simple in-process counters and timings.
+"""
+import threading
+
+_counters = {}
+_lock = threading.Lock()
+
+
+def increment(name, amount=1):
+    """
+    Increments a counter.
+    :param name: name of the counter
+    :param amount: int or float to add
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def get(name):
+    """
+    Returns the current value of a counter.
+    :param name: name of the counter
+    :return: int or float, 0 if the counter does not exist
+    """
+    return _counters.get(name, 0)
+
+
+def snapshot():
+    """
+    Returns a copy of all counters.
+    :return: dict
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    """
+    Resets all counters.
+    """
+    with _lock:
+        _counters.clear()
@@ -0,0 +1,129 @@
+"""
+This module hashes and verifies passwords with scrypt. The hash work runs on a thread pool
+sized to the cores: hashlib.scrypt releases the GIL, so it runs in parallel without blocking
+other routes and without worker processes, which would re-import the app. Successful
+verifications are cached for a short time.
+"""
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# scrypt cost, stored with every hash so it can be raised later without breaking old hashes
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_DKLEN = 32
+SALT_BYTES = 16
+HASH_WORKERS = os.cpu_count() or 1
+VERIFY_CACHE_TTL_SECONDS = 60
+VERIFY_CACHE_SIZE = 10000
+HASH_PREFIX = 'scrypt$'
+
+_pool = {}
+_pool_lock = threading.Lock()
+_verified = OrderedDict()
+_verified_lock = threading.Lock()
+
+
+def _scrypt_hash(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    salt = os.urandom(SALT_BYTES)
+    digest = hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                            dklen=SCRYPT_DKLEN)
+    return f'{HASH_PREFIX}{n}${r}${p}${salt.hex()}${digest.hex()}'
+
+
+def _scrypt_verify(password, stored):
+    if not is_password_hash(stored):
+        # Rows written before passwords were hashed
+        return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8'))
+    n, r, p, salt, digest = stored[len(HASH_PREFIX):].split('$')
+    expected = bytes.fromhex(digest)
+    actual = hashlib.scrypt(password.encode('utf-8'), salt=bytes.fromhex(salt), n=int(n),
+                            r=int(r), p=int(p), dklen=len(expected))
+    return hmac.compare_digest(actual, expected)
+
+
+def _executor():
+    with _pool_lock:
+        if 'executor' not in _pool:
+            _pool['executor'] = ThreadPoolExecutor(max_workers=HASH_WORKERS,
+                                                   thread_name_prefix='scrypt')
+        return _pool['executor']
+
+
+def is_password_hash(value):
+    """
+    Tells whether a stored password is a scrypt hash of this module.
+    :param value: str
+    :return: bool
+    """
+    return isinstance(value, str) and value.startswith(HASH_PREFIX)
+
+
+def hash_password(password):
+    """
+    Hashes a password with a new salt on the thread pool.
+    :param password: str
+    :return: str, scrypt$n$r$p$salt$hash
+    """
+    return _executor().submit(_scrypt_hash, password).result()
+
+
+def verify_password(password, stored):
+    """
+    Checks a password against a stored hash on the thread pool.
+    :param password: str
+    :param stored: str from hash_password
+    :return: bool
+    """
+    return _executor().submit(_scrypt_verify, password, stored).result()
+
+
+# Verified against when the user does not exist, so unknown usernames take as long
+_DUMMY_HASH = (f'{HASH_PREFIX}{SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$'
+               f'{"00" * SALT_BYTES}${"00" * SCRYPT_DKLEN}')
+
+
+def check_credentials(user, password):
+    """
+    Checks the password of a user, successful checks are cached for VERIFY_CACHE_TTL_SECONDS.
+    The cache key is a SHA-256 over the user, the password and the stored hash, so the cache
+    never holds a password and a changed password never matches an old entry.
+    :param user: User or None
+    :param password: str
+    :return: bool
+    """
+    if user is None:
+        verify_password(password, _DUMMY_HASH)
+        return False
+    key = hashlib.sha256(f'{user.user_id}\0{user.password}\0{password}'.encode('utf-8')).digest()
+    now = time.monotonic()
+    with _verified_lock:
+        expires = _verified.get(key)
+        if expires is not None and expires > now:
+            _verified.move_to_end(key)
+            metrics.increment('password_cache.hits')
+            return True
+    metrics.increment('password_cache.misses')
+    if not verify_password(password, user.password):
+        return False
+    with _verified_lock:
+        _verified[key] = now + VERIFY_CACHE_TTL_SECONDS
+        _verified.move_to_end(key)
+        while len(_verified) > VERIFY_CACHE_SIZE:
+            _verified.popitem(last=False)
+    return True
+
+
+def clear_cache():
+    """
+    Forgets all cached verifications.
+    """
+    with _verified_lock:
+        _verified.clear()
@@ -0,0 +1,40 @@
+"""
+This module contains helpers for narrowing responses to a subset of dataclass fields.
+"""
+from dataclasses import fields
+
+
+def parse_fields(raw_fields, model, hidden=()):
+    """
+    Parses a comma separated ``fields=`` query parameter against a dataclass.
+    :param raw_fields: str or None, e.g. "id,title"
+    :param model: dataclass the fields have to belong to
+    :param hidden: fields of the dataclass which are never returned, e.g. ("password",)
+    :return: tuple of field names in the order of the dataclass, or None for all fields
+    :raises ValueError: if a field does not exist on the dataclass or is hidden
+    """
+    if not raw_fields:
+        return None
+    requested = {name.strip() for name in raw_fields.split(',') if name.strip()}
+    if not requested:
+        return None
+    known = [field.name for field in fields(model) if field.name not in hidden]
+    unknown = requested.difference(known)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(name for name in known if name in requested)
+
+
+def parse_expand(raw_expand, allowed):
+    """
+    Parses a comma separated ``expand=`` query parameter, e.g. "user,book".
+    :param raw_expand: str or None
+    :param allowed: names of the nested objects which can be expanded
+    :return: frozenset of the requested names, empty if none
+    :raises ValueError: if a name cannot be expanded
+    """
+    requested = frozenset(name.strip() for name in (raw_expand or '').split(',') if name.strip())
+    unknown = requested.difference(allowed)
+    if unknown:
+        raise ValueError(f"Unknown expansions: {', '.join(sorted(unknown))}")
+    return requested
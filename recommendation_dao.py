@@ -0,0 +1,175 @@
+"""
+This module contains the data access object for "readers who borrowed this also borrowed".
+The top k co-rented books of every book are precomputed into book_similarities: in batch
+from all rentals with vectorized NumPy operations, and incrementally for every new rental.
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+
+import table_versions
+from db import connect, data_file, ReadOnlyPool
+from tracing import trace_methods
+
+RECOMMENDATION_DB_NAME = data_file('recommendations.db')
+SIMILAR_BOOKS_TOP_K = 10
+
+RECOMMENDATION_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS book_similarities (
+        book_id INTEGER NOT NULL,
+        rank INTEGER NOT NULL,
+        similar_book_id INTEGER NOT NULL,
+        co_rentals INTEGER NOT NULL,
+        PRIMARY KEY (book_id, rank)
+    ) WITHOUT ROWID
+'''
+
+
+def build_similar_books(user_ids, book_ids, top_k=SIMILAR_BOOKS_TOP_K):  # pylint: disable=too-many-locals
+    """
+    Computes the top k co-rented books of every book from rentals given as two parallel
+    sequences. Two books are co-rented by every user who rented both of them.
+    The user x book matrix M is kept sparse as its sorted non-zero cells, and the item-item
+    co-occurrence M^T M is computed by expanding every user row into its book pairs.
+    Memory grows with the sum of the squared number of distinct books per user.
+    :param user_ids: user id of every rental
+    :param book_ids: book id of every rental
+    :param top_k: number of similar books kept per book
+    :return: arrays book_id, rank, similar_book_id and co_rentals, ordered by book_id and rank
+    """
+    users = np.asarray(user_ids, dtype=np.int64)
+    books = np.asarray(book_ids, dtype=np.int64)
+    if users.size == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty, empty
+    book_keys, book_index = np.unique(books, return_inverse=True)
+    n_books = len(book_keys)
+    _, user_index = np.unique(users, return_inverse=True)
+    # One cell per distinct (user, book), sorted by user and then book
+    rows, cols = np.divmod(np.unique(user_index * n_books + book_index), n_books)
+
+    row_starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    row_sizes = np.diff(np.r_[row_starts, len(rows)])
+    # Every cell is paired with every cell of its row, the cell itself included
+    cell_row_sizes = np.repeat(row_sizes, row_sizes)
+    left = np.repeat(np.arange(len(rows)), cell_row_sizes)
+    offsets = np.arange(len(left)) - np.repeat(np.cumsum(cell_row_sizes) - cell_row_sizes,
+                                               cell_row_sizes)
+    right = np.repeat(np.repeat(row_starts, row_sizes), cell_row_sizes) + offsets
+    pairs = left != right
+    pair_keys, co_rentals = np.unique(cols[left[pairs]] * n_books + cols[right[pairs]],
+                                      return_counts=True)
+    book, similar = np.divmod(pair_keys, n_books)
+
+    order = np.lexsort((similar, -co_rentals, book))
+    book, similar, co_rentals = book[order], similar[order], co_rentals[order]
+    group_starts = np.flatnonzero(np.r_[True, book[1:] != book[:-1]])
+    ranks = np.arange(len(book)) - np.repeat(group_starts,
+                                             np.diff(np.r_[group_starts, len(book)]))
+    top = ranks < top_k
+    return book_keys[book[top]], ranks[top], book_keys[similar[top]], co_rentals[top]
+
+
+@trace_methods
+class RecommendationDao:
+    """
+    This class stores and reads the precomputed similar books.
+    """
+
+    def __init__(self, db_file=RECOMMENDATION_DB_NAME, top_k=SIMILAR_BOOKS_TOP_K):
+        self.top_k = top_k
+        self.conn = connect(db_file)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute(RECOMMENDATION_SCHEMA)
+        self.conn.commit()
+        self.readers = ReadOnlyPool(db_file, self.conn)
+        # Incremental updates read, merge and rewrite the lists of several books
+        self.lock = threading.Lock()
+
+    def rebuild(self, rentals):
+        """
+        Replaces all similar books with a batch build over all rentals.
+        :param rentals: list of (user_id, book_id) tuples
+        :return: number of stored similar books
+        """
+        user_ids, book_ids = zip(*rentals) if rentals else ((), ())
+        columns = build_similar_books(user_ids, book_ids, self.top_k)
+        rows = list(zip(*(column.tolist() for column in columns)))
+        with self.lock:
+            self.cursor.execute('DELETE FROM book_similarities')
+            self.cursor.executemany(
+                'INSERT INTO book_similarities (book_id, rank, similar_book_id, co_rentals) '
+                'VALUES (?, ?, ?, ?)', rows)
+            self.conn.commit()
+        table_versions.bump('book_similarities')
+        return len(rows)
+
+    def record_co_rentals(self, book_id, co_rentals):
+        """
+        Merges the new co-rental counts of a book into the stored lists after a rental.
+        Counts only grow on a rental, so merging the changed pairs keeps every top k exact;
+        returned books are only accounted for by the next rebuild.
+        :param book_id: the rented book
+        :param co_rentals: dict of the other books of the user to their co-rental count
+        """
+        updates = {book_id: co_rentals}
+        for other_book_id, count in co_rentals.items():
+            updates.setdefault(other_book_id, {})[book_id] = count
+        with self.lock:
+            for target, counts in updates.items():
+                current = dict(self.cursor.execute(
+                    'SELECT similar_book_id, co_rentals FROM book_similarities WHERE book_id = ?',
+                    (target,)).fetchall())
+                current.update(counts)
+                top = sorted(current.items(), key=lambda item: (-item[1], item[0]))[:self.top_k]
+                self.cursor.execute('DELETE FROM book_similarities WHERE book_id = ?', (target,))
+                self.cursor.executemany(
+                    'INSERT INTO book_similarities (book_id, rank, similar_book_id, co_rentals) '
+                    'VALUES (?, ?, ?, ?)',
+                    [(target, rank, similar, count) for rank, (similar, count) in enumerate(top)])
+            self.conn.commit()
+        table_versions.bump('book_similarities')
+
+    def get_similar_books(self, book_id, limit=SIMILAR_BOOKS_TOP_K):
+        """
+        Returns the precomputed similar books of a book along the primary key.
+        :param book_id: int
+        :param limit: maximum number of books
+        :return: list of (similar_book_id, co_rentals) tuples, most co-rented first
+        """
+        with self.readers.connection() as conn:
+            return conn.execute('SELECT similar_book_id, co_rentals FROM book_similarities '
+                                'WHERE book_id = ? ORDER BY rank LIMIT ?',
+                                (book_id, limit)).fetchall()
+
+    def close(self):
+        """
+        Closes the connection to the database.
+        """
+        self.readers.close()
+        self.conn.close()
+
+
+def benchmark(rental_count, user_count, book_count, top_k=SIMILAR_BOOKS_TOP_K, seed=0):
+    """
+    Times build_similar_books on random rentals with a skewed book popularity.
+    :return: seconds of the batch build
+    """
+    rng = np.random.default_rng(seed)
+    user_ids = rng.integers(0, user_count, rental_count)
+    book_ids = (rng.zipf(1.3, rental_count) - 1) % book_count
+    start = time.perf_counter()
+    build_similar_books(user_ids, book_ids, top_k)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the batch build of the similar books.')
+    parser.add_argument('--rentals', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--books', type=int, default=20_000)
+    args = parser.parse_args()
+    seconds = benchmark(args.rentals, args.users, args.books)
+    print(f'{args.rentals} rentals, {args.users} users, {args.books} books: {seconds:.2f} s')
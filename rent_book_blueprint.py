@@ -2,19 +2,32 @@
 This module contains the blueprint for the rent book API.
 """
 import logging
+import sqlite3
 
 # pylint: disable=no-else-return,broad-exception-caught,logging-fstring-interpolation
 from flask import Blueprint, request, jsonify
 
 from book import Book
+from branches import BranchLocal
+from projection import parse_expand
+from recommendation_dao import RecommendationDao, SIMILAR_BOOKS_TOP_K
+from response_cache import cached_response
 from rent_book import RentedBook
-from rent_book_dao import RentedBookDao, RENTED_BOOK_DB_NAME
+from storage import create_rented_book_dao
+from tracing import traced
 from user import User
+from waitlist import MAX_HOLD_PRIORITY
 
 rent_book_blueprint = Blueprint('rent_book_blueprint', __name__)
-rent_book_dao = RentedBookDao(db_file=RENTED_BOOK_DB_NAME)
+rent_book_dao = BranchLocal('rent_book_dao', create_rented_book_dao())
+recommendation_dao = BranchLocal('recommendation_dao', RecommendationDao())
 
+MAX_POPULAR_BOOKS = 100
+RENTAL_EXPANSIONS = ('user', 'book')
+MAX_WAITLIST = 100
 
+
+@traced('serialize_data')
 def serialize_data(data):
     """Convert data recursively to JSON-compatible format."""
     if isinstance(data, dict):
@@ -33,19 +46,39 @@ def handle_bytes_and_custom_objects(data):
     return data
 
 
+def expand_rentals(rentals, expand):
+    """
+    Adds the user (without password) and/or the book to compact rentals, with one batched
+    lookup per entity type.
+    :param rentals: list of dicts from get_rentals
+    :param expand: names from parse_expand
+    :return: the rentals
+    """
+    if 'user' in expand:
+        users = rent_book_dao.user_dao.get_users_by_ids({rental['user_id'] for rental in rentals})
+        for rental in rentals:
+            user = users.get(rental['user_id'])
+            rental['user'] = user.public_dict() if user else None
+    if 'book' in expand:
+        books = rent_book_dao.book_dao.get_books_by_ids({rental['book_id'] for rental in rentals})
+        for rental in rentals:
+            rental['book'] = serialize_data(books.get(rental['book_id']))
+    return rentals
+
+
 @rent_book_blueprint.route('/rented_books', methods=['GET'])
+@cached_response('rented_books', 'users', 'books')
 def get_all_rented_books():
     """
-    This method returns all the rented books from the database.
+    This method returns all the rented books from the database with the ids of their user
+    and book. ?expand=user,book adds the user and/or the book.
     :return:
     """
-    rented_books = rent_book_dao.get_all_rented_books()
     try:
-        rented_books_dict = [serialize_data(book) for book in rented_books]
-        return jsonify(rented_books_dict), 200
-    except TypeError as e:
-        print(f"Serialization error: {e}")  # Log the error to locate problematic data
-        return jsonify({"error": "Data serialization issue"}), 500
+        expand = parse_expand(request.args.get('expand'), RENTAL_EXPANSIONS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    return jsonify(expand_rentals(rent_book_dao.get_rentals(), expand)), 200
 
 
 @rent_book_blueprint.route('/rented_books/<int:rent_id>', methods=['GET'])
@@ -57,7 +90,8 @@ def get_rented_book_by_id(rent_id):
     """
     rented_book = rent_book_dao.get_rent_by_id(rent_id)
     if rented_book:
-        return jsonify(rented_book.__dict__), 200
+        user = rented_book.user.public_dict() if rented_book.user else None
+        return jsonify({**serialize_data(rented_book), 'user': user}), 200
     else:
         return jsonify({'message': 'Rented book not found'}), 404
 
@@ -65,15 +99,20 @@ def get_rented_book_by_id(rent_id):
 @rent_book_blueprint.route('/rented_books_by_user_id/<int:user_id>', methods=['GET'])
 def get_rented_books_by_user_id(user_id):
     """
-    This method returns all the rented books by user id.
+    This method returns all the rented books by user id, compact like /rented_books and
+    with the same ?expand=user,book.
     :param user_id:
     :return:
     """
     try:
-        rented_books = rent_book_dao.get_rented_books_by_user_id(user_id)
-        if not rented_books:
+        expand = parse_expand(request.args.get('expand'), RENTAL_EXPANSIONS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    try:
+        rentals = rent_book_dao.get_rentals(user_id)
+        if not rentals:
             return jsonify({'message': 'Rented book not found'}), 404
-        return jsonify([rented_book.__dict__ for rented_book in rented_books]), 200
+        return jsonify(expand_rentals(rentals, expand)), 200
     except Exception as e:
         logging.error(f"Error fetching rented books for user_id {user_id}: {e}")
         return jsonify({'message': 'Internal Server Error'}), 500
@@ -99,11 +138,146 @@ def add_rent():
 
     # Create RentedBook object and add to database
     rented_book = create_rented_book(rent_id, user, book, rented_date)
-    rent_book_dao.add_rented_book(rented_book)
+    if rented_book.rented:
+        # A book which is out cannot be lent again, the check-out decides atomically
+        try:
+            if rent_book_dao.check_out(user.user_id, book.id) is None:
+                return jsonify({'message': 'Book is already rented'}), 409
+        except sqlite3.OperationalError:
+            return busy_response()
+        refresh_similar_books(user.user_id, book.id)
+    elif rent_book_dao.add_rented_book(rented_book):
+        refresh_similar_books(user.user_id, book.id)
 
     return jsonify({'message': 'Rent created'}), 201
 
 
+@rent_book_blueprint.route('/rented_books/check_out', methods=['POST'])
+def check_out():
+    """
+    This method rents a book to a user unless the book is out. With a version read from
+    /books/<book_id>/availability the check-out also fails if the book changed since.
+    :return: id of the new rental
+    """
+    data = request.get_json()
+    try:
+        rent_id = rent_book_dao.check_out(data['user_id'], data['book_id'], data.get('version'))
+    except sqlite3.OperationalError:
+        return busy_response()
+    if rent_id is None:
+        return jsonify({'message': 'Book is already rented or was changed'}), 409
+    refresh_similar_books(data['user_id'], data['book_id'])
+    return jsonify({'message': 'Book checked out', 'id': rent_id}), 201
+
+
+@rent_book_blueprint.route('/rented_books/<int:rent_id>/return', methods=['POST'])
+def return_book(rent_id):
+    """
+    This method returns a rented book.
+    :param rent_id:
+    :return message:
+    """
+    try:
+        returned = rent_book_dao.return_book(rent_id)
+    except sqlite3.OperationalError:
+        return busy_response()
+    if returned:
+        return jsonify({'message': 'Book returned'}), 200
+    return jsonify({'message': 'Rent not found or already returned'}), 404
+
+
+@rent_book_blueprint.route('/books/<int:book_id>/availability', methods=['GET'])
+def get_book_availability(book_id):
+    """
+    This method returns whether a book is out and the version to check it out with.
+    :param book_id:
+    :return:
+    """
+    return jsonify(rent_book_dao.get_book_loan(book_id)), 200
+
+
+@rent_book_blueprint.route('/books/<int:book_id>/holds', methods=['POST'])
+def add_hold(book_id):
+    """
+    This method puts a user on the waitlist of a book, a book which is not out is rented to
+    the next hold right away.
+    :param book_id:
+    :return: the hold with its position, or the assigned hold
+    """
+    data = request.get_json()
+    priority = data.get('priority', 0)
+    if not isinstance(priority, int) or not 0 <= priority <= MAX_HOLD_PRIORITY:
+        return jsonify({'message': f'priority must be between 0 and {MAX_HOLD_PRIORITY}'}), 400
+    try:
+        hold = rent_book_dao.add_hold(book_id, data['user_id'], priority)
+        if hold is None:
+            return jsonify({'message': 'User already waits for this book'}), 409
+        if rent_book_dao.assign_next_hold(book_id) is not None:
+            hold = rent_book_dao.get_hold(hold['id'])
+    except sqlite3.OperationalError:
+        return busy_response()
+    return jsonify(hold), 201
+
+
+@rent_book_blueprint.route('/books/<int:book_id>/holds', methods=['GET'])
+def get_waitlist(book_id):
+    """
+    This method returns the waiting holds of a book in serving order (?n=, default 100).
+    :param book_id:
+    :return:
+    """
+    limit = request.args.get('n', MAX_WAITLIST, type=int)
+    if not 1 <= limit <= MAX_WAITLIST:
+        return jsonify({'message': f'n must be between 1 and {MAX_WAITLIST}'}), 400
+    return jsonify(rent_book_dao.get_waitlist(book_id, limit)), 200
+
+
+@rent_book_blueprint.route('/holds/<int:hold_id>', methods=['GET'])
+def get_hold(hold_id):
+    """
+    This method returns a hold with its position in the waitlist.
+    :param hold_id:
+    :return:
+    """
+    hold = rent_book_dao.get_hold(hold_id)
+    if hold is None:
+        return jsonify({'message': 'Hold not found'}), 404
+    return jsonify(hold), 200
+
+
+@rent_book_blueprint.route('/holds/<int:hold_id>', methods=['DELETE'])
+def cancel_hold(hold_id):
+    """
+    This method takes a hold off the waitlist.
+    :param hold_id:
+    :return message:
+    """
+    try:
+        cancelled = rent_book_dao.cancel_hold(hold_id)
+    except sqlite3.OperationalError:
+        return busy_response()
+    if cancelled:
+        return jsonify({'message': 'Hold cancelled'}), 200
+    return jsonify({'message': 'Hold not found or no longer waiting'}), 404
+
+
+def busy_response():
+    """Response for a write which still found the database busy after all retries."""
+    logging.warning('Database busy, write given up after retries')
+    response = jsonify({'message': 'Database busy, try again'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+
+def refresh_similar_books(user_id, book_id):
+    """Merges the co-rentals of a new rental into the precomputed similar books."""
+    # The compact rentals carry the book ids, no user and book lookups per rental
+    other_book_ids = {rental['book_id'] for rental in rent_book_dao.get_rentals(user_id)
+                      if rental['book_id'] != book_id}
+    co_rentals = rent_book_dao.count_co_rentals(book_id, other_book_ids)
+    recommendation_dao.record_co_rentals(book_id, co_rentals)
+
+
 def create_user(user_data):
     """Creates a User object from provided data."""
     return User(**user_data)
@@ -156,11 +330,13 @@ def update_rent():
         RentedBook(data['id'], data['user'], data['book'], data['rented']))
     if updated_rent:
         return jsonify({'message': 'Rent updated'}), 200
-    else:
-        return jsonify({'message': 'Rent not found or not updated'}), 404
+    if data['rented'] and rent_book_dao.get_rental_book_id(data['id']) is not None:
+        return jsonify({'message': 'Book is already rented'}), 409
+    return jsonify({'message': 'Rent not found or not updated'}), 404
 
 
 @rent_book_blueprint.route('/rented_books/count_by_user', methods=['GET'])
+@cached_response('rented_books', 'users', 'books')
 def count_rented_books_by_user_route():
     """
     This method returns the count of rented books by user.
@@ -169,3 +345,47 @@ def count_rented_books_by_user_route():
     # Count rented books by user
     rental_count_by_user = rent_book_dao.count_rented_books_by_user()
     return jsonify(rental_count_by_user)
+
+
+@rent_book_blueprint.route('/books/popular', methods=['GET'])
+@cached_response('rented_books', 'books')
+def get_popular_books():
+    """
+    This method returns the n most rented books (?n=, default 10) from the rental counters.
+    :return:
+    """
+    limit = request.args.get('n', 10, type=int)
+    if not 1 <= limit <= MAX_POPULAR_BOOKS:
+        return jsonify({'message': f'n must be between 1 and {MAX_POPULAR_BOOKS}'}), 400
+    popular_books = [{'book': serialize_data(rent_book_dao.book_dao.get_book_by_id(book_id)),
+                      'rentals': rentals}
+                     for book_id, rentals in rent_book_dao.get_most_rented_books(limit)]
+    return jsonify(popular_books), 200
+
+
+@rent_book_blueprint.route('/books/<int:book_id>/similar', methods=['GET'])
+def get_similar_books(book_id):
+    """
+    This method returns the books most often rented by the readers of a book (?n=, default 10),
+    read from the precomputed similar books.
+    :param book_id:
+    :return:
+    """
+    limit = request.args.get('n', SIMILAR_BOOKS_TOP_K, type=int)
+    if not 1 <= limit <= SIMILAR_BOOKS_TOP_K:
+        return jsonify({'message': f'n must be between 1 and {SIMILAR_BOOKS_TOP_K}'}), 400
+    similar = recommendation_dao.get_similar_books(book_id, limit)
+    similar_books = [{'book': serialize_data(rent_book_dao.book_dao.get_book_by_id(similar_id)),
+                      'co_rentals': co_rentals}
+                     for similar_id, co_rentals in similar]
+    return jsonify(similar_books), 200
+
+
+@rent_book_blueprint.route('/books/similar/rebuild', methods=['POST'])
+def rebuild_similar_books():
+    """
+    This method recomputes the similar books of all books in batch, e.g. after returns.
+    :return:
+    """
+    stored = recommendation_dao.rebuild(rent_book_dao.get_rental_pairs())
+    return jsonify({'message': 'Similar books rebuilt', 'similar_books': stored}), 200
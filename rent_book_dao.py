@@ -1,27 +1,153 @@
 """
 This module contains the data access object for rented books.
 """
-# pylint: disable=line-too-long,no-else-return
+# pylint: disable=line-too-long,no-else-return,too-many-public-methods
+import json
 import sqlite3
-from functools import reduce
+import time
+from functools import partial, reduce
 
+from db import connect, data_file, retry_on_busy, ReadOnlyPool, WRITE_RETRIES
+from tracing import trace_methods
 from rent_book import RentedBook
 from user_dao import UserDao, USER_DB_NAME
 from book_dao import BookDao, BOOK_DB_NAME
+from changelog_dao import create_changelog_triggers
+import table_versions
+from waitlist import WaitlistCache
 
-RENTED_BOOK_DB_NAME = 'rented_books.db'
+RENTED_BOOK_DB_NAME = data_file('rented_books.db')
 
+# Rental counters per book and per user, kept up to date by triggers on rented_books
+POPULARITY_SCHEMA = (
+    'DROP TABLE IF EXISTS book_rental_counts',
+    'DROP TABLE IF EXISTS user_rental_counts',
+    'CREATE TABLE book_rental_counts (book_id INTEGER PRIMARY KEY, rentals INTEGER NOT NULL)',
+    'CREATE TABLE user_rental_counts (user_id INTEGER PRIMARY KEY, rentals INTEGER NOT NULL)',
+    'CREATE INDEX book_rental_counts_rentals ON book_rental_counts (rentals DESC, book_id)',
+    'CREATE INDEX user_rental_counts_rentals ON user_rental_counts (rentals DESC, user_id)',
+    '''CREATE TRIGGER rented_books_count_insert AFTER INSERT ON rented_books
+    BEGIN
+        INSERT INTO book_rental_counts (book_id, rentals) VALUES (NEW.book_id, 1)
+            ON CONFLICT (book_id) DO UPDATE SET rentals = rentals + 1;
+        INSERT INTO user_rental_counts (user_id, rentals) VALUES (NEW.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET rentals = rentals + 1;
+    END''',
+    '''CREATE TRIGGER rented_books_count_delete AFTER DELETE ON rented_books
+    BEGIN
+        UPDATE book_rental_counts SET rentals = rentals - 1 WHERE book_id = OLD.book_id;
+        DELETE FROM book_rental_counts WHERE book_id = OLD.book_id AND rentals <= 0;
+        UPDATE user_rental_counts SET rentals = rentals - 1 WHERE user_id = OLD.user_id;
+        DELETE FROM user_rental_counts WHERE user_id = OLD.user_id AND rentals <= 0;
+    END''',
+)
 
+# Who has a book at the moment and a version which changes with every check-out and return,
+# kept up to date by triggers so every way of writing rented_books is covered
+LOAN_SCHEMA = (
+    'DROP TABLE IF EXISTS book_loans',
+    'CREATE TABLE book_loans (book_id INTEGER PRIMARY KEY, rent_id INTEGER, version INTEGER NOT NULL)',
+    '''CREATE TRIGGER rented_books_loan_insert AFTER INSERT ON rented_books WHEN NEW.rented
+    BEGIN
+        INSERT INTO book_loans (book_id, rent_id, version) VALUES (NEW.book_id, NEW.id, 1)
+            ON CONFLICT (book_id) DO UPDATE SET rent_id = excluded.rent_id, version = version + 1;
+    END''',
+    '''CREATE TRIGGER rented_books_loan_rent AFTER UPDATE OF rented ON rented_books
+    WHEN NEW.rented AND NOT OLD.rented
+    BEGIN
+        INSERT INTO book_loans (book_id, rent_id, version) VALUES (NEW.book_id, NEW.id, 1)
+            ON CONFLICT (book_id) DO UPDATE SET rent_id = excluded.rent_id, version = version + 1;
+    END''',
+    '''CREATE TRIGGER rented_books_loan_return AFTER UPDATE OF rented ON rented_books
+    WHEN OLD.rented AND NOT NEW.rented
+    BEGIN
+        UPDATE book_loans SET rent_id = NULL, version = version + 1
+        WHERE book_id = OLD.book_id AND rent_id = OLD.id;
+    END''',
+    '''CREATE TRIGGER rented_books_loan_delete AFTER DELETE ON rented_books WHEN OLD.rented
+    BEGIN
+        UPDATE book_loans SET rent_id = NULL, version = version + 1
+        WHERE book_id = OLD.book_id AND rent_id = OLD.id;
+    END''',
+)
+
+# One conditional write: the rental is only inserted while the book is not out and, if the
+# caller read a version, while the book is still at that version
+CHECK_OUT_QUERY = '''
+    INSERT INTO rented_books (id, user_id, book_id, rented)
+    SELECT :rent_id, :user_id, :book_id, 1
+    WHERE NOT EXISTS (SELECT 1 FROM book_loans WHERE book_id = :book_id AND rent_id IS NOT NULL)
+        AND (:version IS NULL
+             OR COALESCE((SELECT version FROM book_loans WHERE book_id = :book_id), 0) = :version)
+    RETURNING id
+'''
+
+# Holds of patrons waiting for a book, the partial indexes only cover the waiting holds:
+# one for the queue of a book in serving order, one so a user waits at most once per book
+HOLD_SCHEMA = (
+    'DROP TABLE IF EXISTS holds',
+    '''CREATE TABLE holds (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        book_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        priority INTEGER NOT NULL DEFAULT 0,
+        requested_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+        status TEXT NOT NULL DEFAULT 'waiting',
+        rent_id INTEGER
+    )''',
+    "CREATE INDEX holds_queue ON holds (book_id, priority DESC, requested_at, id) WHERE status = 'waiting'",
+    "CREATE UNIQUE INDEX holds_waiting_user ON holds (book_id, user_id) WHERE status = 'waiting'",
+)
+HOLD_COLUMNS = 'id, book_id, user_id, priority, requested_at, status, rent_id'
+
+# Which rental a book is lent to over all shards of ShardedRentedBookDao, kept on the shard
+# of the book; the rental itself lives on the shard of its user
+CLAIM_SCHEMA = (
+    'DROP TABLE IF EXISTS book_claims',
+    'CREATE TABLE book_claims (book_id INTEGER PRIMARY KEY, rent_id INTEGER NOT NULL, claimed_at REAL NOT NULL)',
+)
+
+# Lending a rental again has the condition of CHECK_OUT_QUERY: the book must not be out with
+# another rental
+LEND_AGAIN_QUERY = '''
+    UPDATE rented_books SET rented = 1
+    WHERE id = ? AND (rented OR NOT EXISTS (
+        SELECT 1 FROM book_loans WHERE book_loans.book_id = rented_books.book_id AND rent_id IS NOT NULL))
+'''
+HOLD_QUEUE_ORDER = 'priority DESC, requested_at, id'
+
+
+def hold_to_dict(row, position=None):
+    """
+    Converts a row of the holds table.
+    :param row: tuple of HOLD_COLUMNS
+    :param position: position in the waitlist of the book, None if the hold does not wait
+    :return: dict
+    """
+    return {'id': row[0], 'book_id': row[1], 'user_id': row[2], 'priority': row[3],
+            'requested_at': row[4], 'status': row[5], 'rent_id': row[6], 'position': position}
+
+
+@trace_methods
 class RentedBookDao:
     """
     This class represents a data access object for rented books.
     """
 
-    def __init__(self, db_file=RENTED_BOOK_DB_NAME):
-        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+    def __init__(self, db_file=RENTED_BOOK_DB_NAME, user_dao=None, book_dao=None, assign_holds=True):
+        """
+        :param assign_holds: assign a returned book to the next hold, off for the shards of
+            ShardedRentedBookDao, which keeps the holds itself
+        """
+        self.conn = connect(db_file)
         self.cursor = self.conn.cursor()
-        self.user_dao = UserDao(USER_DB_NAME)
-        self.book_dao = BookDao(BOOK_DB_NAME)
+        # GET routes read through their own read-only connections, self.conn only writes
+        self.readers = ReadOnlyPool(db_file, self.conn)
+        self.user_dao = user_dao or UserDao(USER_DB_NAME)
+        self.book_dao = book_dao or BookDao(BOOK_DB_NAME)
+        self.assign_holds = assign_holds
+        # Waitlists of the hot books, the holds table stays the source of truth
+        self.waitlists = WaitlistCache(self._load_waitlist)
 
     def query_executor(self):
         """
@@ -34,7 +160,10 @@ class RentedBookDao:
                 self.conn.commit()
                 if expect_change:
                     # Return True if rows were affected, False otherwise
-                    return self.cursor.rowcount > 0
+                    if self.cursor.rowcount > 0:
+                        table_versions.bump('rented_books')
+                        return True
+                    return False
                 elif fetch_all:
                     return self.cursor.fetchall()
                 else:
@@ -46,6 +175,22 @@ class RentedBookDao:
 
         return execute_query
 
+    def read_executor(self):
+        """
+        Closure to handle read-only SQL queries on a connection of the read pool.
+        """
+
+        def read_query(query, params=(), fetch_all=True):
+            try:
+                with self.readers.connection() as conn:
+                    cursor = conn.execute(query, params)
+                    return cursor.fetchall() if fetch_all else cursor.fetchone()
+            except sqlite3.Error as e:
+                print(f"Database error: {e}")
+                return None
+
+        return read_query
+
     def create_table(self):
         """
         This method creates the table if it does not exist.
@@ -63,25 +208,40 @@ class RentedBookDao:
                 FOREIGN KEY(book_id) REFERENCES books(id)
             )
             ''', fetch_all=False)
+            execute_query('CREATE INDEX IF NOT EXISTS rented_books_user_id ON rented_books (user_id)',
+                          fetch_all=False)
+            execute_query('CREATE INDEX IF NOT EXISTS rented_books_book_id ON rented_books (book_id, user_id)',
+                          fetch_all=False)
+            for statement in POPULARITY_SCHEMA + LOAN_SCHEMA + HOLD_SCHEMA + CLAIM_SCHEMA:
+                execute_query(statement, fetch_all=False)
+            create_changelog_triggers(self.cursor, 'rented_books', 'id',
+                                      ('id', 'user_id', 'book_id', 'rented'))
+            self.conn.commit()
+            self.waitlists.clear()
+            table_versions.bump('rented_books')
+            table_versions.bump('holds')
         except sqlite3.OperationalError as e:
             print(f'Error creating table: {e}')
 
-    def add_rented_book(self, rented_book):
+    def add_rented_book(self, rented_book, keep_id=False):
         """
         This method adds a rented book to the database.
+        :param rented_book: RentedBook instance
+        :param keep_id: store rented_book.id instead of letting the database assign the id
         """
         execute_query = self.query_executor()
         result = execute_query('''
-            INSERT INTO rented_books (user_id, book_id, rented) VALUES (?, ?, ?)
-        ''', (rented_book.user.user_id, rented_book.book.id, rented_book.rented), fetch_all=False, expect_change=True)
+            INSERT INTO rented_books (id, user_id, book_id, rented) VALUES (?, ?, ?, ?)
+        ''', (rented_book.id if keep_id else None, rented_book.user.user_id, rented_book.book.id, rented_book.rented),
+            fetch_all=False, expect_change=True)
         return result is not None
 
     def get_all_rented_books(self):
         """
         This method returns all rented books.
         """
-        execute_query = self.query_executor()
-        rows = execute_query('SELECT * FROM rented_books')
+        read_query = self.read_executor()
+        rows = read_query('SELECT * FROM rented_books')
         rented_books = []
         for row in rows:
             user = self.user_dao.get_one_user(row[1])
@@ -93,8 +253,8 @@ class RentedBookDao:
         """
         This method returns a rented book by its id.
         """
-        execute_query = self.query_executor()
-        row = execute_query('SELECT * FROM rented_books WHERE id = ?', (rent_id,), fetch_all=False)
+        read_query = self.read_executor()
+        row = read_query('SELECT * FROM rented_books WHERE id = ?', (rent_id,), fetch_all=False)
         if row:
             user = self.user_dao.get_one_user(row[1])
             book = self.book_dao.get_book_by_id(row[2])
@@ -105,13 +265,27 @@ class RentedBookDao:
         """
         This method returns all the rented books by a user.
         """
-        execute_query = self.query_executor()
-        rows = execute_query('SELECT * FROM rented_books WHERE user_id = ?', (user_id,))
+        read_query = self.read_executor()
+        rows = read_query('SELECT * FROM rented_books WHERE user_id = ?', (user_id,))
         return [
             RentedBook(row[0], self.user_dao.get_one_user(row[1]), self.book_dao.get_book_by_id(row[2]), bool(row[3]))
             for row in rows
         ]
 
+    def get_rentals(self, user_id=None):
+        """
+        This method returns the rentals with the ids of their user and book only, no lookups.
+        :param user_id: only the rentals of this user (optional)
+        :return: list of dicts with id, user_id, book_id and rented, ordered by id
+        """
+        read_query = self.read_executor()
+        if user_id is None:
+            rows = read_query('SELECT id, user_id, book_id, rented FROM rented_books ORDER BY id')
+        else:
+            rows = read_query('SELECT id, user_id, book_id, rented FROM rented_books WHERE user_id = ? ORDER BY id',
+                              (user_id,))
+        return [{'id': row[0], 'user_id': row[1], 'book_id': row[2], 'rented': bool(row[3])} for row in rows or []]
+
     def delete_rented_book(self, rent_id):
         """
         This method deletes a rented book by its id.
@@ -129,17 +303,297 @@ class RentedBookDao:
 
     def update_rented_book(self, rented_book):
         """
-        This method updates a rented book.
+        This method updates a rented book. A rental is only lent again while its book is not
+        out with another rental.
+        :return: True if updated, False if the rental does not exist or its book is out
         """
         execute_query = self.query_executor()
-        return execute_query('''
-            UPDATE rented_books SET rented = ? WHERE id = ?
-        ''', (rented_book.rented, rented_book.id), fetch_all=False, expect_change=True)
+        if rented_book.rented:
+            return execute_query(LEND_AGAIN_QUERY, (rented_book.id,), fetch_all=False, expect_change=True)
+        updated = execute_query('''
+            UPDATE rented_books SET rented = 0 WHERE id = ?
+        ''', (rented_book.id,), fetch_all=False, expect_change=True)
+        if updated:
+            self._assign_returned_book(rented_book.id)
+        return updated
+
+    def check_out(self, user_id, book_id, version=None, rent_id=None):
+        """
+        This method rents a book to a user unless it is already out, atomically and without
+        a lock: the rental is a single conditional insert, retried while the database is busy.
+        :param user_id: int
+        :param book_id: int
+        :param version: version of the book read by the caller (optional), see get_book_loan
+        :param rent_id: id of the new rental (optional), assigned by the database if not given
+        :return: id of the new rental, None if the book is out or its version changed
+        """
+        def write():
+            cursor = self.conn.cursor()
+            try:
+                rows = cursor.execute(CHECK_OUT_QUERY, {'rent_id': rent_id, 'user_id': user_id,
+                                                        'book_id': book_id, 'version': version}).fetchall()
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+            return rows[0][0] if rows else None
+
+        new_rent_id = retry_on_busy(write)
+        if new_rent_id is not None:
+            table_versions.bump('rented_books')
+        return new_rent_id
+
+    def return_book(self, rent_id):
+        """
+        This method returns a rented book, a single conditional update retried while the
+        database is busy.
+        :param rent_id: int
+        :return: True if returned, False if the rental does not exist or was returned before
+        """
+        def write():
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute('UPDATE rented_books SET rented = 0 WHERE id = ? AND rented', (rent_id,))
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+            return cursor.rowcount > 0
+
+        returned = retry_on_busy(write)
+        if returned:
+            table_versions.bump('rented_books')
+            self._assign_returned_book(rent_id)
+        return returned
+
+    def _assign_returned_book(self, rent_id):
+        if self.assign_holds:
+            book_id = self.get_rental_book_id(rent_id)
+            if book_id is not None:
+                self.assign_next_hold(book_id)
+
+    def get_rental_book_id(self, rent_id):
+        """
+        This method returns the book of a rental without looking it up.
+        :param rent_id: int
+        :return: book id, None if the rental does not exist
+        """
+        row = self.conn.execute('SELECT book_id FROM rented_books WHERE id = ?', (rent_id,)).fetchone()
+        return row[0] if row else None
+
+    def _load_waitlist(self, book_id):
+        # Read on the writer connection, which has seen every hold written through this DAO
+        return self.conn.execute(f"SELECT id, priority FROM holds WHERE book_id = ? AND status = 'waiting' "
+                                 f'ORDER BY {HOLD_QUEUE_ORDER}', (book_id,)).fetchall()
+
+    def _write_rows(self, query, params, retries=WRITE_RETRIES):
+        def write():
+            cursor = self.conn.cursor()
+            try:
+                rows = cursor.execute(query, params).fetchall()
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+            return rows
+
+        return retry_on_busy(write, retries)
+
+    def _write_holds(self, query, params, retries=WRITE_RETRIES):
+        rows = self._write_rows(query, params, retries)
+        if rows:
+            table_versions.bump('holds')
+        return rows
+
+    def claim_book(self, book_id, rent_id, stale_rent_id=None):
+        """
+        This method lends a book to a rental in book_claims unless another rental holds it.
+        :param book_id: int
+        :param rent_id: id of the rental
+        :param stale_rent_id: rental whose claim may be taken over (optional)
+        :return: True if the rental holds the book now
+        """
+        return bool(self._write_rows('''
+            INSERT INTO book_claims (book_id, rent_id, claimed_at) VALUES (:book_id, :rent_id, :now)
+            ON CONFLICT (book_id) DO UPDATE SET rent_id = excluded.rent_id, claimed_at = excluded.claimed_at
+            WHERE book_claims.rent_id IN (:rent_id, :stale_rent_id)
+            RETURNING rent_id
+        ''', {'book_id': book_id, 'rent_id': rent_id, 'stale_rent_id': stale_rent_id, 'now': time.time()}))
+
+    def get_book_claim(self, book_id):
+        """
+        This method returns which rental holds a book in book_claims.
+        :param book_id: int
+        :return: tuple of rent id and claimed_at (unix time), None if the book is not claimed
+        """
+        return self.conn.execute('SELECT rent_id, claimed_at FROM book_claims WHERE book_id = ?',
+                                 (book_id,)).fetchone()
+
+    def release_book_claim(self, book_id, rent_id):
+        """
+        This method gives a book back in book_claims if the rental still holds it.
+        :param book_id: int
+        :param rent_id: id of the rental
+        """
+        self._write_rows('DELETE FROM book_claims WHERE book_id = ? AND rent_id = ? RETURNING book_id',
+                         (book_id, rent_id))
+
+    def add_hold(self, book_id, user_id, priority=0):
+        """
+        This method puts a user on the waitlist of a book, behind the waiting holds of the
+        same or a higher priority.
+        :param book_id: int
+        :param user_id: int
+        :param priority: int from 0 to MAX_HOLD_PRIORITY, higher is served first
+        :return: dict of the hold with its position, None if the user already waits for the book
+        """
+        # The waitlist is locked for one attempt at a time, not while a busy write backs off
+        return retry_on_busy(partial(self._add_hold, book_id, user_id, priority))
+
+    def _add_hold(self, book_id, user_id, priority):
+        with self.waitlists.lock_for(book_id):
+            # Holds of the book are pushed in the order they are inserted
+            waitlist = self.waitlists.get(book_id)
+            rows = self._write_holds(f'INSERT INTO holds (book_id, user_id, priority) VALUES (?, ?, ?) '
+                                     f'ON CONFLICT DO NOTHING RETURNING {HOLD_COLUMNS}',
+                                     (book_id, user_id, priority), retries=1)
+            if not rows:
+                return None
+            waitlist.push(rows[0][0], priority)
+            return hold_to_dict(rows[0], waitlist.position(rows[0][0]))
+
+    def get_hold(self, hold_id):
+        """
+        This method returns a hold with its position in the waitlist of its book.
+        :param hold_id: int
+        :return: dict, None if the hold does not exist
+        """
+        row = self.conn.execute(f'SELECT {HOLD_COLUMNS} FROM holds WHERE id = ?', (hold_id,)).fetchone()
+        if row is None:
+            return None
+        if row[5] != 'waiting':
+            return hold_to_dict(row, None)
+        with self.waitlists.lock_for(row[1]):
+            return hold_to_dict(row, self.waitlists.get(row[1]).position(hold_id))
+
+    def get_next_hold(self, book_id):
+        """
+        This method returns the hold which is served next for a book.
+        :param book_id: int
+        :return: dict, None if nobody waits for the book
+        """
+        with self.waitlists.lock_for(book_id):
+            hold_id = self.waitlists.get(book_id).peek()
+        return None if hold_id is None else self.get_hold(hold_id)
+
+    def get_waitlist(self, book_id, limit=100):
+        """
+        This method returns the waiting holds of a book in serving order, read along the index.
+        :param book_id: int
+        :param limit: number of holds
+        :return: list of dicts with their positions
+        """
+        read_query = self.read_executor()
+        rows = read_query(f"SELECT {HOLD_COLUMNS} FROM holds WHERE book_id = ? AND status = 'waiting' "
+                          f'ORDER BY {HOLD_QUEUE_ORDER} LIMIT ?', (book_id, limit))
+        return [hold_to_dict(row, position) for position, row in enumerate(rows or [], start=1)]
+
+    def cancel_hold(self, hold_id):
+        """
+        This method takes a waiting hold off the waitlist of its book.
+        :param hold_id: int
+        :return: True if cancelled, False if the hold does not exist or no longer waits
+        """
+        rows = self._write_holds("UPDATE holds SET status = 'cancelled' WHERE id = ? AND status = 'waiting' "
+                                 'RETURNING book_id', (hold_id,))
+        if not rows:
+            return False
+        self._drop_hold(rows[0][0], hold_id)
+        return True
+
+    def _drop_hold(self, book_id, hold_id):
+        # A waitlist loaded after the write does not hold the hold anymore, removing it again is harmless
+        with self.waitlists.lock_for(book_id):
+            self.waitlists.get(book_id).remove(hold_id)
+
+    def assign_hold(self, hold_id, rent_id):
+        """
+        This method marks a waiting hold as served by a rental.
+        :param hold_id: int
+        :param rent_id: id of the rental of the held book
+        :return: True if assigned, False if the hold does not exist or no longer waits
+        """
+        rows = self._write_holds("UPDATE holds SET status = 'assigned', rent_id = ? "
+                                 "WHERE id = ? AND status = 'waiting' RETURNING book_id", (rent_id, hold_id))
+        if not rows:
+            return False
+        self._drop_hold(rows[0][0], hold_id)
+        return True
+
+    def assign_next_hold(self, book_id):
+        """
+        This method rents a book to the user of its next hold if the book is not out. The
+        check-out and the assignment of the hold are one transaction, holds cancelled in the
+        meantime are skipped. The waitlist is only locked to read and update it, so two
+        returns of the same book may both try its next hold, the transaction lets one win.
+        :param book_id: int
+        :return: dict of the assigned hold, None if nobody waits or the book is out
+        """
+        while True:
+            with self.waitlists.lock_for(book_id):
+                hold_id = self.waitlists.get(book_id).peek()
+            if hold_id is None:
+                return None
+            rent_id = retry_on_busy(partial(self._check_out_hold, hold_id, book_id))
+            if rent_id is None:
+                return None
+            self._drop_hold(book_id, hold_id)
+            if rent_id:
+                table_versions.bump('rented_books')
+                table_versions.bump('holds')
+                return self.get_hold(hold_id)
+
+    def _check_out_hold(self, hold_id, book_id):
+        """Returns the new rent id, None if the book is out, 0 if the hold no longer waits."""
+        cursor = self.conn.cursor()
+        try:
+            # The hold is taken only while the book is in, and taking it locks the database for
+            # writes, so the check-out below cannot find the book out and nothing is undone
+            rows = cursor.execute('''
+                UPDATE holds SET status = 'assigned' WHERE id = ? AND status = 'waiting' AND NOT EXISTS (
+                    SELECT 1 FROM book_loans WHERE book_id = ? AND rent_id IS NOT NULL)
+                RETURNING user_id
+            ''', (hold_id, book_id)).fetchall()
+            if not rows:
+                # Nothing was written, so the transaction ends without a rollback, which would
+                # fail a running batch transaction
+                self.conn.commit()
+                return None if self.get_book_loan(book_id)['rent_id'] is not None else 0
+            rent_id = cursor.execute(CHECK_OUT_QUERY, {'rent_id': None, 'user_id': rows[0][0],
+                                                       'book_id': book_id, 'version': None}).fetchall()[0][0]
+            cursor.execute('UPDATE holds SET rent_id = ? WHERE id = ?', (rent_id, hold_id))
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        return rent_id
+
+    def get_book_loan(self, book_id):
+        """
+        This method returns whether a book is out and its version for check_out.
+        :param book_id: int
+        :return: dict with book_id, available, rent_id and version
+        """
+        read_query = self.read_executor()
+        row = read_query('SELECT rent_id, version FROM book_loans WHERE book_id = ?', (book_id,), fetch_all=False)
+        rent_id, version = row or (None, 0)
+        return {'book_id': book_id, 'available': rent_id is None, 'rent_id': rent_id, 'version': version}
 
     def close(self):
         """
         This method closes the connection to the database.
         """
+        self.readers.close()
         self.conn.close()
         self.user_dao.close()
         self.book_dao.close()
@@ -150,6 +604,55 @@ class RentedBookDao:
         """
         execute_query = self.query_executor()
         execute_query('DROP TABLE IF EXISTS rented_books', fetch_all=False)
+        table_versions.bump('rented_books')
+
+    def get_most_rented_books(self, limit=10):
+        """
+        This method returns the most rented books from the counter table, read along its index.
+        :param limit: number of books
+        :return: list of (book_id, rentals) tuples, most rented first
+        """
+        read_query = self.read_executor()
+        return read_query('SELECT book_id, rentals FROM book_rental_counts ORDER BY rentals DESC, book_id LIMIT ?',
+                          (limit,)) or []
+
+    def get_most_active_users(self, limit=10):
+        """
+        This method returns the users with the most rentals from the counter table.
+        :param limit: number of users
+        :return: list of (user_id, rentals) tuples, most active first
+        """
+        read_query = self.read_executor()
+        return read_query('SELECT user_id, rentals FROM user_rental_counts ORDER BY rentals DESC, user_id LIMIT ?',
+                          (limit,)) or []
+
+    def get_rental_pairs(self):
+        """
+        This method returns the user and book of every rental, without loading users and books.
+        :return: list of (user_id, book_id) tuples
+        """
+        read_query = self.read_executor()
+        return read_query('SELECT user_id, book_id FROM rented_books') or []
+
+    def count_co_rentals(self, book_id, other_book_ids):
+        """
+        This method counts for every other book the users who rented both it and book_id.
+        :param book_id: int
+        :param other_book_ids: ids of the other books
+        :return: dict of other book id to number of users
+        """
+        other_book_ids = list(other_book_ids)
+        if not other_book_ids:
+            return {}
+        read_query = self.read_executor()
+        # The ids are passed as one json array, so the statement does not grow with them
+        rows = read_query('''
+            SELECT other.book_id, COUNT(DISTINCT other.user_id) FROM rented_books AS rented
+            JOIN rented_books AS other ON other.user_id = rented.user_id
+            WHERE rented.book_id = ? AND other.book_id IN (SELECT value FROM json_each(?))
+            GROUP BY other.book_id
+        ''', (book_id, json.dumps(other_book_ids)))
+        return dict(rows or [])
 
     def count_rented_books_by_user(self):
         """
@@ -0,0 +1,85 @@
+"""
+This module profiles single requests with cProfile.
+Profiling is opt-in: the app config PROFILING_ENABLED has to be set and the request has to
+carry the header X-Profile: 1. Every profiled request is written to a pstats file named by
+route and timestamp, and the top functions are returned in the X-Profile-Summary header.
+"""
+import cProfile
+import os
+import pstats
+import re
+import time
+
+from flask import current_app, g, request
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_SUMMARY_HEADER = 'X-Profile-Summary'
+PROFILE_DIR = 'profiles'
+PROFILE_TOP_FUNCTIONS = 5
+
+
+def register_profiling(app):
+    """
+    Registers the profiling hooks on an app, profiling stays off until PROFILING_ENABLED is set.
+    :param app: flask app
+    """
+    app.config.setdefault('PROFILING_ENABLED', False)
+    app.config.setdefault('PROFILE_DIR', PROFILE_DIR)
+    app.before_request(start_profile)
+    app.after_request(stop_profile)
+    app.teardown_request(discard_profile)
+
+
+def start_profile():
+    """
+    before_request hook, starts the profiler if the request asks for it.
+    """
+    # Two lookups are all a request pays while profiling is disabled
+    if not current_app.config['PROFILING_ENABLED'] or request.headers.get(PROFILE_HEADER) != '1':
+        return
+    g.profile = cProfile.Profile()
+    g.profile.enable()
+
+
+def stop_profile(response):
+    """
+    after_request hook, stops the profiler, writes the pstats file and adds the summary header.
+    :param response: flask response
+    :return: response
+    """
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    profile.disable()
+    profile_dir = current_app.config['PROFILE_DIR']
+    os.makedirs(profile_dir, exist_ok=True)
+    rule = request.url_rule.rule if request.url_rule else request.path
+    route = re.sub(r'[^A-Za-z0-9]+', '_', rule)
+    profile_file = os.path.join(profile_dir,
+                                f"{route.strip('_') or 'root'}-{time.strftime('%Y%m%d-%H%M%S')}"
+                                f"-{time.perf_counter_ns()}.pstats")
+    profile.dump_stats(profile_file)
+    response.headers[PROFILE_SUMMARY_HEADER] = summarize(pstats.Stats(profile))
+    response.headers['X-Profile-File'] = os.path.basename(profile_file)
+    return response
+
+
+def discard_profile(_exception):
+    """
+    teardown_request hook, makes sure the profiler is off if the request failed.
+    """
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.disable()
+
+
+def summarize(stats, top=PROFILE_TOP_FUNCTIONS):
+    """
+    Returns the functions with the highest cumulative time as one header value.
+    :param stats: pstats.Stats
+    :param top: number of functions
+    :return: str, e.g. "book_dao.py:61(get_all_books)=1.234ms; ..."
+    """
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+    return '; '.join(f'{os.path.basename(file)}:{line}({name})={cumulative * 1000:.3f}ms'
+                     for (file, line, name), (_, _, _, cumulative, _) in rows)
@@ -0,0 +1,112 @@
+"""
+This module caches the serialized bodies of collection responses.
+Entries are keyed by branch, route, query string and the versions of the tables the response is
+built from, and are dropped as soon as one of those tables is written.
+"""
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, g, make_response, request
+
+import metrics
+import table_versions
+from branches import current_branch
+
+RESPONSE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+_size = {'bytes': 0}
+
+
+def cached_response(*tables):
+    """
+    Decorator for GET routes whose response only depends on the given tables.
+    :param tables: names of the tables the response is built from
+    :return: decorator
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Read the versions before the view reads the database, a write in between
+            # then only leads to a miss and never to a stale entry
+            key = (current_branch(), request.path, request.query_string,
+                   table_versions.get_versions(tables))
+            # The compressed bytes can be cached under the same key
+            g.compression_cache_key = key
+            entry = _get(key)
+            if entry is not None:
+                body, status, mimetype = entry
+                return Response(body, status=status, mimetype=mimetype)
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                _put(key, tables, response)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def _get(key):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            _entries.move_to_end(key)
+    metrics.increment('response_cache.hits' if entry else 'response_cache.misses')
+    return entry[:3] if entry else None
+
+
+def _put(key, tables, response):
+    body = response.get_data()
+    if len(body) > RESPONSE_CACHE_MAX_BYTES:
+        return
+    with _lock:
+        if key in _entries:
+            return
+        _entries[key] = (body, response.status_code, response.mimetype, tables)
+        _size['bytes'] += len(body)
+        while _size['bytes'] > RESPONSE_CACHE_MAX_BYTES:
+            _, evicted = _entries.popitem(last=False)
+            _size['bytes'] -= len(evicted[0])
+            metrics.increment('response_cache.evictions')
+
+
+def invalidate(table):
+    """
+    Drops all entries built from a table. Registered as listener of table_versions.bump.
+    :param table: name of the changed table
+    """
+    with _lock:
+        for key in [key for key, entry in _entries.items() if table in entry[3]]:
+            _size['bytes'] -= len(_entries.pop(key)[0])
+
+
+def clear():
+    """
+    Drops all entries.
+    """
+    with _lock:
+        _entries.clear()
+        _size['bytes'] = 0
+
+
+def stats():
+    """
+    Returns the size and hit rate of the cache.
+    :return: dict
+    """
+    hits = metrics.get('response_cache.hits')
+    lookups = hits + metrics.get('response_cache.misses')
+    with _lock:
+        return {
+            'entries': len(_entries),
+            'bytes': _size['bytes'],
+            'max_bytes': RESPONSE_CACHE_MAX_BYTES,
+            'hit_rate': hits / lookups if lookups else 0.0,
+        }
+
+
+table_versions.add_listener(invalidate)
@@ -0,0 +1,85 @@
+"""
+This module compresses responses with gzip or deflate and caches the compressed
+bytes of the responses of cached_response routes until one of their tables changes.
+"""
+import gzip
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from flask import g, request
+
+import metrics
+
+COMPRESSION_MIN_SIZE = 500
+COMPRESSION_CACHE_SIZE = 64
+
+COMPRESSORS = {
+    'gzip': lambda data: gzip.compress(data, compresslevel=6, mtime=0),
+    'deflate': zlib.compress,
+}
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def compress_response(response):
+    """
+    after_request hook which compresses the response if the client accepts it.
+    :param response: flask response
+    :return: the (possibly compressed) response
+    """
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+    encoding = request.accept_encodings.best_match(COMPRESSORS.keys())
+    response.vary.add('Accept-Encoding')
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_SIZE:
+        metrics.increment('compression.skipped_small')
+        return response
+
+    cache_key = g.get('compression_cache_key')
+    compressed = _get_cached(cache_key + (encoding,)) if cache_key else None
+    if compressed is None:
+        start = time.perf_counter()
+        compressed = COMPRESSORS[encoding](data)
+        metrics.increment('compression.seconds', time.perf_counter() - start)
+        metrics.increment('compression.compressed')
+        if cache_key:
+            _put_cached(cache_key + (encoding,), compressed)
+    metrics.increment('compression.bytes_in', len(data))
+    metrics.increment('compression.bytes_out', len(compressed))
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def _get_cached(key):
+    with _cache_lock:
+        compressed = _cache.get(key)
+        if compressed is None:
+            metrics.increment('compression.cache_misses')
+            return None
+        _cache.move_to_end(key)
+    metrics.increment('compression.cache_hits')
+    return compressed
+
+
+def _put_cached(key, compressed):
+    with _cache_lock:
+        _cache[key] = compressed
+        while len(_cache) > COMPRESSION_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def clear_cache():
+    """
+    Removes all compressed responses from the cache.
+    """
+    with _cache_lock:
+        _cache.clear()
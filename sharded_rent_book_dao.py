@@ -0,0 +1,424 @@
+"""
+This module contains a data access object which partitions the rented books by user id
+across several SQLite files, so check-outs of different users do not share a writer lock.
+"""
+# pylint: disable=line-too-long,too-many-public-methods
+import contextvars
+import heapq
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from book_dao import BookDao, BOOK_DB_NAME
+from rent_book import RentedBook
+from rent_book_dao import RentedBookDao, RENTED_BOOK_DB_NAME
+from tracing import trace_methods
+from user_dao import UserDao, USER_DB_NAME
+
+# 1 keeps all rentals in RENTED_BOOK_DB_NAME, more partitions them by user id
+RENTED_BOOK_SHARDS = 1
+# A claim whose rental is not out on any shard after this long was left behind, e.g. by a
+# crash between the claim and the insert of the rental, and may be taken over
+CLAIM_GRACE_SECONDS = 60
+
+
+def create_rented_book_dao(db_file=RENTED_BOOK_DB_NAME, shard_count=RENTED_BOOK_SHARDS,
+                           user_dao=None, book_dao=None):
+    """
+    Creates the rented book DAO for the configured number of shards.
+    :param db_file: file name of the unsharded database
+    :param shard_count: number of shards
+    :param user_dao: DAO to look the users up with, one on USER_DB_NAME if not given
+    :param book_dao: DAO to look the books up with, one on BOOK_DB_NAME if not given
+    :return: RentedBookDao or ShardedRentedBookDao
+    """
+    if shard_count <= 1:
+        return RentedBookDao(db_file, user_dao=user_dao, book_dao=book_dao)
+    return ShardedRentedBookDao(db_file, shard_count, user_dao=user_dao, book_dao=book_dao)
+
+
+def shard_file(db_file, index):
+    """
+    Returns the file name of a shard, e.g. rented_books.db -> rented_books.shard0.db
+    :param db_file: file name of the unsharded database
+    :param index: index of the shard
+    :return: str
+    """
+    root, extension = os.path.splitext(db_file)
+    return f'{root}.shard{index}{extension}'
+
+
+@trace_methods
+class ShardedRentedBookDao:
+    """
+    This class offers the methods of RentedBookDao on top of one RentedBookDao per shard.
+    Operations on a user go to the shard user_id % shard_count, everything else is
+    scattered to all shards in parallel and gathered again. Which rental a book is out with
+    is claimed on the shard book_id % shard_count before the rental is written, so a book is
+    never lent by two shards at once.
+    """
+
+    def __init__(self, db_file=RENTED_BOOK_DB_NAME, shard_count=2, user_dao=None, book_dao=None):
+        self.db_file = db_file
+        self.user_dao = user_dao or UserDao(USER_DB_NAME)
+        self.book_dao = book_dao or BookDao(BOOK_DB_NAME)
+        self.shards = [self._open_shard(index) for index in range(shard_count)]
+        self.executor = ThreadPoolExecutor(max_workers=shard_count)
+        # Rent ids have to be unique over all shards, so they are assigned here
+        self.id_lock = threading.Lock()
+        self.last_id = max(self._scatter(self._max_id), default=0)
+
+    def _open_shard(self, index):
+        return RentedBookDao(shard_file(self.db_file, index), user_dao=self.user_dao, book_dao=self.book_dao,
+                             assign_holds=False)
+
+    @property
+    def holds(self):
+        """
+        The shard which keeps the holds of all books, a waitlist spans the users of all shards.
+        :return: RentedBookDao
+        """
+        return self.shards[0]
+
+    @staticmethod
+    def _max_id(shard):
+        row = shard.read_executor()('SELECT MAX(id) FROM rented_books', fetch_all=False)
+        return (row[0] or 0) if row else 0
+
+    def _scatter(self, function):
+        """
+        Runs function(shard) on all shards in parallel and returns the results in shard order.
+        Every shard runs in a copy of the context of the caller, so it joins its batch transaction.
+        """
+        contexts = [contextvars.copy_context() for _ in self.shards]
+        return list(self.executor.map(lambda context, shard: context.run(function, shard), contexts, self.shards))
+
+    def shard_for_user(self, user_id):
+        """
+        Returns the shard which stores the rentals of a user.
+        :param user_id: int
+        :return: RentedBookDao
+        """
+        return self.shards[user_id % len(self.shards)]
+
+    def shard_for_book(self, book_id):
+        """
+        Returns the shard which keeps the claim of a book.
+        :param book_id: int
+        :return: RentedBookDao
+        """
+        return self.shards[book_id % len(self.shards)]
+
+    def _claim_book(self, book_id, rent_id):
+        owner = self.shard_for_book(book_id)
+        if owner.claim_book(book_id, rent_id):
+            return True
+        claim = owner.get_book_claim(book_id)
+        if claim is None:
+            return owner.claim_book(book_id, rent_id)
+        claimed_rent_id, claimed_at = claim
+        if time.time() - claimed_at < CLAIM_GRACE_SECONDS or self.get_book_loan(book_id)['rent_id'] == claimed_rent_id:
+            return False
+        return owner.claim_book(book_id, rent_id, stale_rent_id=claimed_rent_id)
+
+    def _release_book(self, book_id, rent_id):
+        self.shard_for_book(book_id).release_book_claim(book_id, rent_id)
+
+    def _next_id(self):
+        with self.id_lock:
+            self.last_id += 1
+            return self.last_id
+
+    def create_table(self):
+        """
+        This method creates the table in every shard.
+        """
+        self._scatter(lambda shard: shard.create_table())
+        self.last_id = 0
+
+    def add_rented_book(self, rented_book):
+        """
+        This method adds a rented book to the shard of its user.
+        """
+        rented_book = RentedBook(self._next_id(), rented_book.user, rented_book.book, rented_book.rented)
+        return self.shard_for_user(rented_book.user.user_id).add_rented_book(rented_book, keep_id=True)
+
+    def get_all_rented_books(self):
+        """
+        This method returns all rented books of all shards ordered by id.
+        """
+        rented_books = [rented_book for rented_books in self._scatter(lambda shard: shard.get_all_rented_books())
+                        for rented_book in rented_books]
+        return sorted(rented_books, key=lambda rented_book: rented_book.id)
+
+    def get_rent_by_id(self, rent_id):
+        """
+        This method returns a rented book by its id.
+        """
+        return next((rented_book for rented_book in self._scatter(lambda shard: shard.get_rent_by_id(rent_id))
+                     if rented_book), None)
+
+    def get_rented_books_by_user_id(self, user_id):
+        """
+        This method returns all the rented books by a user.
+        """
+        return self.shard_for_user(user_id).get_rented_books_by_user_id(user_id)
+
+    def get_rentals(self, user_id=None):
+        """
+        This method returns the rentals with the ids of their user and book only.
+        """
+        if user_id is not None:
+            return self.shard_for_user(user_id).get_rentals(user_id)
+        rentals = [rental for rentals in self._scatter(lambda shard: shard.get_rentals()) for rental in rentals]
+        return sorted(rentals, key=lambda rental: rental['id'])
+
+    def delete_rented_book(self, rent_id):
+        """
+        This method deletes a rented book by its id.
+        """
+        book_id = self.get_rental_book_id(rent_id)
+        deleted = any(self._scatter(lambda shard: shard.delete_rented_book(rent_id)))
+        if deleted and book_id is not None:
+            self._release_book(book_id, rent_id)
+        return deleted
+
+    def delete_rented_book_by_user_id(self, user_id):
+        """
+        This method deletes the rented books of a user.
+        """
+        rentals = self.get_rentals(user_id)
+        deleted = self.shard_for_user(user_id).delete_rented_book_by_user_id(user_id)
+        if deleted:
+            for rental in rentals:
+                self._release_book(rental['book_id'], rental['id'])
+        return deleted
+
+    def update_rented_book(self, rented_book):
+        """
+        This method updates a rented book. A rental is only lent again if its book can be
+        claimed for it.
+        """
+        if not rented_book.rented:
+            updated = any(self._scatter(lambda shard: shard.update_rented_book(rented_book)))
+            if updated:
+                self._end_loan(rented_book.id)
+            return updated
+        book_id = self.get_rental_book_id(rented_book.id)
+        if book_id is None or not self._claim_book(book_id, rented_book.id):
+            return False
+        updated = any(self._scatter(lambda shard: shard.update_rented_book(rented_book)))
+        if not updated:
+            self._release_book(book_id, rented_book.id)
+        return updated
+
+    def count_rented_books_by_user(self):
+        """
+        This method returns the count of rented books by user.
+        Users never span two shards, so the counts of the shards can simply be merged.
+        """
+        counts = {}
+        for shard_counts in self._scatter(lambda shard: shard.count_rented_books_by_user()):
+            counts.update(shard_counts)
+        return counts
+
+    def get_most_rented_books(self, limit=10):
+        """
+        This method returns the most rented books. A book is rented on every shard, so the
+        counters of all shards are summed before the top books are picked.
+        """
+        totals = {}
+        for rows in self._scatter(lambda shard: shard.read_executor()('SELECT book_id, rentals FROM book_rental_counts') or []):
+            for book_id, rentals in rows:
+                totals[book_id] = totals.get(book_id, 0) + rentals
+        return heapq.nsmallest(limit, totals.items(), key=lambda item: (-item[1], item[0]))
+
+    def get_most_active_users(self, limit=10):
+        """
+        This method returns the users with the most rentals.
+        Users never span two shards, so the top users of every shard are merged.
+        """
+        rows = [row for shard_rows in self._scatter(lambda shard: shard.get_most_active_users(limit)) for row in shard_rows]
+        return heapq.nsmallest(limit, rows, key=lambda row: (-row[1], row[0]))
+
+    def get_book_loan(self, book_id):
+        """
+        This method returns whether a book is out on any shard. The version is the sum of the
+        versions of all shards, so it changes with every check-out and return.
+        """
+        loans = self._scatter(lambda shard: shard.get_book_loan(book_id))
+        rent_id = next((loan['rent_id'] for loan in loans if loan['rent_id'] is not None), None)
+        return {'book_id': book_id, 'available': rent_id is None, 'rent_id': rent_id,
+                'version': sum(loan['version'] for loan in loans)}
+
+    def check_out(self, user_id, book_id, version=None):
+        """
+        This method rents a book to a user unless it is out on any shard.
+        The conditional insert only sees the shard of the user, so the book is claimed on its
+        own shard first and check-outs by users of different shards exclude each other there.
+        """
+        loan = self.get_book_loan(book_id)
+        if not loan['available'] or version not in (None, loan['version']):
+            return None
+        rent_id = self._next_id()
+        if not self._claim_book(book_id, rent_id):
+            return None
+        try:
+            checked_out = self.shard_for_user(user_id).check_out(user_id, book_id, rent_id=rent_id)
+        except Exception:
+            self._release_book(book_id, rent_id)
+            raise
+        if checked_out is None:
+            self._release_book(book_id, rent_id)
+        return checked_out
+
+    def return_book(self, rent_id):
+        """
+        This method returns a rented book.
+        """
+        returned = any(self._scatter(lambda shard: shard.return_book(rent_id)))
+        if returned:
+            self._end_loan(rent_id)
+        return returned
+
+    def _end_loan(self, rent_id):
+        book_id = self.get_rental_book_id(rent_id)
+        if book_id is not None:
+            self._release_book(book_id, rent_id)
+            self.assign_next_hold(book_id)
+
+    def get_rental_book_id(self, rent_id):
+        """
+        This method returns the book of a rental on any shard.
+        """
+        return next((book_id for book_id in self._scatter(lambda shard: shard.get_rental_book_id(rent_id))
+                     if book_id is not None), None)
+
+    def add_hold(self, book_id, user_id, priority=0):
+        """
+        This method puts a user on the waitlist of a book.
+        """
+        return self.holds.add_hold(book_id, user_id, priority)
+
+    def get_hold(self, hold_id):
+        """
+        This method returns a hold with its position in the waitlist of its book.
+        """
+        return self.holds.get_hold(hold_id)
+
+    def get_next_hold(self, book_id):
+        """
+        This method returns the hold which is served next for a book.
+        """
+        return self.holds.get_next_hold(book_id)
+
+    def get_waitlist(self, book_id, limit=100):
+        """
+        This method returns the waiting holds of a book in serving order.
+        """
+        return self.holds.get_waitlist(book_id, limit)
+
+    def cancel_hold(self, hold_id):
+        """
+        This method takes a waiting hold off the waitlist of its book.
+        """
+        return self.holds.cancel_hold(hold_id)
+
+    def assign_hold(self, hold_id, rent_id):
+        """
+        This method marks a waiting hold as served by a rental.
+        """
+        return self.holds.assign_hold(hold_id, rent_id)
+
+    def assign_next_hold(self, book_id):
+        """
+        This method rents a book to the user of its next hold if the book is not out.
+        The rental is written to the shard of the user and the hold to the holds shard, so the
+        two writes are not one transaction: a hold cancelled between them gets the book
+        returned again and the next hold is tried. No lock is held, the claim of the book lets
+        only one of two returns of the same book check it out.
+        """
+        hold = self.get_next_hold(book_id)
+        while hold is not None:
+            rent_id = self.check_out(hold['user_id'], book_id)
+            if rent_id is None:
+                return None
+            if self.assign_hold(hold['id'], rent_id):
+                return self.get_hold(hold['id'])
+            self.shard_for_user(hold['user_id']).return_book(rent_id)
+            self._release_book(book_id, rent_id)
+            hold = self.get_next_hold(book_id)
+        return None
+
+    def get_rental_pairs(self):
+        """
+        This method returns the user and book of every rental of all shards.
+        """
+        return [pair for pairs in self._scatter(lambda shard: shard.get_rental_pairs()) for pair in pairs]
+
+    def count_co_rentals(self, book_id, other_book_ids):
+        """
+        This method counts for every other book the users who rented both it and book_id.
+        Users never span two shards, so the counts of the shards are summed.
+        """
+        other_book_ids = list(other_book_ids)
+        totals = {}
+        for counts in self._scatter(lambda shard: shard.count_co_rentals(book_id, other_book_ids)):
+            for other_book_id, count in counts.items():
+                totals[other_book_id] = totals.get(other_book_id, 0) + count
+        return totals
+
+    def rebalance(self, shard_count):
+        """
+        Changes the number of shards and moves every rental to the shard of its user.
+        The rentals are copied before they are deleted from their old shard, with their ids,
+        so an interrupted rebalance can simply be run again. Run it while no check-outs happen.
+        The claims of the books out are moved to the new shards of the books as well.
+        :param shard_count: new number of shards
+        :return: number of moved rentals
+        """
+        for index in range(len(self.shards), shard_count):
+            shard = self._open_shard(index)
+            shard.create_table()
+            self.shards.append(shard)
+        moved = 0
+        for index, shard in enumerate(self.shards):
+            rows = shard.read_executor()('SELECT id, user_id, book_id, rented FROM rented_books') or []
+            for rent_id, user_id, book_id, rented in rows:
+                if user_id % shard_count == index:
+                    continue
+                target = self.shards[user_id % shard_count]
+                target.query_executor()(
+                    'INSERT OR IGNORE INTO rented_books (id, user_id, book_id, rented) VALUES (?, ?, ?, ?)',
+                    (rent_id, user_id, book_id, rented), fetch_all=False, expect_change=True)
+                shard.delete_rented_book(rent_id)
+                moved += 1
+        for shard in self.shards[shard_count:]:
+            shard.readers.close()
+            shard.conn.close()
+        del self.shards[shard_count:]
+        self.executor.shutdown()
+        self.executor = ThreadPoolExecutor(max_workers=shard_count)
+        self._scatter(lambda shard: shard.query_executor()('DELETE FROM book_claims', fetch_all=False))
+        for rental in self.get_rentals():
+            if rental['rented']:
+                self.shard_for_book(rental['book_id']).claim_book(rental['book_id'], rental['id'])
+        return moved
+
+    def close(self):
+        """
+        This method closes the connections to all shards.
+        """
+        self.executor.shutdown()
+        for shard in self.shards:
+            shard.readers.close()
+            shard.conn.close()
+        self.user_dao.close()
+        self.book_dao.close()
+
+    def drop_table(self):
+        """
+        This method drops the table in every shard.
+        """
+        self._scatter(lambda shard: shard.drop_table())
@@ -0,0 +1,129 @@
+"""
+This module times every SQL statement the DAOs run. Statements slower than
+SLOW_QUERY_THRESHOLD_MS are logged with their parameters, the calling DAO method and
+the output of EXPLAIN QUERY PLAN, and the slowest of them are kept for the admin endpoint.
+"""
+import heapq
+import logging
+import sqlite3
+import sys
+import threading
+import time
+
+import metrics
+import tracing
+
+SLOW_QUERY_THRESHOLD_MS = 100
+SLOW_QUERY_KEEP = 50
+
+_slowest = []
+_lock = threading.Lock()
+_counter = {'next': 0}
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor which times execute and executemany.
+    """
+
+    def execute(self, sql, parameters=(), /):
+        """Executes a statement and records its duration."""
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record(self.connection, sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        """Executes a statement for every parameter set and records the total duration."""
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record(self.connection, sql, None, time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Connection whose cursors, also the ones of Connection.execute, are TimedCursors.
+    """
+
+    def cursor(self, factory=TimedCursor):  # pylint: disable=useless-parent-delegation
+        """Returns a new cursor, a TimedCursor unless another factory is given."""
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=(), /):
+        """Executes a statement on a new TimedCursor, the C shortcut would skip the timing."""
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        """Executes a statement for every parameter set on a new TimedCursor."""
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _record(conn, sql, parameters, seconds):
+    metrics.increment('sql.statements')
+    metrics.increment('sql.seconds', seconds)
+    tracing.record_span('sql', seconds, statement=' '.join(sql.split())[:200])
+    if seconds * 1000 < SLOW_QUERY_THRESHOLD_MS:
+        return
+    metrics.increment('sql.slow_statements')
+    entry = {
+        'sql': ' '.join(sql.split()),
+        'parameters': repr(parameters)[:200],
+        'duration_ms': round(seconds * 1000, 3),
+        'dao_method': _calling_dao_method(),
+        'query_plan': _query_plan(conn, sql, parameters),
+        'logged_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    logging.warning('Slow query (%.1f ms) in %s: %s %s plan: %s', entry['duration_ms'],
+                    entry['dao_method'], entry['sql'], entry['parameters'], entry['query_plan'])
+    with _lock:
+        _counter['next'] += 1
+        item = (seconds, _counter['next'], entry)
+        if len(_slowest) < SLOW_QUERY_KEEP:
+            heapq.heappush(_slowest, item)
+        else:
+            heapq.heappushpop(_slowest, item)
+
+
+def _calling_dao_method():
+    """Returns module.Class.method of the innermost DAO frame on the stack."""
+    frame = sys._getframe(3)  # pylint: disable=protected-access
+    while frame is not None:
+        instance = frame.f_locals.get('self')
+        # Closures like RentedBookDao.query_executor are skipped in favour of their caller
+        if (instance is not None and type(instance).__name__.endswith('Dao')
+                and '<locals>' not in frame.f_code.co_qualname):
+            return f'{type(instance).__name__}.{frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+def _query_plan(conn, sql, parameters):
+    """Returns the EXPLAIN QUERY PLAN lines of a statement, without timing them again."""
+    if parameters is None or not sql.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE',
+                                                                  'DELETE', 'WITH')):
+        return []
+    try:
+        cursor = sqlite3.Cursor(conn)
+        return [row[3] for row in cursor.execute(f'EXPLAIN QUERY PLAN {sql}', parameters)]
+    except sqlite3.Error:
+        return []
+
+
+def get_slow_queries():
+    """
+    Returns the slowest statements logged so far, slowest first.
+    :return: list of dicts
+    """
+    with _lock:
+        return [entry for _, _, entry in sorted(_slowest, key=lambda item: item[0], reverse=True)]
+
+
+def clear():
+    """
+    Forgets all logged statements.
+    """
+    with _lock:
+        _slowest.clear()
@@ -0,0 +1,96 @@
+"""
+Online snapshots of the databases with the SQLite backup API.
+The databases are copied in small page steps while the service keeps running.
+
+Usage: python snapshot.py <target_dir> [--compress]
+"""
+import argparse
+import os
+import sqlite3
+import tarfile
+import time
+
+import metrics
+from db import BUSY_TIMEOUT_SECONDS
+from book_dao import BOOK_DB_NAME
+from rent_book_dao import RENTED_BOOK_DB_NAME
+from user_dao import USER_DB_NAME
+
+DB_FILES = (BOOK_DB_NAME, USER_DB_NAME, RENTED_BOOK_DB_NAME)
+SNAPSHOT_PAGES = 256
+SNAPSHOT_STEP_PAUSE_SECONDS = 0.001
+
+
+def snapshot_databases(target_dir, db_files=None, pages=SNAPSHOT_PAGES):
+    """
+    Copies the databases into target_dir at one consistent point.
+    The write lock of every file is taken first, so no write lands in between while a read
+    transaction is opened on every source; then the locks are given back. Under WAL the read
+    transactions pin the snapshot of all files while writers carry on appending to the WAL.
+    Writers wait for the locks like for any other writer, at most BUSY_TIMEOUT_SECONDS.
+    :param target_dir: directory the copies are written to, created if missing
+    :param db_files: database files to copy, defaults to DB_FILES
+    :param pages: number of pages copied per step, between the steps other threads can run
+    :return: list of the written files
+    """
+    db_files = db_files or DB_FILES
+    os.makedirs(target_dir, exist_ok=True)
+    sources = [sqlite3.connect(db_file, isolation_level=None, check_same_thread=False,
+                               timeout=BUSY_TIMEOUT_SECONDS)
+               for db_file in db_files]
+    writers = [sqlite3.connect(db_file, isolation_level=None, timeout=BUSY_TIMEOUT_SECONDS)
+               for db_file in db_files]
+    start = time.perf_counter()
+    try:
+        try:
+            for writer in writers:
+                writer.execute('BEGIN IMMEDIATE')
+            for source in sources:
+                source.execute('BEGIN')
+                source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        finally:
+            # Closing rolls the write transactions back, nothing was written in them
+            for writer in writers:
+                writer.close()
+        targets = []
+        for db_file, source in zip(db_files, sources):
+            target_file = os.path.join(target_dir, os.path.basename(db_file))
+            with sqlite3.connect(target_file) as target:
+                source.backup(target, pages=pages,
+                              progress=lambda status, remaining, total: time.sleep(
+                                  SNAPSHOT_STEP_PAUSE_SECONDS))
+            target.close()
+            targets.append(target_file)
+    finally:
+        for source in sources:
+            source.close()
+    metrics.increment('snapshot.runs')
+    metrics.increment('snapshot.seconds', time.perf_counter() - start)
+    return targets
+
+
+def export_snapshot(archive_file, snapshot_dir, db_files=None, compress=True):
+    """
+    Takes a snapshot and packs it into a tar archive.
+    :param archive_file: path of the .tar.gz (or .tar) file
+    :param snapshot_dir: directory the uncompressed snapshot is written to first
+    :param db_files: database files to copy, defaults to DB_FILES
+    :param compress: gzip compress the archive
+    :return: archive_file
+    """
+    with tarfile.open(archive_file, 'w:gz' if compress else 'w') as archive:
+        for snapshot_file in snapshot_databases(snapshot_dir, db_files):
+            archive.add(snapshot_file, arcname=os.path.basename(snapshot_file))
+    return archive_file
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Take an online snapshot of the databases.')
+    parser.add_argument('target_dir')
+    parser.add_argument('--compress', action='store_true',
+                        help='additionally write snapshot.tar.gz into target_dir')
+    args = parser.parse_args()
+    if args.compress:
+        print(export_snapshot(os.path.join(args.target_dir, 'snapshot.tar.gz'), args.target_dir))
+    else:
+        print('\n'.join(snapshot_databases(args.target_dir)))
@@ -0,0 +1,55 @@
+"""
+Blueprint for the circulation reports.
+"""
+from datetime import date, datetime, timedelta, timezone
+
+from flask import Blueprint, jsonify, request
+
+import changes_blueprint
+import rent_book_blueprint
+from branches import BranchLocal
+from circulation_dao import CirculationDao, GROUP_BY
+
+stats_blueprint = Blueprint('stats_blueprint', __name__)
+circulation_dao = BranchLocal('circulation_dao', CirculationDao())
+DEFAULT_REPORT_DAYS = 30
+
+
+@stats_blueprint.route('/stats/circulation', methods=['GET'])
+def get_circulation():
+    """
+    This method returns the loans and active users between ?from= and ?to= (YYYY-MM-DD, by
+    default the last 30 days) grouped by ?group_by=day or author. Rentals added since the last
+    report are rolled up first, the report itself only reads the daily rollups.
+    :return:
+    """
+    # The changelog timestamps are UTC
+    today = datetime.now(timezone.utc).date()
+    try:
+        to_day = date.fromisoformat(request.args.get('to', today.isoformat()))
+        from_day = date.fromisoformat(request.args.get(
+            'from', (to_day - timedelta(days=DEFAULT_REPORT_DAYS - 1)).isoformat()))
+    except ValueError:
+        return jsonify({'message': 'from and to must be dates in the format YYYY-MM-DD'}), 400
+    group_by = request.args.get('group_by', 'day')
+    if group_by not in GROUP_BY:
+        return jsonify({'message': f"group_by must be one of {', '.join(GROUP_BY)}"}), 400
+    roll_up()
+    circulation = circulation_dao.get_circulation(from_day.isoformat(), to_day.isoformat(),
+                                                  group_by)
+    return jsonify({'from': from_day.isoformat(), 'to': to_day.isoformat(),
+                    'group_by': group_by, **circulation}), 200
+
+
+def roll_up():
+    """
+    Folds the rentals added since the last roll up into the rollups of the current branch.
+    :return: the changelog sequence number of rented_books the rollups are up to
+    """
+    circulation_dao.roll_up(changes_blueprint.changelog_daos['rented_books'],
+                            rent_book_blueprint.rent_book_dao.book_dao)
+    return circulation_dao.get_last_seq()
+
+
+# The rollups count the inserts of rentals, a compaction must not drop those not yet rolled up
+changes_blueprint.register_compaction_limit('rented_books', roll_up)
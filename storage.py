@@ -0,0 +1,66 @@
+"""
+This module chooses the storage backend behind the DAOs, set with the environment variable
+LIBRARY_STORAGE_BACKEND like the data directory with LIBRARY_DATA_DIR.
+Every backend offers the methods of BookDao, UserDao and RentedBookDao, the blueprints only
+rely on those. "sqlite" uses the SQLite DAOs, "memory" the dict based engine of memory_dao
+which is persisted to MEMORY_SNAPSHOT_FILE in the data directory when a DAO is closed.
+"""
+import os
+
+from book_dao import BookDao, BOOK_DB_NAME
+from db import data_file
+from memory_dao import MemoryStorage, MemoryBookDao, MemoryUserDao, MemoryRentedBookDao
+import sharded_rent_book_dao
+from rent_book_dao import RENTED_BOOK_DB_NAME
+from user_dao import UserDao, USER_DB_NAME
+
+STORAGE_BACKENDS = ('sqlite', 'memory')
+STORAGE_BACKEND = os.environ.get('LIBRARY_STORAGE_BACKEND', 'sqlite')
+if STORAGE_BACKEND not in STORAGE_BACKENDS:
+    raise ValueError(f'LIBRARY_STORAGE_BACKEND must be one of {", ".join(STORAGE_BACKENDS)}')
+MEMORY_SNAPSHOT_FILE = data_file('library.snapshot.json')
+
+_memory_storage = {}
+
+
+def get_memory_storage():
+    """
+    Returns the in-memory storage shared by all memory DAOs, loaded from the snapshot once.
+    :return: MemoryStorage
+    """
+    if 'storage' not in _memory_storage:
+        _memory_storage['storage'] = MemoryStorage(MEMORY_SNAPSHOT_FILE)
+    return _memory_storage['storage']
+
+
+def create_book_dao(backend=None):
+    """
+    Creates the book DAO of the configured backend.
+    :param backend: "sqlite" or "memory", defaults to STORAGE_BACKEND
+    :return: BookDao or MemoryBookDao
+    """
+    if (backend or STORAGE_BACKEND) == 'memory':
+        return MemoryBookDao(get_memory_storage())
+    return BookDao(BOOK_DB_NAME)
+
+
+def create_user_dao(backend=None):
+    """
+    Creates the user DAO of the configured backend.
+    :param backend: "sqlite" or "memory", defaults to STORAGE_BACKEND
+    :return: UserDao or MemoryUserDao
+    """
+    if (backend or STORAGE_BACKEND) == 'memory':
+        return MemoryUserDao(get_memory_storage())
+    return UserDao(USER_DB_NAME)
+
+
+def create_rented_book_dao(backend=None):
+    """
+    Creates the rented book DAO of the configured backend.
+    :param backend: "sqlite" or "memory", defaults to STORAGE_BACKEND
+    :return: RentedBookDao, ShardedRentedBookDao or MemoryRentedBookDao
+    """
+    if (backend or STORAGE_BACKEND) == 'memory':
+        return MemoryRentedBookDao(get_memory_storage())
+    return sharded_rent_book_dao.create_rented_book_dao(RENTED_BOOK_DB_NAME)
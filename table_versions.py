@@ -0,0 +1,48 @@
+"""
+This module keeps a change version per table, so cached responses can tell whether they are stale.
+"""
+import threading
+
+_versions = {}
+_listeners = []
+_lock = threading.Lock()
+
+
+def bump(table):
+    """
+    Marks a table as changed. Called by the DAOs after every successful write.
+    :param table: name of the table
+    :return: the new version of the table
+    """
+    with _lock:
+        _versions[table] = _versions.get(table, 0) + 1
+        version = _versions[table]
+    for listener in _listeners:
+        listener(table)
+    return version
+
+
+def add_listener(listener):
+    """
+    Registers a function which is called with the table name after every bump.
+    :param listener: callable taking the table name
+    """
+    _listeners.append(listener)
+
+
+def get_version(table):
+    """
+    Returns the current version of a table.
+    :param table: name of the table
+    :return: int, 0 if the table was never changed
+    """
+    return _versions.get(table, 0)
+
+
+def get_versions(tables):
+    """
+    Returns the current versions of several tables.
+    :param tables: iterable of table names
+    :return: tuple of versions in the same order
+    """
+    return tuple(get_version(table) for table in tables)
@@ -0,0 +1,283 @@
+"""
+This module traces requests into spans: one span per HTTP request, child spans per DAO method
+and per SQL statement, and spans for serialize_data and jsonify.
+Tracing is sampled per request: TRACE_SAMPLE_RATE of the requests, and every request with the
+header X-Trace: 1, are traced. Finished spans are kept in an in-process ring buffer and, if
+TRACE_FILE is set, appended as JSON Lines to a rotating file.
+Requests which are not sampled only pay one context variable lookup per traced call.
+"""
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+from flask import current_app, request
+from flask.json.provider import DefaultJSONProvider
+
+TRACE_HEADER = 'X-Trace'
+TRACE_ID_HEADER = 'X-Trace-Id'
+TRACE_RING_SIZE = 10000
+TRACE_FILE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_FILE_BACKUPS = 3
+# The request span is kept in the WSGI environ, requests of a batch share the app context and g
+_ENVIRON_KEY = 'tracing.span'
+
+_current = contextvars.ContextVar('span', default=None)
+_ring = deque(maxlen=TRACE_RING_SIZE)
+_ring_lock = threading.Lock()
+_file_handlers = {}
+_file_lock = threading.Lock()
+
+
+class Span:  # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    """
+    A running span, all spans of a trace share the list of its finished spans.
+    """
+
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.parent_id = parent.span_id if parent else None
+        self.finished = parent.finished if parent else []
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.token = _current.set(self)
+
+    def to_dict(self, duration):
+        """Returns the finished span as it is exported."""
+        return {'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id,
+                'name': self.name, 'started_at': round(self.started_at, 6),
+                'duration_ms': round(duration * 1000, 3), 'attributes': self.attributes}
+
+
+def start_trace(name, sample_rate, force=False, **attributes):
+    """
+    Starts the root span of a new trace if the trace is sampled, or a child span if a trace
+    is already running, e.g. for the operations of a batch request.
+    :param name: span name
+    :param sample_rate: share of the traces which are sampled, 0 to 1
+    :param force: sample regardless of the rate
+    :return: Span or None if the trace is not sampled
+    """
+    parent = _current.get()
+    if parent is None and not force and random.random() >= sample_rate:
+        return None
+    return Span(name, parent, attributes)
+
+
+def start_span(name, **attributes):
+    """
+    Starts a child span of the current span.
+    :param name: span name
+    :return: Span or None without a sampled trace
+    """
+    parent = _current.get()
+    if parent is None:
+        return None
+    return Span(name, parent, attributes)
+
+
+def finish_span(span, trace_file=None, **attributes):
+    """
+    Ends a span and makes its parent the current span again. Ending the root span exports
+    all spans of the trace.
+    :param span: Span or None
+    :param trace_file: JSON Lines file the trace is appended to, or None
+    """
+    if span is None:
+        return
+    duration = time.perf_counter() - span.start
+    try:
+        _current.reset(span.token)
+    except ValueError:
+        # Ended in another context than it was started in
+        _current.set(None)
+    span.attributes.update(attributes)
+    span.finished.append(span.to_dict(duration))
+    if span.parent_id is None:
+        export(span.finished, trace_file)
+
+
+def record_span(name, seconds, **attributes):
+    """
+    Adds an already finished child span to the current trace, e.g. a timed SQL statement.
+    :param name: span name
+    :param seconds: duration which ended just now
+    """
+    parent = _current.get()
+    if parent is None:
+        return
+    span_id = uuid.uuid4().hex[:16]
+    parent.finished.append({'trace_id': parent.trace_id, 'span_id': span_id,
+                            'parent_id': parent.span_id, 'name': name,
+                            'started_at': round(time.time() - seconds, 6),
+                            'duration_ms': round(seconds * 1000, 3), 'attributes': attributes})
+
+
+def traced(name):
+    """
+    Decorator which runs a function in a child span of the current trace.
+    Recursive calls inside the span of the same name are not traced again.
+    :param name: span name
+    :return: decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            parent = _current.get()
+            if parent is None or parent.name == name:
+                return function(*args, **kwargs)
+            span = Span(name, parent, {})
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                span.attributes['error'] = type(e).__name__
+                raise
+            finally:
+                finish_span(span)
+        return wrapper
+    return decorator
+
+
+def trace_methods(cls):
+    """
+    Class decorator which traces every public method of a DAO as Class.method, static and
+    class methods are left alone.
+    :param cls: DAO class
+    :return: the class
+    """
+    for attribute, value in list(vars(cls).items()):
+        if inspect.isfunction(value) and not attribute.startswith('_') and attribute != 'close':
+            setattr(cls, attribute, traced(f'{cls.__name__}.{attribute}')(value))
+    return cls
+
+
+def export(spans, trace_file=None):
+    """
+    Keeps finished spans in the ring buffer and appends them to the trace file.
+    :param spans: list of span dicts
+    :param trace_file: path of the JSON Lines file, or None
+    """
+    with _ring_lock:
+        _ring.extend(spans)
+    if trace_file:
+        handler = _file_handler(trace_file)
+        for span in spans:
+            # handle, not emit: it takes the lock of the handler, which also guards the rollover
+            handler.handle(logging.makeLogRecord({'msg': json.dumps(span)}))
+
+
+def _file_handler(trace_file):
+    with _file_lock:
+        if trace_file not in _file_handlers:
+            handler = RotatingFileHandler(trace_file, maxBytes=TRACE_FILE_MAX_BYTES,
+                                          backupCount=TRACE_FILE_BACKUPS, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            _file_handlers[trace_file] = handler
+        return _file_handlers[trace_file]
+
+
+def get_spans(trace_id=None, limit=None):
+    """
+    Returns finished spans from the ring buffer, oldest first.
+    :param trace_id: only the spans of this trace
+    :param limit: only the latest spans
+    :return: list of span dicts
+    """
+    with _ring_lock:
+        spans = [span for span in _ring if trace_id is None or span['trace_id'] == trace_id]
+    return spans[-limit:] if limit else spans
+
+
+def summarize(spans):
+    """
+    Sums the spans of one trace by name, e.g. to see which DAO method a request spends its
+    time in. Nested spans are counted in their own and in their ancestors' totals.
+    :param spans: span dicts of one trace
+    :return: list of dicts with name, count, total_ms and share of the root span, slowest first
+    """
+    root = next((span for span in spans if span['parent_id'] is None), None)
+    totals = {}
+    for span in spans:
+        count, total = totals.get(span['name'], (0, 0.0))
+        totals[span['name']] = (count + 1, total + span['duration_ms'])
+    root_ms = root['duration_ms'] if root else 0
+    return sorted(({'name': name, 'count': count, 'total_ms': round(total, 3),
+                    'share': round(total / root_ms, 4) if root_ms else None}
+                   for name, (count, total) in totals.items()),
+                  key=lambda row: row['total_ms'], reverse=True)
+
+
+def clear():
+    """
+    Forgets all spans of the ring buffer.
+    """
+    with _ring_lock:
+        _ring.clear()
+
+
+class TracedJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider which times jsonify in a span.
+    """
+
+    def response(self, *args, **kwargs):
+        """Builds the JSON response of jsonify in a jsonify span."""
+        span = start_span('jsonify')
+        try:
+            return super().response(*args, **kwargs)
+        finally:
+            finish_span(span)
+
+
+def register_tracing(app):
+    """
+    Registers the tracing hooks on an app, tracing stays off until TRACE_SAMPLE_RATE is above 0
+    or a request carries X-Trace: 1.
+    :param app: flask app
+    """
+    app.config.setdefault('TRACE_SAMPLE_RATE', 0.0)
+    app.config.setdefault('TRACE_FILE', None)
+    app.json = TracedJSONProvider(app)
+    app.before_request(start_request_span)
+    app.after_request(tag_response)
+    app.teardown_request(finish_request_span)
+
+
+def start_request_span():
+    """
+    before_request hook, starts the span of the request if it is sampled.
+    """
+    rule = request.url_rule.rule if request.url_rule else request.path
+    request.environ[_ENVIRON_KEY] = start_trace(
+        f'{request.method} {rule}', current_app.config['TRACE_SAMPLE_RATE'],
+        force=request.headers.get(TRACE_HEADER) == '1', path=request.path)
+
+
+def tag_response(response):
+    """
+    after_request hook, records the status and returns the trace id in X-Trace-Id.
+    :param response: flask response
+    :return: response
+    """
+    span = request.environ.get(_ENVIRON_KEY)
+    if span is not None:
+        span.attributes['status'] = response.status_code
+        response.headers[TRACE_ID_HEADER] = span.trace_id
+    return response
+
+
+def finish_request_span(_exception):
+    """
+    teardown_request hook, ends the span of the request and exports the trace.
+    """
+    finish_span(request.environ.pop(_ENVIRON_KEY, None), current_app.config['TRACE_FILE'])
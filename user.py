@@ -10,3 +10,10 @@ class User:
     user_id: int
     username: str
     password: str
+
+    def public_dict(self):
+        """
+        Returns the user as it leaves the API, without the password hash.
+        :return: dict with user_id and username
+        """
+        return {'user_id': self.user_id, 'username': self.username}
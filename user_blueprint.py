@@ -3,27 +3,34 @@ Blueprint for user operations.
 """
 # pylint: disable=no-else-return
 from flask import Blueprint, request, jsonify
-from user_dao import UserDao, USER_DB_NAME
+import password_hashing
+from bloom_filter import MAX_EXISTENCE_CHECKS, existence_response
+from branches import BranchLocal
 from user import User
+from projection import parse_fields
+from response_cache import cached_response
+from storage import create_user_dao
 
 user_blueprint = Blueprint('user_blueprint', __name__)
-user_dao = UserDao(db_file=USER_DB_NAME)
+user_dao = BranchLocal('user_dao', create_user_dao())
 
 
 @user_blueprint.route('/users', methods=['GET'])
+@cached_response('users')
 def get_all_users():
     """
     This method returns all the users from the database.
+    Supports ?fields=user_id,username to only select and return the given fields.
+    The password hashes are never returned.
     :return list of users in json format:
     """
-    users = user_dao.get_all_users()
-    users_dict = []
-    for user in users:
-        user_dict = user.__dict__
-        if isinstance(user_dict.get('password'), bytes):
-            user_dict['password'] = user_dict['password'].decode('utf-8')
-        users_dict.append(user_dict)
-    return jsonify(users_dict), 200
+    try:
+        fields = parse_fields(request.args.get('fields'), User, hidden=('password',))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    if fields:
+        return jsonify(user_dao.get_all_users(fields=fields)), 200
+    return jsonify([user.public_dict() for user in user_dao.get_all_users()]), 200
 
 
 @user_blueprint.route('/user_by_id/<int:user_id>', methods=['GET'])
@@ -36,7 +43,7 @@ def get_user(user_id):
     user = user_dao.get_one_user(user_id)
 
     if user:
-        return jsonify(user.__dict__), 200
+        return jsonify(user.public_dict()), 200
     else:
         return jsonify({'message': 'User not found'}), 404
 
@@ -44,13 +51,13 @@ def get_user(user_id):
 @user_blueprint.route('/user_by_username/<string:user_name>', methods=['GET'])
 def get_user_by_username(user_name):
     """
-    This method returns a user by its id and password.
+    This method returns a user by its username.
     :param user_name:
     :return user json format:
     """
     user = user_dao.get_user_by_username(user_name)
     if user:
-        response = jsonify(user.__dict__)
+        response = jsonify(user.public_dict())
         response.status_code = 200
     else:
         response = jsonify({'message': 'User not found'})
@@ -59,6 +66,20 @@ def get_user_by_username(user_name):
     return response
 
 
+@user_blueprint.route('/users/exists', methods=['POST'])
+def get_existing_usernames():
+    """
+    This method tells which usernames are taken, e.g. {"usernames": ["alice", "bob"]}, to
+    validate a bulk onboarding with one call. Usernames the Bloom filter rules out cost no query.
+    :return existing and missing usernames:
+    """
+    usernames = (request.get_json(silent=True) or {}).get('usernames')
+    if not isinstance(usernames, list) or len(usernames) > MAX_EXISTENCE_CHECKS:
+        message = f'usernames must be a list of at most {MAX_EXISTENCE_CHECKS} names'
+        return jsonify({'message': message}), 400
+    return jsonify(existence_response(usernames, user_dao.get_existing_usernames(usernames))), 200
+
+
 @user_blueprint.route('/add_user', methods=['POST'])
 def add_user():
     """
@@ -71,6 +92,23 @@ def add_user():
     return jsonify({'message': 'User created'}), 201
 
 
+@user_blueprint.route('/login', methods=['POST'])
+def login():
+    """
+    This method verifies a username and password, e.g. {"username": "admin", "password": "admin"}.
+    The scrypt check runs on the hashing thread pool and successful checks are cached briefly.
+    :return user id and username, or 401:
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get('username'), str) or not isinstance(data.get('password'), str):
+        return jsonify({'message': 'username and password are required'}), 400
+    user = user_dao.get_user_by_username(data['username'])
+    if password_hashing.check_credentials(user, data['password']):
+        return jsonify(user.public_dict()), 200
+    else:
+        return jsonify({'message': 'Invalid username or password'}), 401
+
+
 @user_blueprint.route('/delete_user/<int:user_id>', methods=['DELETE'])
 def delete_user_by_id_and_password(user_id):
     """
@@ -1,20 +1,34 @@
 """
 This module is responsible for handling user data.
 """
+import json
 import sqlite3
+from bloom_filter import ExistenceFilter
+from db import connect, data_file, ReadOnlyPool
+from tracing import trace_methods
+from password_hashing import hash_password
 from user import User
+from changelog_dao import create_changelog_triggers
+import table_versions
 
-USER_DB_NAME = 'user.db'
+USER_DB_NAME = data_file('user.db')
+USER_COLUMNS = ('user_id', 'username', 'password')
 
 
+@trace_methods
 class UserDao:
     """
     This class handles all the database operations related to the user entity.
     """
 
     def __init__(self, db_file=USER_DB_NAME):
-        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn = connect(db_file)
         self.cursor = self.conn.cursor()
+        # GET routes read through their own read-only connections, self.conn only writes
+        self.readers = ReadOnlyPool(db_file, self.conn)
+        # Lookups of usernames which definitely do not exist skip the database
+        self.usernames = ExistenceFilter('usernames', self.readers, 'users', 'username')
+        self.existence_filters = {'usernames': self.usernames}
 
     def create_table(self):
         """
@@ -29,32 +43,43 @@ class UserDao:
                     password TEXT NOT NULL
                 )
             ''')
+            # The password is deliberately not part of the change feed
+            create_changelog_triggers(self.cursor, 'users', 'user_id', ('user_id', 'username'))
             self.conn.commit()
+            self.usernames.rebuild()
+            table_versions.bump('users')
         except sqlite3.OperationalError as e:
             print(f'Error creating table: {e}')
 
     def add_user(self, user):
         """
-        Adds a user to the database.
+        Adds a user to the database, the password is stored as scrypt hash.
         :param user: dict or User object
         """
         username = user['username'] if isinstance(user, dict) else user.username
-        password = user['password'] if isinstance(user, dict) else user.password
-        try:
-            self.cursor.execute('INSERT INTO users (username, password) VALUES (?, ?)',
-                                (username, password))
-            self.conn.commit()
-            return True
-        except sqlite3.IntegrityError:
+        password = hash_password(user['password'] if isinstance(user, dict) else user.password)
+        self.cursor.execute('INSERT INTO users (username, password) VALUES (?, ?) '
+                            'ON CONFLICT(username) DO NOTHING RETURNING user_id',
+                            (username, password))
+        row = self.cursor.fetchone()
+        self.conn.commit()
+        self.usernames.add(username)
+        if row is None:
             print('User already exists')
             return False
+        table_versions.bump('users')
+        return True
 
-    def get_all_users(self):
+    def get_all_users(self, fields=None):
         """
         This method returns all the users from the database.
+        :param fields: Tuple of column names to select (optional), see projection.parse_fields.
+        :return: list of User objects, or a list of dicts if fields is given.
         """
-        self.cursor.execute('SELECT * FROM users')
-        rows = self.cursor.fetchall()
+        with self.readers.connection() as conn:
+            rows = conn.execute(f"SELECT {', '.join(fields or USER_COLUMNS)} FROM users").fetchall()
+        if fields:
+            return [dict(zip(fields, row)) for row in rows]
         users = [User(row[0], row[1], row[2]) for row in rows]
         return users
 
@@ -62,53 +87,88 @@ class UserDao:
         """
         This method returns a user from the database.
         """
-        self.cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        row = self.cursor.fetchone()
+        with self.readers.connection() as conn:
+            row = conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)).fetchone()
         if row:
             return User(row[0], row[1], row[2])
         return None
 
+    def get_users_by_ids(self, user_ids):
+        """
+        This method returns several users with one query, the ids are passed as one json array.
+        :param user_ids: iterable of user ids
+        :return: dict of user id to User
+        """
+        with self.readers.connection() as conn:
+            rows = conn.execute(
+                'SELECT * FROM users WHERE user_id IN (SELECT value FROM json_each(?))',
+                (json.dumps(list(user_ids)),)
+            ).fetchall()
+        return {row[0]: User(row[0], row[1], row[2]) for row in rows}
+
     def get_user_by_username(self, username):
         """
-        This method returns a user from the database.
+        This method returns a user from the database, without a query if the username
+        definitely does not exist.
         """
-        self.cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-        row = self.cursor.fetchone()
+        if not self.usernames.might_contain(username):
+            return None
+        with self.readers.connection() as conn:
+            row = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
         if row:
             return User(row[0], row[1], row[2])
+        self.usernames.record_false_positives(1)
         return None
 
+    def get_existing_usernames(self, usernames):
+        """
+        This method tells which of many usernames exist, e.g. to validate a bulk onboarding.
+        Only the usernames which pass the Bloom filter are looked up, with one query.
+        :param usernames: iterable of usernames
+        :return: set of the existing usernames
+        """
+        candidates = self.usernames.candidates(usernames)
+        if not candidates:
+            return set()
+        with self.readers.connection() as conn:
+            rows = conn.execute(
+                'SELECT username FROM users WHERE username IN (SELECT value FROM json_each(?))',
+                (json.dumps(candidates),)
+            ).fetchall()
+        existing = {row[0] for row in rows}
+        self.usernames.record_false_positives(len(set(candidates)) - len(existing))
+        return existing
+
     def delete_user_by_id(self, user_id):
         """
         This method deletes a user from the database.
         """
-        self.cursor.execute('SELECT password FROM users WHERE user_id = ?', (user_id,))
-        row = self.cursor.fetchone()
-
-        if row:
-            # Delete the user if the password is correct
-            self.cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-            if self.cursor.rowcount > 0:
-                self.conn.commit()
-                return True
-        return False
+        self.cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+        deleted = self.cursor.rowcount > 0
+        self.conn.commit()
+        if deleted:
+            table_versions.bump('users')
+        return deleted
 
     def update_user(self, updated_user):
         """
-        This method updates a user.
+        This method updates a user, the password is stored as scrypt hash.
         """
         self.cursor.execute('UPDATE users SET username = ?, password = ? WHERE user_id = ?',
-                            (updated_user.username, updated_user.password,
+                            (updated_user.username, hash_password(updated_user.password),
                              updated_user.user_id))
-        if self.cursor.rowcount > 0:
-            self.conn.commit()
-            return True
-        return False
+        updated = self.cursor.rowcount > 0
+        self.conn.commit()
+        if updated:
+            self.usernames.add(updated_user.username)
+            table_versions.bump('users')
+        return updated
 
     def close(self):
         """
         This method closes the connection to the database.
         """
+        self.readers.close()
         self.conn.close()
 
     def drop_table(self):
@@ -117,4 +177,5 @@ class UserDao:
         """
         self.cursor.execute('DROP TABLE IF EXISTS users')
         self.conn.commit()
+        table_versions.bump('users')
         return True
@@ -0,0 +1,177 @@
+"""
+This module keeps the waiting holds of a book in memory, so that the next patron and the
+queue position of a hold are found in O(log n).
+Holds are served by priority, highest first, and in the order they were placed within a
+priority. A heap gives the next hold, and a Fenwick tree per priority counts the holds still
+waiting before a hold, the number of priorities is bounded by MAX_HOLD_PRIORITY.
+Cancelled and assigned holds are only marked in the tree and dropped from the heap lazily.
+"""
+import heapq
+import threading
+from collections import OrderedDict
+
+MAX_HOLD_PRIORITY = 9
+HOT_WAITLISTS = 1024
+# Locks the waitlists are spread over, the waitlists of two books rarely share one
+WAITLIST_LOCKS = 64
+
+
+class _WaitingCounts:
+    """
+    Fenwick tree over the arrival slots of one priority, a slot counts 1 while its hold waits.
+    """
+
+    def __init__(self):
+        self.tree = [0]
+        self.total = 0
+
+    def append(self):
+        """Adds a waiting hold in the next slot and returns the slot."""
+        slot = len(self.tree)
+        # The node of a slot sums the slots (slot - lowbit, slot]
+        self.tree.append(1 + self.prefix(slot - 1) - self.prefix(slot - (slot & -slot)))
+        self.total += 1
+        return slot
+
+    def remove(self, slot):
+        """Stops counting the hold of a slot."""
+        self.total -= 1
+        while slot < len(self.tree):
+            self.tree[slot] -= 1
+            slot += slot & -slot
+
+    def prefix(self, slot):
+        """Returns the number of waiting holds in the slots up to and including slot."""
+        count = 0
+        while slot > 0:
+            count += self.tree[slot]
+            slot -= slot & -slot
+        return count
+
+
+class Waitlist:
+    """
+    The waiting holds of one book.
+    """
+
+    def __init__(self, holds=()):
+        """
+        :param holds: (hold_id, priority) tuples of the waiting holds in queue order
+        """
+        self.heap = []
+        self.slots = {}
+        self.counts = {}
+        for hold_id, priority in holds:
+            self.push(hold_id, priority)
+
+    def push(self, hold_id, priority):
+        """
+        Adds a hold behind all waiting holds of the same priority, unless it is waiting already.
+        :param hold_id: int
+        :param priority: int from 0 to MAX_HOLD_PRIORITY
+        """
+        if hold_id in self.slots:
+            return
+        slot = self.counts.setdefault(priority, _WaitingCounts()).append()
+        self.slots[hold_id] = (priority, slot)
+        heapq.heappush(self.heap, (-priority, slot, hold_id))
+
+    def remove(self, hold_id):
+        """
+        Removes a hold which was assigned or cancelled.
+        :param hold_id: int
+        :return: True if the hold was waiting
+        """
+        entry = self.slots.pop(hold_id, None)
+        if entry is None:
+            return False
+        priority, slot = entry
+        self.counts[priority].remove(slot)
+        # Cancelled holds leave dead heap entries and slots behind, rebuild when they dominate
+        if len(self.heap) > 2 * len(self.slots) + 64:
+            self._rebuild()
+        return True
+
+    def peek(self):
+        """
+        Returns the next hold.
+        :return: hold id, or None if no hold waits
+        """
+        while self.heap and self.heap[0][2] not in self.slots:
+            heapq.heappop(self.heap)
+        return self.heap[0][2] if self.heap else None
+
+    def position(self, hold_id):
+        """
+        Returns the position of a waiting hold in the queue.
+        :param hold_id: int
+        :return: 1 for the next hold, None if the hold does not wait
+        """
+        entry = self.slots.get(hold_id)
+        if entry is None:
+            return None
+        priority, slot = entry
+        ahead = sum(counts.total for other, counts in self.counts.items() if other > priority)
+        return ahead + self.counts[priority].prefix(slot)
+
+    def _rebuild(self):
+        waiting = [(-negated_priority, hold_id)
+                   for negated_priority, _, hold_id in sorted(self.heap) if hold_id in self.slots]
+        self.heap, self.slots, self.counts = [], {}, {}
+        for priority, hold_id in waiting:
+            self.push(hold_id, priority)
+
+    def __len__(self):
+        return len(self.slots)
+
+
+class WaitlistCache:
+    """
+    The waitlists of the most recently used books, loaded on first use.
+    """
+
+    def __init__(self, load, max_size=HOT_WAITLISTS):
+        """
+        :param load: callable which returns the (hold_id, priority) tuples of a book in queue order
+        :param max_size: number of waitlists kept
+        """
+        self.load = load
+        self.max_size = max_size
+        self.waitlists = OrderedDict()
+        # Guards the OrderedDict only, the waitlists themselves are guarded by lock_for
+        self.cache_lock = threading.Lock()
+        self.locks = [threading.RLock() for _ in range(WAITLIST_LOCKS)]
+
+    def lock_for(self, book_id):
+        """
+        Returns the lock held while the waitlist of a book is read or changed.
+        :param book_id: int
+        :return: threading.RLock
+        """
+        return self.locks[book_id % len(self.locks)]
+
+    def get(self, book_id):
+        """
+        Returns the waitlist of a book, the caller has to hold lock_for(book_id).
+        :param book_id: int
+        :return: Waitlist
+        """
+        with self.cache_lock:
+            waitlist = self.waitlists.get(book_id)
+            if waitlist is not None:
+                self.waitlists.move_to_end(book_id)
+                return waitlist
+        # Loaded outside the cache lock, the lock of the book keeps out a second load
+        waitlist = Waitlist(self.load(book_id))
+        with self.cache_lock:
+            self.waitlists[book_id] = waitlist
+            if len(self.waitlists) > self.max_size:
+                self.waitlists.popitem(last=False)
+        return waitlist
+
+    def clear(self):
+        """
+        Forgets all waitlists, e.g. after the holds table was recreated.
+        """
+        with self.cache_lock:
+            self.waitlists.clear()